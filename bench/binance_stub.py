@@ -0,0 +1,77 @@
+"""
+Локальная заглушка Binance klines для проверки планировщика загрузки истории.
+
+    python3 -m bench.binance_stub [порт] [бюджет_веса_в_минуту]
+
+    BINANCE_SPOT_KLINES=http://127.0.0.1:8765/api/v3/klines \\
+    BINANCE_FUTURES_KLINES=http://127.0.0.1:8765/fapi/v1/klines \\
+    python3 -m cex.binance_history all all 1h
+
+Отдаёт синтетические свечи, считает вес по минутным окнам как Binance,
+шлёт X-MBX-USED-WEIGHT-1M и отвечает 429 + Retry-After при превышении.
+"""
+import sys
+import time
+
+from aiohttp import web
+
+from cex.binance_history import TF_TO_MS, KLINES_WEIGHT
+
+LISTED = 1_600_000_000_000
+
+
+class Stub:
+    def __init__(self, budget):
+        self.budget = budget
+        self.window = 0
+        self.used = 0
+        self.requests = 0
+        self.rejected = 0
+
+    def handler(self, market):
+        async def klines(request):
+            now = time.time()
+            window = int(now // 60)
+            if window != self.window:
+                self.window, self.used = window, 0
+            self.used += KLINES_WEIGHT[market]
+            self.requests += 1
+            headers = {"X-MBX-USED-WEIGHT-1M": str(self.used)}
+            if self.used > self.budget:
+                self.rejected += 1
+                headers["Retry-After"] = str(60 - int(now % 60))
+                return web.json_response({"code": -1003, "msg": "Too many requests"}, status=429, headers=headers)
+
+            q = request.query
+            tf_ms = TF_TO_MS[q["interval"]]
+            start = max(int(q.get("startTime", LISTED)), LISTED)
+            start += (-start) % tf_ms
+            end = min(int(q.get("endTime", now * 1000)), int(now * 1000))
+            limit = int(q.get("limit", 500))
+
+            rows = []
+            t = start
+            while t <= end and len(rows) < limit:
+                price = 100 + (t // tf_ms) % 50
+                rows.append([t, str(price), str(price + 1), str(price - 1), str(price), "10", t + tf_ms - 1])
+                t += tf_ms
+            return web.json_response(rows, headers=headers)
+        return klines
+
+    async def stats(self, request):
+        return web.json_response({"requests": self.requests, "rejected": self.rejected, "used": self.used})
+
+
+def main():
+    port = int(sys.argv[1]) if len(sys.argv) > 1 else 8765
+    budget = int(sys.argv[2]) if len(sys.argv) > 2 else 6000
+    stub = Stub(budget)
+    app = web.Application()
+    app.router.add_get("/api/v3/klines", stub.handler("spot"))
+    app.router.add_get("/fapi/v1/klines", stub.handler("futures"))
+    app.router.add_get("/stats", stub.stats)
+    web.run_app(app, port=port)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,72 @@
+"""
+Холодный архив против Mongo: латентность чтения диапазона и размер на диске.
+
+    python3 -m bench.candle_archive [свечей] [запросов]
+
+Пишет 1m-свечи в отдельную базу tradium_bench, меряет find_columns из Mongo,
+затем компактит всё в архив во временном каталоге и меряет те же срезы из mmap.
+"""
+import asyncio
+import random
+import statistics
+import sys
+import tempfile
+import time
+
+from db import client
+from candle_store import DocumentCandleStore
+from candle_archive import CandleArchive
+from bench.candle_storage import SYMBOLS, PAGE, START, MARKET, TF, seed
+
+
+async def measure(name, query, per_symbol, runs):
+    samples = []
+    for _ in range(runs):
+        before = START + random.randint(PAGE, per_symbol) * 60
+        started = time.perf_counter()
+        result = query(random.choice(SYMBOLS), before)
+        if asyncio.iscoroutine(result):
+            await result
+        samples.append((time.perf_counter() - started) * 1000)
+    samples.sort()
+    print(
+        f"{name:14} | p50 {statistics.median(samples):8.2f} ms | "
+        f"p99 {samples[max(0, int(len(samples) * 0.99) - 1)]:8.2f} ms | max {samples[-1]:8.2f} ms"
+    )
+
+
+async def _main():
+    total = int(sys.argv[1]) if len(sys.argv) > 1 else 3_000_000
+    runs = int(sys.argv[2]) if len(sys.argv) > 2 else 200
+
+    store = DocumentCandleStore(client["tradium_bench"])
+    await store.collection("bench", MARKET, TF).drop()
+    await store.ensure_indexes("bench", MARKET, TF)
+    print(f"Seeding {total} candles...")
+    per_symbol = await seed(store, total)
+
+    await measure("mongo", lambda s, b: store.find_columns("bench", MARKET, s, TF, b, PAGE), per_symbol, runs)
+    stats = await store.storage_stats("bench", MARKET, TF)
+    mongo_size = stats["storage"] + stats["indexes"]
+
+    with tempfile.TemporaryDirectory() as root:
+        archive = CandleArchive(root, store)
+        started = time.perf_counter()
+        cutoff = START + per_symbol * 60
+        for symbol in SYMBOLS:
+            # сид сплошной — чекпоинта докачки у bench нет, вся серия считается проверенной
+            await archive.compact_series("bench", MARKET, symbol, TF, cutoff, verified=cutoff)
+        print(f"compaction: {time.perf_counter() - started:.1f} s")
+
+        await measure(
+            "archive",
+            lambda s, b: archive.series("bench", MARKET, s, TF).read(b, PAGE),
+            per_symbol, runs
+        )
+        print(f"mongo {mongo_size / 2**20:.1f} MiB (data+indexes), archive {archive.disk_size() / 2**20:.1f} MiB")
+
+    await store.collection("bench", MARKET, TF).drop()
+
+
+if __name__ == "__main__":
+    asyncio.run(_main())
@@ -0,0 +1,89 @@
+"""
+Документные коллекции свечей против time-series: размер на диске и латентность.
+
+    python3 -m bench.candle_storage [свечей] [запросов]
+
+Пишет одни и те же 1m-свечи в оба backend'а candle_store в отдельной базе
+tradium_bench и меряет постраничный /history (find), колоночный
+(find_columns) и добор старшей свечи (summarize).
+"""
+import asyncio
+import random
+import statistics
+import sys
+import time
+
+from db import client
+from candle_store import DocumentCandleStore, TimeSeriesCandleStore
+
+SYMBOLS = ["BTCUSDT", "ETHUSDT", "BNBUSDT", "XRPUSDT", "SOLUSDT"]
+PAGE = 1000
+START = 1_500_000_000
+MARKET = "spot"
+TF = "1m"
+
+
+async def seed(store, total):
+    per_symbol = total // len(SYMBOLS)
+    batch = []
+    for symbol in SYMBOLS:
+        for i in range(per_symbol):
+            price = 100 + (i % 1000) / 10
+            batch.append({
+                "symbol": symbol, "timestamp": START + i * 60,
+                "open": price, "high": price + 1, "low": price - 1, "close": price, "volume": 10.0,
+            })
+            if len(batch) == 10_000:
+                await store.insert("bench", MARKET, TF, batch)
+                batch = []
+    if batch:
+        await store.insert("bench", MARKET, TF, batch)
+    return per_symbol
+
+
+async def measure(name, query, per_symbol, runs):
+    samples = []
+    for _ in range(runs):
+        before = START + random.randint(PAGE, per_symbol) * 60
+        started = time.perf_counter()
+        await query(random.choice(SYMBOLS), before)
+        samples.append((time.perf_counter() - started) * 1000)
+    samples.sort()
+    print(
+        f"{name:24} | p50 {statistics.median(samples):8.2f} ms | "
+        f"p99 {samples[max(0, int(len(samples) * 0.99) - 1)]:8.2f} ms | max {samples[-1]:8.2f} ms"
+    )
+
+
+async def bench(store, total, runs):
+    coll = store.collection("bench", MARKET, TF)
+    await coll.drop()
+    await store.ensure_indexes("bench", MARKET, TF)
+
+    started = time.perf_counter()
+    per_symbol = await seed(store, total)
+    print(f"[{store.name}] insert {total} свечей: {time.perf_counter() - started:.1f} s")
+
+    await measure(f"{store.name} find", lambda s, b: store.find("bench", MARKET, s, TF, b, PAGE), per_symbol, runs)
+    await measure(f"{store.name} find_columns", lambda s, b: store.find_columns("bench", MARKET, s, TF, b, PAGE), per_symbol, runs)
+    await measure(f"{store.name} summarize 1d", lambda s, b: store.summarize("bench", MARKET, s, TF, b - 86_400, b), per_symbol, runs)
+
+    stats = await store.storage_stats("bench", MARKET, TF)
+    print(
+        f"[{store.name}] storage {stats['storage'] / 2**20:.1f} MiB, "
+        f"indexes {stats['indexes'] / 2**20:.1f} MiB"
+    )
+    await coll.drop()
+
+
+async def _main():
+    total = int(sys.argv[1]) if len(sys.argv) > 1 else 3_000_000
+    runs = int(sys.argv[2]) if len(sys.argv) > 2 else 200
+
+    database = client["tradium_bench"]
+    for store in (DocumentCandleStore(database), TimeSeriesCandleStore(database)):
+        await bench(store, total, runs)
+
+
+if __name__ == "__main__":
+    asyncio.run(_main())
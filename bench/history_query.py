@@ -0,0 +1,98 @@
+"""
+Латентность постраничной загрузки /history (before=) на большой коллекции свечей.
+
+    python3 -m bench.history_query [свечей] [запросов]
+
+Пишет свечи в отдельную базу tradium_bench и сравнивает старый запрос
+(без индекса, полные документы, str(_id) в цикле) с новым
+(индекс {symbol, timestamp} + проекция HISTORY_PROJECTION).
+"""
+import asyncio
+import random
+import statistics
+import sys
+import time
+
+from pymongo import InsertOne
+
+from db import client
+from candles import HISTORY_PROJECTION
+
+SYMBOLS = ["BTCUSDT", "ETHUSDT", "BNBUSDT", "XRPUSDT", "SOLUSDT"]
+PAGE = 1000
+START = 1_500_000_000
+
+
+async def seed(coll, total):
+    per_symbol = total // len(SYMBOLS)
+    batch = []
+    for symbol in SYMBOLS:
+        for i in range(per_symbol):
+            price = 100 + (i % 1000) / 10
+            batch.append(InsertOne({
+                "symbol": symbol, "timestamp": START + i * 60,
+                "open": price, "high": price + 1, "low": price - 1, "close": price, "volume": 10.0,
+                "openTime": START + i * 60, "closeTime": START + i * 60 + 59,
+                "isFinal": True, "price": price, "timer": 0
+            }))
+            if len(batch) == 10_000:
+                await coll.bulk_write(batch, ordered=False)
+                batch = []
+    if batch:
+        await coll.bulk_write(batch, ordered=False)
+    return per_symbol
+
+
+async def old_query(coll, symbol, before):
+    cursor = coll.find({"symbol": symbol, "timestamp": {"$lt": before}}).sort("timestamp", -1).limit(PAGE)
+    history = await cursor.to_list(None)
+    for candle in history:
+        candle["_id"] = str(candle["_id"])
+    return history
+
+
+async def new_query(coll, symbol, before):
+    cursor = coll.find({"symbol": symbol, "timestamp": {"$lt": before}}, HISTORY_PROJECTION).sort("timestamp", -1).limit(PAGE)
+    return await cursor.to_list(None)
+
+
+async def measure(name, query, coll, per_symbol, runs):
+    samples = []
+    for _ in range(runs):
+        before = START + random.randint(PAGE, per_symbol) * 60
+        started = time.perf_counter()
+        try:
+            await query(coll, random.choice(SYMBOLS), before)
+        except Exception as e:
+            print(f"{name}: {e}")
+            return
+        samples.append((time.perf_counter() - started) * 1000)
+    samples.sort()
+    print(
+        f"{name:14} | p50 {statistics.median(samples):8.2f} ms | "
+        f"p99 {samples[max(0, int(len(samples) * 0.99) - 1)]:8.2f} ms | max {samples[-1]:8.2f} ms"
+    )
+
+
+async def _main():
+    total = int(sys.argv[1]) if len(sys.argv) > 1 else 3_000_000
+    runs = int(sys.argv[2]) if len(sys.argv) > 2 else 200
+
+    coll = client["tradium_bench"]["candles_1m"]
+    await coll.drop()
+    print(f"Seeding {total} candles...")
+    per_symbol = await seed(coll, total)
+
+    # без индекса сортировка идёт в памяти — хватит и малого числа запросов
+    await measure("no index", old_query, coll, per_symbol, max(5, runs // 20))
+    await coll.create_index([("symbol", 1), ("timestamp", 1)], unique=True, name="symbol_timestamp")
+    await measure("index", old_query, coll, per_symbol, runs)
+    await measure("index+project", new_query, coll, per_symbol, runs)
+
+    stats = await client["tradium_bench"].command("collstats", "candles_1m")
+    print(f"data {stats['size'] / 2**20:.1f} MiB, indexes {stats['totalIndexSize'] / 2**20:.1f} MiB")
+    await coll.drop()
+
+
+if __name__ == "__main__":
+    asyncio.run(_main())
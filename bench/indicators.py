@@ -0,0 +1,71 @@
+"""
+Серверные индикаторы: время расчёта каждого индикатора на большом ряде свечей.
+
+    python3 -m bench.indicators [свечей] [повторов]
+
+Ряд синтетический (случайное блуждание), параметры — клиентские по умолчанию.
+Для сравнения — EMA обычным циклом, как её считает браузер.
+"""
+import statistics
+import sys
+import time
+
+import numpy as np
+
+from indicators import INDICATORS, resolve_params, compute, ema
+
+
+def candles(n):
+    rng = np.random.default_rng(1)
+    close = 100 * np.exp(np.cumsum(rng.normal(0, 0.001, n)))
+    open_ = np.concatenate(([close[0]], close[:-1]))
+    spread = np.abs(rng.normal(0, 0.001, n)) * close
+    return {
+        "t": np.arange(n, dtype=np.int64) * 60,
+        "o": open_,
+        "h": np.maximum(open_, close) + spread,
+        "l": np.minimum(open_, close) - spread,
+        "c": close,
+        "v": rng.random(n) * 100,
+    }
+
+
+def measure(name, func, runs):
+    samples = []
+    for _ in range(runs):
+        started = time.perf_counter()
+        func()
+        samples.append((time.perf_counter() - started) * 1000)
+    print(f"{name:16} | median {statistics.median(samples):9.2f} ms | max {max(samples):9.2f} ms")
+    return statistics.median(samples)
+
+
+def ema_loop(values, period):
+    k = 2 / (period + 1)
+    prev = values[0]
+    out = [prev]
+    for value in values[1:]:
+        prev = value * k + prev * (1 - k)
+        out.append(prev)
+    return out
+
+
+def main():
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 1_000_000
+    runs = int(sys.argv[2]) if len(sys.argv) > 2 else 5
+    columns = candles(n)
+    print(f"{n} свечей, {runs} повторов")
+
+    total = 0
+    for name in INDICATORS:
+        params = resolve_params(name, {})
+        total += measure(name, lambda: compute(name, columns, params), runs)
+    print(f"{'все':16} | {total:9.2f} ms")
+
+    closes = columns["c"].tolist()
+    measure("ema(26) numpy", lambda: ema(columns["c"], 26), runs)
+    measure("ema(26) цикл", lambda: ema_loop(closes, 26), max(1, runs // 2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,79 @@
+"""
+Лаг event loop под потоком тикеров: синхронный redis.Redis против асинхронного пула.
+
+    python3 -m bench.redis_lag [тикеров_в_кадре] [кадров]
+
+Имитирует !ticker@arr: каждый кадр — SET на каждый тикер. Параллельно крутится
+монитор, который спит 10 мс и меряет, насколько позже он проснулся.
+"""
+import asyncio
+import json
+import statistics
+import sys
+import time
+
+import redis
+
+from db import REDIS_URI, redis_client, redis_set_many
+
+TICK = 0.01
+
+
+async def lag_monitor(samples, stop):
+    while not stop.is_set():
+        started = time.perf_counter()
+        await asyncio.sleep(TICK)
+        samples.append((time.perf_counter() - started - TICK) * 1000)
+
+
+def make_frame(n, frame):
+    return {
+        f"bench:spot:SYM{i}USDT": json.dumps({"symbol": f"SYM{i}USDT", "price": frame + i / 1000})
+        for i in range(n)
+    }
+
+
+async def run_sync(n, frames):
+    client = redis.Redis.from_url(REDIS_URI, decode_responses=True)
+    for frame in range(frames):
+        for key, value in make_frame(n, frame).items():
+            client.set(key, value)
+        await asyncio.sleep(0)
+
+
+async def run_async(n, frames):
+    for frame in range(frames):
+        await redis_set_many(make_frame(n, frame))
+
+
+async def measure(name, scenario, n, frames):
+    samples, stop = [], asyncio.Event()
+    monitor = asyncio.create_task(lag_monitor(samples, stop))
+    started = time.perf_counter()
+    await scenario(n, frames)
+    elapsed = time.perf_counter() - started
+    stop.set()
+    await monitor
+
+    samples.sort()
+    p99 = samples[int(len(samples) * 0.99) - 1] if samples else 0
+    print(
+        f"{name:6} | {n * frames / elapsed:9.0f} SET/s | lag p50 {statistics.median(samples or [0]):7.2f} ms"
+        f" | p99 {p99:7.2f} ms | max {max(samples or [0]):7.2f} ms"
+    )
+
+
+async def _main():
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 600
+    frames = int(sys.argv[2]) if len(sys.argv) > 2 else 50
+
+    await measure("sync", run_sync, n, frames)
+    await measure("async", run_async, n, frames)
+
+    keys = [k async for k in redis_client.scan_iter("bench:*")]
+    if keys:
+        await redis_client.delete(*keys)
+
+
+if __name__ == "__main__":
+    asyncio.run(_main())
@@ -0,0 +1,112 @@
+"""
+Запросов в секунду на странице тикера /{exchange}/{market_type}/{symbol}.
+
+    python3 -m bench.ticker_page [тикеров] [секунд] [параллельно]
+
+Тикеры пишутся в отдельную базу tradium_bench. Старая страница — find_one
+в Mongo и рендер шаблона на каждый просмотр; новая — роут из router.py
+(снимок тикеров в памяти + кэш HTML). Запросы идут в приложение напрямую
+через ASGI, без сети; 20% запросов — на несуществующие символы (404).
+"""
+import asyncio
+import random
+import sys
+import time
+
+import httpx
+from fastapi import FastAPI, HTTPException, Request
+from fastapi.responses import HTMLResponse
+from fastapi.staticfiles import StaticFiles
+
+from db import client
+import router as app_router
+from tickers import ticker_snapshot
+
+MISSING_SHARE = 0.2
+
+
+async def seed(coll, total):
+    await coll.drop()
+    tickers = [{
+        "_id": f"binance:spot:T{i}USDT", "symbol": f"T{i}USDT", "exchange": "binance", "market_type": "spot",
+        "price": 1.0 + i, "price_change": 0.5, "volume_24h": 1e6, "market_vol": 1e3, "market_cap": 1e9
+    } for i in range(total)]
+    await coll.insert_many(tickers)
+    return tickers
+
+
+def base_app() -> FastAPI:
+    # шаблоны строят ссылки через url_for('static', ...)
+    app = FastAPI()
+    app.mount("/static", StaticFiles(directory="static"), name="static")
+    return app
+
+
+def old_app(coll) -> FastAPI:
+    app = base_app()
+
+    @app.get("/{exchange}/{market_type}/{symbol}", response_class=HTMLResponse)
+    async def get_ticker_page(request: Request, exchange: str, market_type: str, symbol: str):
+        ticker_info = await coll.find_one({"_id": f"{exchange}:{market_type}:{symbol}"})
+        if not ticker_info:
+            raise HTTPException(status_code=404, detail="Ticker not found")
+        return HTMLResponse(app_router.templates.get_template("ticker.html").render({
+            "request": request, "exchange": exchange, "market_type": market_type,
+            "symbol": symbol, "ticker_info": ticker_info
+        }))
+
+    return app
+
+
+def new_app() -> FastAPI:
+    app = base_app()
+    app.include_router(app_router.router)
+    return app
+
+
+async def measure(name, app, total, seconds, concurrency):
+    transport = httpx.ASGITransport(app=app)
+    done = statuses = 0
+    deadline = time.perf_counter() + seconds
+
+    async def worker():
+        nonlocal done, statuses
+        rnd = random.Random()
+        async with httpx.AsyncClient(transport=transport, base_url="http://bench") as http:
+            while time.perf_counter() < deadline:
+                if rnd.random() < MISSING_SHARE:
+                    symbol = f"NOPE{rnd.randrange(10**6)}USDT"
+                else:
+                    symbol = f"T{rnd.randrange(total)}USDT"
+                response = await http.get(f"/binance/spot/{symbol}")
+                statuses += response.status_code == 200
+                done += 1
+
+    started = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    elapsed = time.perf_counter() - started
+    print(f"{name:6} | {done / elapsed:9.0f} req/s | {done} запросов, 200: {statuses}")
+    return done / elapsed
+
+
+async def main():
+    total = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    seconds = float(sys.argv[2]) if len(sys.argv) > 2 else 10
+    concurrency = int(sys.argv[3]) if len(sys.argv) > 3 else 16
+
+    coll = client["tradium_bench"]["tickers"]
+    tickers = await seed(coll, total)
+    # новый роут читает снимок; наполняем его теми же тикерами вместо рабочей базы
+    ticker_snapshot.items = {t["_id"]: t for t in tickers}
+    ticker_snapshot.loaded = True
+
+    print(f"{total} тикеров, {seconds:g}s, {concurrency} параллельно")
+    old = await measure("old", old_app(coll), total, seconds, concurrency)
+    new = await measure("new", new_app(), total, seconds, concurrency)
+    print(f"ускорение: x{new / old:.1f}")
+    print(app_router.ticker_pages.stats())
+    await coll.drop()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,336 @@
+"""
+Шина между процессом загрузки (ingest) и веб-воркерами через Redis pub/sub.
+
+INGEST_MODE=embedded (по умолчанию) — всё в одном процессе, как раньше:
+шина просто передаёт кадры в ws_manager.
+
+INGEST_MODE=external — веб-воркеры (uvicorn --workers N) только читают:
+    python3 -m ingest                    # один процесс: Binance, coinpaprika, heatmap, запись в Mongo
+    uvicorn index:app --workers 4        # сколько угодно воркеров
+
+    {prefix}:room:{room}      кадры комнаты /ws/kline (уже сериализованные, как в ws_manager.broadcast)
+    {prefix}:demand           какие комнаты (и потоковые индикаторы) нужны воркеру: изменения
+                              и полный список раз в DEMAND_HEARTBEAT секунд; молчащий воркер
+                              через три интервала считается ушедшим
+    {prefix}:snapshot:{name}  снимки (heatmap): последний ещё и лежит ключом для новых воркеров
+    {prefix}:feed:{name}      потоки изменений (tickers): только PUBLISH, начальное состояние
+                              воркер берёт сам
+"""
+import asyncio
+import json
+import os
+import time
+import uuid
+
+from db import redis_client
+from config import INGEST_MODE, BUS_PREFIX, DEMAND_HEARTBEAT
+from ws.manager import ws_manager
+from candles import live_bars, candle_cache
+from indicators import live_indicators, indicator_key
+
+DEMAND_CHANNEL = f"{BUS_PREFIX}:demand"
+ROOM_CHANNEL = f"{BUS_PREFIX}:room:"
+SNAPSHOT_CHANNEL = f"{BUS_PREFIX}:snapshot:"
+FEED_CHANNEL = f"{BUS_PREFIX}:feed:"
+STATS_KEY = f"{BUS_PREFIX}:stats:ingest"
+
+
+def candle_kind(candle: dict) -> str:
+    """Вид кадра свечи для conflate: у каждой свечи свой — закрытая не вытесняется следующей."""
+    return f"candle:{candle['timestamp']}"
+
+
+class MarketBus:
+    def __init__(self, role: str = "embedded" if INGEST_MODE == "embedded" else "web"):
+        self.role = role
+        self.worker = f"{os.getpid()}-{uuid.uuid4().hex[:6]}"
+        self.room_listeners = []
+        self.snapshot_listeners = {}   # name -> [callback(data)]
+        self.feed_listeners = {}       # name -> [callback(data)]
+        self.stats_provider = None     # ingest: что отдавать воркерам в /api/stats
+        self.demand = {}               # ingest: room -> {worker: истекает}
+        self.local = {}                # web: room -> спецификации индикаторов
+        self.changes = asyncio.Queue() # web: изменения локальных комнат для ingest
+        self.published = 0
+        self.received = 0
+        self.errors = 0
+        ws_manager.on_room(self._local_room)
+
+    # ====== Подписки внутри процесса ======
+
+    def on_room(self, callback):
+        """callback(room, active) — комната стала нужна / больше не нужна хоть кому-то."""
+        self.room_listeners.append(callback)
+
+    def on_snapshot(self, name: str, callback):
+        self.snapshot_listeners.setdefault(name, []).append(callback)
+
+    def on_feed(self, name: str, callback):
+        self.feed_listeners.setdefault(name, []).append(callback)
+
+    def _notify(self, room: str, active: bool):
+        for callback in self.room_listeners:
+            try:
+                callback(room, active)
+            except Exception as e:
+                print(f"[bus] Room listener error {room}: {e}")
+
+    def _local_room(self, room: str, active: bool):
+        if self.role == "embedded":
+            self._notify(room, active)
+        elif self.role == "web":
+            if active:
+                self.local.setdefault(room, [])
+            else:
+                self.local.pop(room, None)
+                # зеркала живых свечей без подписки устаревают
+                live_bars.forget(room)
+                candle_cache.release(room)
+            self.changes.put_nowait(room)
+
+    # ====== Сторона ingest ======
+
+    def has_subscribers(self, room: str) -> bool:
+        if self.role == "ingest":
+            return room in self.demand
+        return ws_manager.has_subscribers(room)
+
+    async def publish(self, room: str, message, kind: str = None):
+        if self.role != "ingest":
+            await ws_manager.broadcast(room, message, kind)
+            return
+        try:
+            await redis_client.publish(ROOM_CHANNEL + room, json.dumps(message))
+            self.published += 1
+        except Exception as e:
+            self.errors += 1
+            print(f"[bus] Publish error {room}: {e}")
+
+    async def publish_snapshot(self, name: str, data):
+        if self.role != "ingest":
+            for callback in self.snapshot_listeners.get(name, ()):
+                callback(data)
+            return
+        text = json.dumps(data)
+        try:
+            await redis_client.set(SNAPSHOT_CHANNEL + name, text)
+            await redis_client.publish(SNAPSHOT_CHANNEL + name, text)
+            self.published += 1
+        except Exception as e:
+            self.errors += 1
+            print(f"[bus] Snapshot error {name}: {e}")
+
+    async def publish_feed(self, name: str, data):
+        # ingest тоже держит своё состояние фида (тикеры — для проверки kline-комнат)
+        for callback in self.feed_listeners.get(name, ()):
+            callback(data)
+        if self.role != "ingest":
+            return
+        try:
+            await redis_client.publish(FEED_CHANNEL + name, json.dumps(data, default=str))
+            self.published += 1
+        except Exception as e:
+            self.errors += 1
+            print(f"[bus] Feed error {name}: {e}")
+
+    def _leave(self, room: str, worker: str):
+        workers = self.demand.get(room)
+        if workers is None or workers.pop(worker, None) is None:
+            return
+        if not workers:
+            del self.demand[room]
+            self._notify(room, False)
+
+    def _on_demand(self, msg: dict):
+        worker = msg["worker"]
+        expires = time.time() + 3 * DEMAND_HEARTBEAT
+        if "room" in msg:
+            if not msg["active"]:
+                self._leave(msg["room"], worker)
+                return
+            rooms, full = {msg["room"]: msg.get("indicators") or []}, False
+        else:
+            rooms, full = msg.get("rooms") or {}, True
+        if full:
+            for room in [room for room, workers in self.demand.items() if worker in workers and room not in rooms]:
+                self._leave(room, worker)
+        for room, specs in rooms.items():
+            workers = self.demand.setdefault(room, {})
+            first = not workers
+            workers[worker] = expires
+            if first:
+                self._notify(room, True)
+            if specs:
+                live_indicators.attach(room, specs)
+
+    async def _expire(self):
+        while True:
+            await asyncio.sleep(1)
+            now = time.time()
+            for room, workers in list(self.demand.items()):
+                for worker, expires in list(workers.items()):
+                    if expires < now:
+                        self._leave(room, worker)
+
+    async def _export_stats(self, interval=10):
+        while True:
+            await asyncio.sleep(interval)
+            if self.stats_provider is None:
+                continue
+            try:
+                await redis_client.set(STATS_KEY, json.dumps(self.stats_provider(), default=str))
+            except Exception as e:
+                print(f"[bus] Stats export error: {e}")
+
+    async def _run_ingest(self):
+        asyncio.create_task(self._expire())
+        asyncio.create_task(self._export_stats())
+        while True:
+            pubsub = redis_client.pubsub()
+            try:
+                await pubsub.subscribe(DEMAND_CHANNEL)
+                while True:
+                    msg = await pubsub.get_message(ignore_subscribe_messages=True, timeout=1.0)
+                    if msg is None:
+                        continue
+                    self.received += 1
+                    try:
+                        self._on_demand(json.loads(msg["data"]))
+                    except (ValueError, KeyError, TypeError) as e:
+                        print(f"[bus] Bad demand message: {e}")
+            except Exception as e:
+                self.errors += 1
+                print(f"[bus] Demand listener error: {e}")
+                await asyncio.sleep(1)
+            finally:
+                await pubsub.aclose()
+
+    # ====== Сторона веб-воркера ======
+
+    def attach_indicators(self, room: str, specs) -> tuple:
+        """Потоковые индикаторы комнаты: считаются там же, где идут свечи."""
+        if self.role != "web":
+            return live_indicators.attach(room, specs)
+        keys, errors, accepted = live_indicators.parse(specs)
+        local = self.local.setdefault(room, [])
+        known = {indicator_key(spec["name"], spec["params"]) for spec in local}
+        added = [spec for spec in accepted if indicator_key(spec["name"], spec["params"]) not in known]
+        if added:
+            local.extend(added)
+            self.changes.put_nowait(room)
+        return keys, errors
+
+    async def _send_demand(self, msg: dict):
+        await redis_client.publish(DEMAND_CHANNEL, json.dumps({"worker": self.worker, **msg}))
+
+    async def _heartbeat(self):
+        while True:
+            try:
+                await self._send_demand({"rooms": self.local})
+            except Exception as e:
+                print(f"[bus] Heartbeat error: {e}")
+            await asyncio.sleep(DEMAND_HEARTBEAT)
+
+    async def _apply_changes(self, pubsub):
+        while True:
+            room = await self.changes.get()
+            active = room in self.local
+            if active:
+                await pubsub.subscribe(ROOM_CHANNEL + room)
+            else:
+                await pubsub.unsubscribe(ROOM_CHANNEL + room)
+            await self._send_demand({"room": room, "active": active, "indicators": self.local.get(room)})
+
+    async def _on_message(self, channel: str, data: str):
+        self.received += 1
+        if channel.startswith(ROOM_CHANNEL):
+            room = channel[len(ROOM_CHANNEL):]
+            if '"timestamp"' not in data:
+                await ws_manager.broadcast(room, data)
+            else:
+                candle = json.loads(data)
+                await ws_manager.broadcast(room, data, candle_kind(candle))
+                # зеркало формирующейся свечи для /history этого воркера
+                candle.pop("indicators", None)
+                live_bars.update(room, candle)
+                if candle.get("complete", True):
+                    candle_cache.push(room, candle)
+        elif channel.startswith(SNAPSHOT_CHANNEL):
+            name = channel[len(SNAPSHOT_CHANNEL):]
+            snapshot = json.loads(data)
+            for callback in self.snapshot_listeners.get(name, ()):
+                callback(snapshot)
+        elif channel.startswith(FEED_CHANNEL):
+            name = channel[len(FEED_CHANNEL):]
+            update = json.loads(data)
+            for callback in self.feed_listeners.get(name, ()):
+                callback(update)
+
+    async def _run_web(self):
+        asyncio.create_task(self._heartbeat())
+        while True:
+            pubsub = redis_client.pubsub()
+            applier = None
+            try:
+                channels = [SNAPSHOT_CHANNEL + name for name in self.snapshot_listeners]
+                channels += [FEED_CHANNEL + name for name in self.feed_listeners]
+                channels += [ROOM_CHANNEL + room for room in self.local]
+                # свой канал воркера — заглушка, в него никто не публикует: SUBSCRIBE без
+                # каналов невозможен, а get_message без единой подписки падает с RuntimeError
+                # (нет соединения) — так pubsub живёт и до первой комнаты, и после последней
+                await pubsub.subscribe(f"{BUS_PREFIX}:worker:{self.worker}", *channels)
+                # последние снимки — чтобы не ждать следующей публикации
+                for name in self.snapshot_listeners:
+                    text = await redis_client.get(SNAPSHOT_CHANNEL + name)
+                    if text:
+                        await self._on_message(SNAPSHOT_CHANNEL + name, text)
+                applier = asyncio.create_task(self._apply_changes(pubsub))
+                while True:
+                    msg = await pubsub.get_message(ignore_subscribe_messages=True, timeout=1.0)
+                    if msg is not None:
+                        await self._on_message(msg["channel"], msg["data"])
+            except Exception as e:
+                self.errors += 1
+                print(f"[bus] Listener error: {e}")
+                await asyncio.sleep(1)
+            finally:
+                if applier:
+                    applier.cancel()
+                await pubsub.aclose()
+
+    # ====== Общее ======
+
+    async def run(self):
+        if self.role == "ingest":
+            await self._run_ingest()
+        elif self.role == "web":
+            await self._run_web()
+
+    async def stop(self):
+        if self.role == "web":
+            try:
+                await self._send_demand({"rooms": {}})
+            except Exception:
+                pass
+
+    async def ingest_stats(self):
+        if self.role != "web":
+            return None
+        try:
+            text = await redis_client.get(STATS_KEY)
+        except Exception:
+            return None
+        return json.loads(text) if text else None
+
+    def stats(self):
+        return {
+            "role": self.role,
+            "worker": self.worker,
+            "rooms": len(self.demand) if self.role == "ingest" else len(self.local),
+            "published": self.published,
+            "received": self.received,
+            "errors": self.errors,
+        }
+
+
+bus = MarketBus()
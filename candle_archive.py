@@ -0,0 +1,290 @@
+"""
+Холодный архив свечей. Закрытые свечи старше CANDLE_ARCHIVE_AGE_DAYS
+переезжают из Mongo в колоночные файлы, по каталогу на symbol/tf:
+
+    {CANDLE_ARCHIVE_DIR}/{exchange}/{market}/{tf}/{SYMBOL}/t.i64, o.f64, ... v.f64
+
+Файлы читаются через mmap: срез по времени — бинарный поиск по t и срез
+memoryview без копирования. Порядок байт — родной, как в pack_columns
+(little-endian). Новое дописывается в хвост, но только до чекпоинта докачки
+(binance_history_progress.verified_until): дыры в архиве иначе уже не
+заполнить. Свечи старше конца серии (докачанные дыры, история раньше
+архива) вливаются переписыванием серии целиком в соседний каталог.
+
+Компакция:
+    python3 -m candle_archive compact [spot|futures|all] [tf]
+"""
+import asyncio
+import mmap
+import os
+import shutil
+import time
+from array import array
+from bisect import bisect_left
+from collections import OrderedDict
+
+from candle_store import candle_store, MARKETS, HISTORY_FIELDS, COLUMNS
+from config import (
+    CANDLE_ARCHIVE_DIR, CANDLE_ARCHIVE_AGE_DAYS, CANDLE_ARCHIVE_TIMEFRAMES, CANDLE_ARCHIVE_INTERVAL
+)
+
+TYPECODES = ("q",) + ("d",) * (len(COLUMNS) - 1)
+FILES = tuple(f"{name}.{'i64' if code == 'q' else 'f64'}" for name, code in zip(COLUMNS, TYPECODES))
+COMPACT_CHUNK = 50_000
+# на каждую серию mmap держит по дескриптору на колонку
+MAX_OPEN_SERIES = 256
+
+
+class ArchiveSeries:
+    """Колонки одного symbol/tf. Число свечей — по размеру t-файла: t пишется последним."""
+
+    def __init__(self, path: str):
+        self.path = path
+        self.size = None    # (st_ino, st_size) t-файла
+        self.n = 0
+        self.maps = []
+        self.views = []
+
+    def _file(self, i: int, path: str = None) -> str:
+        return os.path.join(path or self.path, FILES[i])
+
+    def _stat(self):
+        try:
+            st = os.stat(self._file(0))
+        except FileNotFoundError:
+            # обрыв посреди подмены каталога в merge: старая копия ещё цела
+            if not os.path.exists(self.path + ".old"):
+                return 0, 0
+            os.rename(self.path + ".old", self.path)
+            st = os.stat(self._file(0))
+        return st.st_ino, st.st_size
+
+    def refresh(self):
+        # файлы может дописать или подменить компакция из другого процесса
+        ino, size = self._stat()
+        if (ino, size) == self.size:
+            return
+        self.close()
+        self.size = (ino, size)
+        self.n = size // 8
+        if not self.n:
+            return
+        for i, code in enumerate(TYPECODES):
+            with open(self._file(i), "rb") as f:
+                m = mmap.mmap(f.fileno(), self.n * 8, access=mmap.ACCESS_READ)
+            self.maps.append(m)
+            self.views.append(memoryview(m).cast(code))
+
+    def close(self):
+        for view in self.views:
+            view.release()
+        for m in self.maps:
+            m.close()
+        self.maps, self.views, self.n = [], [], 0
+
+    @property
+    def start(self) -> int:
+        return self.views[0][0] if self.n else 0
+
+    @property
+    def end(self) -> int:
+        """Всё, что раньше end, лежит в архиве."""
+        return self.views[0][self.n - 1] + 1 if self.n else 0
+
+    def read(self, before=None, limit=None) -> dict:
+        """Колонки по возрастанию timestamp: последние limit свечей до before."""
+        self.refresh()
+        if not self.n:
+            return {name: [] for name in COLUMNS}
+        end = bisect_left(self.views[0], before) if before else self.n
+        start = max(0, end - limit) if limit else 0
+        return {name: view[start:end].tolist() for name, view in zip(COLUMNS, self.views)}
+
+    def times(self, since=0) -> list:
+        """timestamp архива начиная с since — для поиска дыр при докачке."""
+        self.refresh()
+        if not self.n:
+            return []
+        return self.views[0][bisect_left(self.views[0], since):].tolist()
+
+    def append(self, columns: dict):
+        """Дописывает свечи новее end. Пишет синхронно с fsync — звать через asyncio.to_thread."""
+        os.makedirs(self.path, exist_ok=True)
+        self.refresh()
+        rows = self.n
+        # сначала значения, t — последним: оборванная запись не видна читателям
+        for i in reversed(range(len(COLUMNS))):
+            with open(self._file(i), "ab") as f:
+                f.truncate(rows * 8)  # хвост от прерванной компакции
+                array(TYPECODES[i], columns[COLUMNS[i]]).tofile(f)
+                f.flush()
+                os.fsync(f.fileno())
+        self.refresh()
+
+    def merge(self, columns: dict):
+        """
+        Вливает свечи в любое место серии (при совпадении t побеждают новые).
+        Серия пишется целиком в {path}.new и подменяет старую переименованием:
+        читатели на старых mmap дочитывают удалённые файлы. Синхронно — через to_thread.
+        """
+        self.refresh()
+        rows = {row[0]: row for row in zip(*self.read().values())}
+        rows.update((row[0], row) for row in zip(*(columns[name] for name in COLUMNS)))
+        merged = [rows[t] for t in sorted(rows)]
+
+        fresh, backup = self.path + ".new", self.path + ".old"
+        shutil.rmtree(fresh, ignore_errors=True)
+        os.makedirs(fresh)
+        for i, code in enumerate(TYPECODES):
+            with open(self._file(i, fresh), "wb") as f:
+                array(code, (row[i] for row in merged)).tofile(f)
+                f.flush()
+                os.fsync(f.fileno())
+        if os.path.exists(self.path):
+            os.rename(self.path, backup)
+        os.rename(fresh, self.path)
+        shutil.rmtree(backup, ignore_errors=True)
+        self.refresh()
+
+
+def _columns(rows: list) -> dict:
+    columns = {name: [row[field] for row in rows] for name, field in zip(COLUMNS, HISTORY_FIELDS)}
+    # живой путь раньше писал timestamp float'ом — array('q') его не примет
+    columns["t"] = [int(t) for t in columns["t"]]
+    return columns
+
+
+class CandleArchive:
+    def __init__(self, root: str = CANDLE_ARCHIVE_DIR, store=candle_store, max_open: int = MAX_OPEN_SERIES):
+        self.root = root
+        self.store = store
+        self.max_open = max_open
+        self.open = OrderedDict()   # (exchange, market, symbol, tf) -> ArchiveSeries, LRU
+        self.reads = 0
+        self.compacted = 0
+
+    def _series(self, exchange, market_type, symbol, tf) -> ArchiveSeries:
+        key = (exchange, market_type, symbol, tf)
+        series = self.open.get(key)
+        if series is None:
+            series = ArchiveSeries(os.path.join(self.root, exchange, market_type, tf, symbol))
+            self.open[key] = series
+            while len(self.open) > self.max_open:
+                self.open.popitem(last=False)[1].close()
+        self.open.move_to_end(key)
+        series.refresh()
+        return series
+
+    def series(self, exchange, market_type, symbol, tf):
+        """Непустая серия или None — большинство символов в архиве не лежит."""
+        path = os.path.join(self.root, exchange, market_type, tf, symbol)
+        if not os.path.exists(path) and not os.path.exists(path + ".old"):
+            return None
+        series = self._series(exchange, market_type, symbol, tf)
+        if series.n:
+            self.reads += 1
+            return series
+        return None
+
+    def end(self, exchange, market_type, symbol, tf) -> int:
+        series = self.series(exchange, market_type, symbol, tf)
+        return series.end if series else 0
+
+    async def verified_until(self, exchange, market_type, symbol, tf) -> int:
+        """Чекпоинт докачки в секундах: до него в Mongo нет дыр. 0 — не проверялось."""
+        # binance_history сам импортирует архив — отсюда только лениво
+        from cex.binance_history import PROGRESS_COLLECTION
+        if exchange != "binance":
+            return 0
+        progress = await self.store.db[PROGRESS_COLLECTION].find_one({"_id": f"{market_type}:{symbol}:{tf}"})
+        return progress["verified_until"] // 1000 if progress else 0
+
+    async def merge_older(self, exchange, market_type, symbol, tf, chunk=COMPACT_CHUNK) -> int:
+        """Свечи из Mongo старше конца серии (докачанные дыры, история раньше архива) — в архив."""
+        series = self.series(exchange, market_type, symbol, tf)
+        if series is None:
+            return 0
+        start, moved = 0, 0
+        while True:
+            rows = await self.store.find_range(exchange, market_type, symbol, tf, start, series.end, chunk)
+            if not rows:
+                break
+            await asyncio.to_thread(series.merge, _columns(rows))
+            start = int(rows[-1]["timestamp"]) + 1
+            # удаляем ровно то, что влили
+            await self.store.delete_range(exchange, market_type, symbol, tf, int(rows[0]["timestamp"]), start)
+            moved += len(rows)
+        self.compacted += moved
+        return moved
+
+    async def compact_series(self, exchange, market_type, symbol, tf, cutoff, chunk=COMPACT_CHUNK,
+                             verified=None) -> int:
+        """verified — граница без дыр (с); по умолчанию чекпоинт докачки."""
+        merged = await self.merge_older(exchange, market_type, symbol, tf, chunk)
+        moved = 0
+        # дальше хвост — только проверенный докачкой: за end дыру уже не заполнить
+        if verified is None:
+            verified = await self.verified_until(exchange, market_type, symbol, tf)
+        until = min(cutoff, verified)
+        series = self._series(exchange, market_type, symbol, tf)
+        start = series.end
+        while start < until:
+            rows = await self.store.find_range(exchange, market_type, symbol, tf, start, until, chunk)
+            if not rows:
+                break
+            await asyncio.to_thread(series.append, _columns(rows))
+            start = int(rows[-1]["timestamp"]) + 1
+            await self.store.delete_range(exchange, market_type, symbol, tf, int(rows[0]["timestamp"]), start)
+            moved += len(rows)
+        self.compacted += moved
+        return merged + moved
+
+    async def compact(self, exchange="binance", markets=MARKETS, timeframes=CANDLE_ARCHIVE_TIMEFRAMES,
+                      age_days=CANDLE_ARCHIVE_AGE_DAYS):
+        cutoff = int(time.time() - age_days * 86_400)
+        for market_type in markets:
+            for tf in timeframes:
+                started, moved = time.perf_counter(), 0
+                for symbol in await self.store.symbols(exchange, market_type, tf):
+                    moved += await self.compact_series(exchange, market_type, symbol, tf, cutoff)
+                print(f"[archive] {exchange} {market_type} {tf}: {moved} свечей в архив "
+                      f"за {time.perf_counter() - started:.1f}s")
+
+    def disk_size(self) -> int:
+        total = 0
+        for path, _, files in os.walk(self.root):
+            total += sum(os.stat(os.path.join(path, name)).st_size for name in files)
+        return total
+
+    def stats(self):
+        return {"open_series": len(self.open), "reads": self.reads, "compacted": self.compacted}
+
+    async def run(self, interval: float = CANDLE_ARCHIVE_INTERVAL):
+        if interval <= 0:
+            return
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                await self.compact()
+            except Exception as e:
+                print("[archive] Compaction error:", e)
+
+
+candle_archive = CandleArchive()
+
+
+async def _main():
+    import sys
+    if len(sys.argv) < 2 or sys.argv[1] != "compact":
+        print("python3 -m candle_archive compact [spot|futures|all] [tf]")
+        return
+    market = sys.argv[2] if len(sys.argv) > 2 else "all"
+    tf = sys.argv[3] if len(sys.argv) > 3 else None
+    await candle_archive.compact(
+        markets=MARKETS if market == "all" else (market,),
+        timeframes=[tf] if tf else CANDLE_ARCHIVE_TIMEFRAMES
+    )
+
+
+if __name__ == "__main__":
+    asyncio.run(_main())
@@ -0,0 +1,380 @@
+"""
+Хранилище свечей. Весь код, который читает или пишет свечи (kline-обработчик,
+/history, cex.binance_history, cex.binance_candles), ходит через candle_store,
+поэтому backend переключается одной настройкой CANDLE_STORAGE:
+
+documents  — обычные коллекции {exchange}_{market}_candles_{tf}, по документу на свечу
+timeseries — time-series коллекции {exchange}_{market}_ts_candles_{tf}
+             (timeField timestamp, metaField meta = {symbol, exchange}); нужен MongoDB 7.0+
+
+Миграция документов в time-series:
+    python3 -m candle_store migrate [spot|futures|all] [tf]
+"""
+import asyncio
+from datetime import datetime, timezone
+from pymongo import UpdateOne, DeleteMany
+from pymongo.errors import BulkWriteError
+from db import db
+from config import CANDLE_STORAGE
+
+TIMEFRAMES = [
+    "1m", "5m", "15m", "30m", "1h", "2h", "4h", "6h", "12h", "1d", "3d", "1w", "1M"
+]
+MARKETS = ("spot", "futures")
+
+# Что отдаёт /history: без _id и служебных полей живой свечи
+HISTORY_FIELDS = ("timestamp", "open", "high", "low", "close", "volume")
+HISTORY_PROJECTION = {"_id": 0, **{field: 1 for field in HISTORY_FIELDS}}
+VALUE_FIELDS = HISTORY_FIELDS[1:]
+COLUMNS = ("t", "o", "h", "l", "c", "v")
+
+
+def collection_name(exchange: str, market_type: str, tf: str) -> str:
+    return f"{exchange}_{market_type}_candles_{tf}"
+
+
+def _empty_columns():
+    return {name: [] for name in COLUMNS}
+
+
+def _ignore_duplicates(e: BulkWriteError):
+    # дубли на границах диапазонов — не ошибка
+    if any(err["code"] != 11000 for err in e.details.get("writeErrors", [])):
+        raise e
+
+
+class DocumentCandleStore:
+    """Свеча — обычный документ, уникальный индекс {symbol, timestamp}."""
+
+    name = "documents"
+
+    def __init__(self, database=db):
+        self.db = database
+
+    def collection(self, exchange, market_type, tf):
+        return self.db[collection_name(exchange, market_type, tf)]
+
+    async def ensure_indexes(self, exchange, market_type, tf):
+        await self.collection(exchange, market_type, tf).create_index(
+            [("symbol", 1), ("timestamp", 1)],
+            unique=True,
+            name="symbol_timestamp"
+        )
+
+    async def upsert(self, exchange, market_type, tf, candles):
+        if not candles:
+            return
+        await self.collection(exchange, market_type, tf).bulk_write([
+            UpdateOne({"symbol": c["symbol"], "timestamp": c["timestamp"]}, {"$set": c}, upsert=True)
+            for c in candles
+        ], ordered=False)
+
+    async def insert(self, exchange, market_type, tf, candles, ordered=False):
+        """Вставка в заведомо пустой диапазон — дешевле upsert'ов."""
+        if not candles:
+            return
+        try:
+            await self.collection(exchange, market_type, tf).insert_many(candles, ordered=ordered)
+        except BulkWriteError as e:
+            _ignore_duplicates(e)
+
+    async def find(self, exchange, market_type, symbol, tf, before=None, limit=None):
+        """Свечи по убыванию timestamp, только HISTORY_FIELDS."""
+        query = {"symbol": symbol}
+        if before:
+            query["timestamp"] = {"$lt": before}
+
+        cursor = self.collection(exchange, market_type, tf).find(query, HISTORY_PROJECTION).sort("timestamp", -1)
+        if limit:
+            cursor = cursor.limit(limit)
+        return await cursor.to_list(None)
+
+    def _column_pipeline(self, match, limit, time_expr):
+        pipeline = [{"$match": match}, {"$sort": {"timestamp": -1}}]
+        if limit:
+            pipeline.append({"$limit": limit})
+        pipeline += [
+            {"$sort": {"timestamp": 1}},
+            {"$group": {
+                "_id": None,
+                "t": {"$push": time_expr},
+                **{col: {"$push": f"${field}"} for col, field in zip(COLUMNS[1:], VALUE_FIELDS)},
+            }},
+            {"$project": {"_id": 0}}
+        ]
+        return pipeline
+
+    async def find_columns(self, exchange, market_type, symbol, tf, before=None, limit=None):
+        """
+        То же, что find, но Mongo сама собирает параллельные массивы
+        t/o/h/l/c/v по возрастанию времени — без словаря на каждую свечу.
+        """
+        match = {"symbol": symbol}
+        if before:
+            match["timestamp"] = {"$lt": before}
+        rows = await self.collection(exchange, market_type, tf).aggregate(
+            self._column_pipeline(match, limit, "$timestamp")
+        ).to_list(1)
+        columns = rows[0] if rows else _empty_columns()
+        columns["t"] = [int(t) for t in columns["t"]]
+        return columns
+
+    async def find_range(self, exchange, market_type, symbol, tf, start, until, limit=None):
+        """Свечи [start, until) по возрастанию timestamp — для выгрузки в архив."""
+        cursor = self.collection(exchange, market_type, tf).find(
+            {"symbol": symbol, "timestamp": {"$gte": start, "$lt": until}}, HISTORY_PROJECTION
+        ).sort("timestamp", 1)
+        if limit:
+            cursor = cursor.limit(limit)
+        return await cursor.to_list(None)
+
+    async def delete_range(self, exchange, market_type, symbol, tf, start, until):
+        await self.collection(exchange, market_type, tf).delete_many(
+            {"symbol": symbol, "timestamp": {"$gte": start, "$lt": until}}
+        )
+
+    async def symbols(self, exchange, market_type, tf):
+        return await self.collection(exchange, market_type, tf).distinct("symbol")
+
+    async def timestamps(self, exchange, market_type, symbol, tf, since=0):
+        """Сохранённые timestamp (секунды) по возрастанию — только по индексу."""
+        cursor = self.collection(exchange, market_type, tf).find(
+            {"symbol": symbol, "timestamp": {"$gte": since}},
+            {"_id": 0, "timestamp": 1}
+        ).sort("timestamp", 1)
+        async for doc in cursor:
+            yield int(doc["timestamp"])
+
+    async def summarize(self, exchange, market_type, symbol, tf, start, until):
+        """OHLCV свечей [start, until) одной строкой или None."""
+        rows = await self.collection(exchange, market_type, tf).aggregate([
+            {"$match": {"symbol": symbol, "timestamp": {"$gte": start, "$lt": until}}},
+            {"$sort": {"timestamp": 1}},
+            {"$group": {
+                "_id": None,
+                "open": {"$first": "$open"},
+                "high": {"$max": "$high"},
+                "low": {"$min": "$low"},
+                "volume": {"$sum": "$volume"},
+            }}
+        ]).to_list(1)
+        return rows[0] if rows else None
+
+    async def storage_stats(self, exchange, market_type, tf):
+        name = self.collection(exchange, market_type, tf).name
+        try:
+            stats = await self.db.command("collStats", name)
+        except Exception:
+            return {"collection": name, "count": 0, "storage": 0, "indexes": 0}
+        return {
+            "collection": name,
+            "count": stats.get("count", 0),
+            "storage": stats.get("storageSize", 0),
+            "indexes": stats.get("totalIndexSize", 0),
+        }
+
+
+class TimeSeriesCandleStore(DocumentCandleStore):
+    """
+    Time-series коллекции: Mongo сама раскладывает свечи по бакетам
+    и сжимает колонки. timestamp хранится как BSON date, наружу отдаётся
+    в секундах, как у документного backend.
+    """
+
+    name = "timeseries"
+
+    def collection(self, exchange, market_type, tf):
+        return self.db[f"{exchange}_{market_type}_ts_candles_{tf}"]
+
+    @staticmethod
+    def granularity(tf):
+        return "minutes" if tf in ("1m", "5m", "15m", "30m") else "hours"
+
+    @staticmethod
+    def _to_date(ts):
+        return datetime.fromtimestamp(ts, tz=timezone.utc)
+
+    @staticmethod
+    def _to_ts(value):
+        return int(value.replace(tzinfo=timezone.utc).timestamp())
+
+    def _doc(self, exchange, candle):
+        return {
+            "timestamp": self._to_date(candle["timestamp"]),
+            "meta": {"symbol": candle["symbol"], "exchange": exchange},
+            **{field: candle[field] for field in VALUE_FIELDS},
+        }
+
+    async def ensure_indexes(self, exchange, market_type, tf):
+        coll = self.collection(exchange, market_type, tf)
+        if coll.name not in await self.db.list_collection_names(filter={"name": coll.name}):
+            await self.db.create_collection(coll.name, timeseries={
+                "timeField": "timestamp",
+                "metaField": "meta",
+                "granularity": self.granularity(tf),
+            })
+        # уникальных индексов у time-series нет — только для поиска
+        await coll.create_index([("meta.symbol", 1), ("timestamp", 1)], name="symbol_timestamp")
+
+    async def upsert(self, exchange, market_type, tf, candles):
+        # upsert'а по произвольному полю у time-series нет: удаляем и вставляем заново
+        if not candles:
+            return
+        coll = self.collection(exchange, market_type, tf)
+        by_symbol = {}
+        for c in candles:
+            by_symbol.setdefault(c["symbol"], []).append(self._to_date(c["timestamp"]))
+        await coll.bulk_write([
+            DeleteMany({"meta.symbol": symbol, "timestamp": {"$in": dates}})
+            for symbol, dates in by_symbol.items()
+        ], ordered=False)
+        await coll.insert_many([self._doc(exchange, c) for c in candles], ordered=False)
+
+    async def insert(self, exchange, market_type, tf, candles, ordered=False):
+        # уникального индекса нет: insert зовут только для диапазонов, которых нет в хранилище
+        if candles:
+            await self.collection(exchange, market_type, tf).insert_many(
+                [self._doc(exchange, c) for c in candles], ordered=ordered
+            )
+
+    async def find(self, exchange, market_type, symbol, tf, before=None, limit=None):
+        query = {"meta.symbol": symbol}
+        if before:
+            query["timestamp"] = {"$lt": self._to_date(before)}
+
+        cursor = self.collection(exchange, market_type, tf).find(query, HISTORY_PROJECTION).sort("timestamp", -1)
+        if limit:
+            cursor = cursor.limit(limit)
+        rows = await cursor.to_list(None)
+        for row in rows:
+            row["timestamp"] = self._to_ts(row["timestamp"])
+        return rows
+
+    async def find_columns(self, exchange, market_type, symbol, tf, before=None, limit=None):
+        match = {"meta.symbol": symbol}
+        if before:
+            match["timestamp"] = {"$lt": self._to_date(before)}
+        rows = await self.collection(exchange, market_type, tf).aggregate(
+            self._column_pipeline(match, limit, {"$toLong": {"$divide": [{"$toLong": "$timestamp"}, 1000]}})
+        ).to_list(1)
+        return rows[0] if rows else _empty_columns()
+
+    async def find_range(self, exchange, market_type, symbol, tf, start, until, limit=None):
+        cursor = self.collection(exchange, market_type, tf).find(
+            {"meta.symbol": symbol, "timestamp": {"$gte": self._to_date(start), "$lt": self._to_date(until)}},
+            HISTORY_PROJECTION
+        ).sort("timestamp", 1)
+        if limit:
+            cursor = cursor.limit(limit)
+        rows = await cursor.to_list(None)
+        for row in rows:
+            row["timestamp"] = self._to_ts(row["timestamp"])
+        return rows
+
+    async def delete_range(self, exchange, market_type, symbol, tf, start, until):
+        await self.collection(exchange, market_type, tf).delete_many(
+            {"meta.symbol": symbol, "timestamp": {"$gte": self._to_date(start), "$lt": self._to_date(until)}}
+        )
+
+    async def symbols(self, exchange, market_type, tf):
+        return await self.collection(exchange, market_type, tf).distinct("meta.symbol")
+
+    async def timestamps(self, exchange, market_type, symbol, tf, since=0):
+        cursor = self.collection(exchange, market_type, tf).find(
+            {"meta.symbol": symbol, "timestamp": {"$gte": self._to_date(since)}},
+            {"_id": 0, "timestamp": 1}
+        ).sort("timestamp", 1)
+        async for doc in cursor:
+            yield self._to_ts(doc["timestamp"])
+
+    async def summarize(self, exchange, market_type, symbol, tf, start, until):
+        rows = await self.collection(exchange, market_type, tf).aggregate([
+            {"$match": {
+                "meta.symbol": symbol,
+                "timestamp": {"$gte": self._to_date(start), "$lt": self._to_date(until)}
+            }},
+            {"$sort": {"timestamp": 1}},
+            {"$group": {
+                "_id": None,
+                "open": {"$first": "$open"},
+                "high": {"$max": "$high"},
+                "low": {"$min": "$low"},
+                "volume": {"$sum": "$volume"},
+            }}
+        ]).to_list(1)
+        return rows[0] if rows else None
+
+    async def storage_stats(self, exchange, market_type, tf):
+        stats = await super().storage_stats(exchange, market_type, tf)
+        # у time-series count в collStats нет — считаем по метаданным бакетов
+        if not stats["count"]:
+            stats["count"] = await self.collection(exchange, market_type, tf).estimated_document_count()
+        return stats
+
+
+STORES = {store.name: store for store in (DocumentCandleStore(), TimeSeriesCandleStore())}
+
+
+def get_store(name: str = CANDLE_STORAGE):
+    if name not in STORES:
+        raise ValueError(f"Unknown candle storage: {name}")
+    return STORES[name]
+
+
+candle_store = get_store()
+
+
+# ====== Миграция ======
+
+async def migrate(exchange="binance", markets=MARKETS, timeframes=TIMEFRAMES, batch=10_000):
+    """
+    Потоково переливает документные коллекции в time-series. Уникального
+    индекса у цели нет, поэтому каждый символ продолжаем после последней
+    уже перенесённой свечи: повторный запуск и продолжение после обрыва не
+    плодят дублей. Свечи идут по возрастанию и вставляются ordered — после
+    обрыва в цели всегда лежит префикс.
+    """
+    source, target = STORES["documents"], STORES["timeseries"]
+    for market_type in markets:
+        for tf in timeframes:
+            await target.ensure_indexes(exchange, market_type, tf)
+            moved = skipped = 0
+            for symbol in await source.symbols(exchange, market_type, tf):
+                query = {"symbol": symbol}
+                last = await target.find(exchange, market_type, symbol, tf, limit=1)
+                if last:
+                    query["timestamp"] = {"$gt": last[0]["timestamp"]}
+                    skipped += 1
+                cursor = source.collection(exchange, market_type, tf).find(
+                    query, {"_id": 0, "symbol": 1, **{field: 1 for field in HISTORY_FIELDS}}
+                ).sort("timestamp", 1).batch_size(batch)
+
+                chunk = []
+                async for doc in cursor:
+                    chunk.append(doc)
+                    if len(chunk) >= batch:
+                        await target.insert(exchange, market_type, tf, chunk, ordered=True)
+                        moved += len(chunk)
+                        chunk = []
+                if chunk:
+                    await target.insert(exchange, market_type, tf, chunk, ordered=True)
+                    moved += len(chunk)
+            print(f"✅ {exchange} {market_type} {tf}: {moved} свечей"
+                  f"{f', продолжено после уже перенесённых у {skipped} символов' if skipped else ''}")
+
+
+async def _main():
+    import sys
+    if len(sys.argv) < 2 or sys.argv[1] != "migrate":
+        print("python3 -m candle_store migrate [spot|futures|all] [tf]")
+        return
+    market = sys.argv[2] if len(sys.argv) > 2 else "all"
+    tf = sys.argv[3] if len(sys.argv) > 3 else None
+    await migrate(
+        markets=MARKETS if market == "all" else (market,),
+        timeframes=[tf] if tf else TIMEFRAMES
+    )
+
+
+if __name__ == "__main__":
+    asyncio.run(_main())
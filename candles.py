@@ -0,0 +1,467 @@
+import asyncio
+import sys
+import time
+from array import array
+from datetime import datetime, timezone
+from collections import OrderedDict
+from candle_archive import candle_archive
+from candle_store import (
+    candle_store, TIMEFRAMES, MARKETS, HISTORY_FIELDS, COLUMNS
+)
+from config import CANDLE_CACHE_BARS, CANDLE_CACHE_MB, CANDLE_CACHE_TTL
+from cex.binance_history import TF_TO_MS
+
+HIGHER_TIMEFRAMES = TIMEFRAMES[1:]
+
+# 1970-01-01 — четверг, а недели Binance начинаются с понедельника
+WEEK_OFFSET = 4 * 86_400
+
+
+def room_name(exchange: str, market_type: str, symbol: str, tf: str) -> str:
+    return f"{exchange}:{market_type}:{symbol}:{tf}"
+
+
+async def ensure_indexes(exchanges=("binance",), markets=MARKETS):
+    """Индекс {symbol, timestamp} на каждой коллекции свечей: по нему идут upsert'ы и пагинация /history."""
+    for exchange in exchanges:
+        for market_type in markets:
+            for tf in TIMEFRAMES:
+                try:
+                    await candle_store.ensure_indexes(exchange, market_type, tf)
+                except Exception as e:
+                    # например, в старой коллекции остались дубли
+                    print(f"[indexes] {exchange} {market_type} {tf}: {e}")
+
+
+async def find_history(exchange, market_type, symbol, tf, before=None, limit=None):
+    """
+    Свечи по убыванию timestamp, только поля HISTORY_FIELDS. Сначала Mongo,
+    недостающее — из холодного архива (там всё строго старше горячего слоя).
+    """
+    cold = candle_archive.series(exchange, market_type, symbol, tf)
+    rows = []
+    if not cold or not before or before > cold.end:
+        rows = await candle_store.find(exchange, market_type, symbol, tf, before, limit)
+    if cold and (not limit or len(rows) < limit):
+        older = cold.read(rows[-1]["timestamp"] if rows else before, limit - len(rows) if limit else None)
+        rows += rows_from_columns(older)[::-1]
+    return rows
+
+
+# ====== Границы свечей ======
+
+def _month_start(ts: int, months_ahead: int = 0) -> int:
+    d = datetime.fromtimestamp(ts, tz=timezone.utc)
+    month = d.month - 1 + months_ahead
+    return int(datetime(d.year + month // 12, month % 12 + 1, 1, tzinfo=timezone.utc).timestamp())
+
+
+def bucket_start(ts: int, tf: str) -> int:
+    """Начало свечи tf, в которую попадает ts (секунды)."""
+    if tf == "1M":
+        return _month_start(ts)
+    size = TF_TO_MS[tf] // 1000
+    offset = WEEK_OFFSET if tf == "1w" else 0
+    return ts - (ts - offset) % size
+
+
+def bucket_end(start: int, tf: str) -> int:
+    """Начало следующей свечи после start (секунды)."""
+    if tf == "1M":
+        return _month_start(start, 1)
+    return start + TF_TO_MS[tf] // 1000
+
+
+# ====== Сборка старших тф из 1m ======
+
+class CandleAggregator:
+    """
+    Инкрементально сворачивает поток 1m-свечей одного рынка во все старшие тф.
+    На вход — payload 1m-свечи (как шлёт kline-обработчик), на выход — payload
+    той же формы для каждого тф.
+
+    seed(exchange, market_type, symbol, tf, start, until) -> {open, high, low, volume}
+    закрытых минут [start, until) или None — добор свечи, начатой без нас. Добор
+    идёт фоновой задачей (не дольше seed_timeout), поток минут его не ждёт. Свеча,
+    период которой мы видели не целиком (пока не добрана, без добора или с
+    разрывом потока), помечается complete=False: её не закрывают и не сохраняют.
+    """
+
+    def __init__(self, exchange: str, market_type: str, timeframes=HIGHER_TIMEFRAMES, seed=None,
+                 seed_timeout: float = 10):
+        self.exchange = exchange
+        self.market_type = market_type
+        self.timeframes = timeframes
+        self.seed = seed
+        self.seed_timeout = seed_timeout
+        # (symbol, tf) -> состояние формирующейся свечи
+        self.bars = {}
+        self.tasks = set()
+
+    def _open_bar(self, symbol, tf, start, minute):
+        bar = {
+            "start": start,
+            "end": bucket_end(start, tf),
+            "open": minute["open"],
+            "high": minute["high"],
+            "low": minute["low"],
+            "volume": 0.0,           # объём закрытых минут
+            "minute": minute["openTime"],
+            "minute_volume": 0.0,    # объём текущей минуты (ещё растёт)
+            "final": False,
+            "complete": minute["openTime"] == start,
+            "gap": False,            # пропущены минуты — свеча уже не станет полной
+        }
+        if not bar["complete"] and self.seed:
+            # подключились посреди свечи — добираем уже прошедшие минуты в фоне
+            task = asyncio.create_task(self._seed_bar(symbol, tf, bar))
+            self.tasks.add(task)
+            task.add_done_callback(self.tasks.discard)
+        return bar
+
+    async def _seed_bar(self, symbol, tf, bar):
+        until = bar["minute"]
+        try:
+            seed = await asyncio.wait_for(
+                self.seed(self.exchange, self.market_type, symbol, tf, bar["start"], until), self.seed_timeout
+            )
+        except Exception as e:
+            print(f"[aggregator] Seed error {symbol}/{tf}: {e!r}")
+            return
+        # свечу могли закрыть или забыть, пока ждали REST
+        if not seed or self.bars.get((symbol, tf)) is not bar:
+            return
+        # минуты с until и дальше свеча уже набрала из потока — добавляем только более ранние
+        bar["open"] = seed["open"]
+        bar["high"] = max(seed["high"], bar["high"])
+        bar["low"] = min(seed["low"], bar["low"])
+        bar["volume"] += seed["volume"]
+        bar["complete"] = not bar["gap"]
+
+    async def update(self, symbol: str, minute: dict) -> list:
+        """Применяет тик 1m-свечи, возвращает [(tf, candle)] для изменившихся тф."""
+        out = []
+        ts = minute["openTime"]
+        for tf in self.timeframes:
+            key = (symbol, tf)
+            start = bucket_start(ts, tf)
+            bar = self.bars.get(key)
+
+            if bar is not None and start < bar["start"]:
+                continue
+            if bar is None or start > bar["start"]:
+                # закрывающая минута не пришла (разрыв потока) — свечу не закрываем:
+                # её период виден не целиком, историю поправит докачка
+                bar = self.bars[key] = self._open_bar(symbol, tf, start, minute)
+
+            if ts > bar["minute"]:
+                if ts > bar["minute"] + 60:
+                    # пропущены минуты — их объёма в свече нет
+                    bar["gap"] = True
+                    bar["complete"] = False
+                bar["volume"] += bar["minute_volume"]
+                bar["minute"] = ts
+            elif ts < bar["minute"]:
+                continue
+
+            bar["high"] = max(bar["high"], minute["high"])
+            bar["low"] = min(bar["low"], minute["low"])
+            bar["close"] = minute["close"]
+            bar["minute_volume"] = minute["volume"]
+            bar["final"] = bar["complete"] and minute["isFinal"] and ts + 60 >= bar["end"]
+            out.append((tf, self.candle(symbol, bar)))
+        return out
+
+    def candle(self, symbol: str, bar: dict) -> dict:
+        close_time = bar["end"] - 1
+        return {
+            "symbol":     symbol,
+            "timestamp":  int(bar["start"]),
+            "open":       bar["open"],
+            "high":       bar["high"],
+            "low":        bar["low"],
+            "close":      bar["close"],
+            "volume":     bar["volume"] + bar["minute_volume"],
+            "openTime":   bar["start"],
+            "closeTime":  close_time,
+            "isFinal":    bar["final"],
+            "complete":   bar["complete"],
+            "price":      bar["close"],
+            "timer":      max(0, close_time - int(time.time()))
+        }
+
+    def forget(self, symbol: str):
+        # стрим символа закрыт — состояние больше не актуально
+        for tf in self.timeframes:
+            self.bars.pop((symbol, tf), None)
+
+
+# ====== Формирующиеся свечи ======
+
+class LiveBarStore:
+    """
+    Текущая (незакрытая) свеча каждой комнаты. Тики обновляют только память;
+    в Mongo свеча пишется один раз — закрытой (save). Незакрытые не пишутся:
+    недостроенная свеча, оставшаяся в базе после ухода последнего зрителя,
+    выглядела бы для докачки (missing_ranges) целой. После рестарта
+    формирующаяся свеча добирается заново (CandleAggregator.seed).
+    """
+
+    def __init__(self):
+        self.bars = {}       # room -> candle
+        self.writes = 0
+
+    def update(self, room: str, candle: dict):
+        self.bars[room] = candle
+
+    def forget(self, room: str):
+        self.bars.pop(room, None)
+
+    def get(self, room: str):
+        return self.bars.get(room)
+
+    def drop(self, exchange: str, market_type: str, symbol: str):
+        for tf in TIMEFRAMES:
+            self.bars.pop(room_name(exchange, market_type, symbol, tf), None)
+
+    async def save(self, room: str, candle: dict):
+        exchange, market_type, _, tf = room.split(":")
+        await candle_store.upsert(exchange, market_type, tf, [candle])
+        self.writes += 1
+
+    def stats(self):
+        return {"bars": len(self.bars), "writes": self.writes}
+
+
+# ====== Колоночный формат /history ======
+
+BINARY_LAYOUT = "t:i64,o:f64,h:f64,l:f64,c:f64,v:f64"
+
+
+async def find_history_columns(exchange, market_type, symbol, tf, before=None, limit=None):
+    """
+    То же, что find_history, но Mongo сама собирает параллельные массивы
+    t/o/h/l/c/v по возрастанию времени — без словаря на каждую свечу.
+    """
+    cold = candle_archive.series(exchange, market_type, symbol, tf)
+    if cold and before and before <= cold.end:
+        return cold.read(before, limit)
+    columns = await candle_store.find_columns(exchange, market_type, symbol, tf, before, limit)
+    if cold and (not limit or len(columns["t"]) < limit):
+        older = cold.read(columns["t"][0] if columns["t"] else before, limit - len(columns["t"]) if limit else None)
+        columns = {name: older[name] + columns[name] for name in COLUMNS}
+    return columns
+
+
+def merge_live_columns(columns: dict, live: dict, before=None, limit=None) -> dict:
+    """merge_live для колонок (columns — по возрастанию timestamp)."""
+    if not live or (before and live["timestamp"] >= before):
+        return columns
+    ts = int(live["timestamp"])
+    values = (ts, live["open"], live["high"], live["low"], live["close"], live["volume"])
+    t = columns["t"]
+    if t and t[-1] == ts:
+        for name, value in zip(COLUMNS, values):
+            columns[name][-1] = value
+    elif not t or ts > t[-1]:
+        for name, value in zip(COLUMNS, values):
+            columns[name].append(value)
+        if limit and len(t) > limit:
+            for name in COLUMNS:
+                del columns[name][0]
+    return columns
+
+
+def pack_columns(columns: dict) -> bytes:
+    """Колонки подряд: t — int64, остальные — float64, little-endian."""
+    parts = [array("q", columns["t"])] + [array("d", columns[name]) for name in COLUMNS[1:]]
+    if sys.byteorder != "little":
+        for part in parts:
+            part.byteswap()
+    return b"".join(part.tobytes() for part in parts)
+
+
+def rows_from_columns(columns: dict) -> list:
+    return [
+        {"timestamp": t, "open": o, "high": h, "low": l, "close": c, "volume": v}
+        for t, o, h, l, c, v in zip(*(columns[name] for name in COLUMNS))
+    ]
+
+
+def merge_live(history: list, live: dict, before=None, limit=None) -> list:
+    """Накладывает формирующуюся свечу на историю (history — по убыванию timestamp)."""
+    if not live or (before and live["timestamp"] >= before):
+        return history
+    live = {field: live[field] for field in HISTORY_FIELDS}
+    if history and history[0]["timestamp"] == live["timestamp"]:
+        history[0] = live
+    elif not history or live["timestamp"] > history[0]["timestamp"]:
+        history.insert(0, live)
+        if limit and len(history) > limit:
+            history.pop()
+    return history
+
+
+live_bars = LiveBarStore()
+
+
+# ====== Кэш последних свечей ======
+
+BAR_BYTES = 48  # int64 + 5 × float64
+
+
+class CandleRing:
+    """Кольцевой буфер последних capacity свечей серии в array-колонках."""
+
+    def __init__(self, capacity: int):
+        self.capacity = capacity
+        self.cols = [array("q", bytes(8 * capacity))] + [array("d", bytes(8 * capacity)) for _ in COLUMNS[1:]]
+        self.head = 0       # физический индекс самой старой свечи
+        self.size = 0
+        # complete — в Mongo старше ничего нет, буфер покрывает всю историю
+        self.complete = False
+        # live — буфер кормит поток свечей; иначе он живёт CANDLE_CACHE_TTL
+        self.live = False
+        self.loaded = time.time()
+
+    def _pos(self, i: int) -> int:
+        return (self.head + i) % self.capacity
+
+    def time_at(self, i: int) -> int:
+        return self.cols[0][self._pos(i)]
+
+    def push(self, values):
+        t = values[0]
+        if self.size and t < self.time_at(self.size - 1):
+            return
+        if self.size and t == self.time_at(self.size - 1):
+            pos = self._pos(self.size - 1)
+        elif self.size < self.capacity:
+            pos = self._pos(self.size)
+            self.size += 1
+        else:
+            # перезаписываем самую старую
+            pos = self.head
+            self.head = (self.head + 1) % self.capacity
+            self.complete = False
+        for col, value in zip(self.cols, values):
+            col[pos] = value
+
+    def index_before(self, before: int) -> int:
+        """Число свечей с timestamp < before (бинарный поиск по логическому индексу)."""
+        lo, hi = 0, self.size
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self.time_at(mid) < before:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    def slice(self, start: int, end: int) -> dict:
+        if end <= start:
+            return {name: [] for name in COLUMNS}
+        a, b = self._pos(start), self._pos(end - 1) + 1
+        return {
+            name: col[a:b].tolist() if a < b else col[a:].tolist() + col[:b].tolist()
+            for name, col in zip(COLUMNS, self.cols)
+        }
+
+
+class CandleCache:
+    """
+    LRU-набор CandleRing по комнатам (exchange:market_type:symbol:tf) в пределах бюджета памяти.
+    Свежая история и неглубокий before= отдаются из памяти, глубокая прокрутка идёт в Mongo.
+    """
+
+    def __init__(self, bars: int = CANDLE_CACHE_BARS, budget_mb: int = CANDLE_CACHE_MB, ttl: float = CANDLE_CACHE_TTL):
+        self.bars = bars
+        self.max_rings = max(1, budget_mb * 2**20 // (bars * BAR_BYTES))
+        self.ttl = ttl
+        self.rings = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def _valid(self, room: str):
+        ring = self.rings.get(room)
+        if ring is None:
+            return None
+        if not ring.live and time.time() - ring.loaded > self.ttl:
+            del self.rings[room]
+            return None
+        self.rings.move_to_end(room)
+        return ring
+
+    def _store(self, room: str, ring: CandleRing):
+        self.rings[room] = ring
+        self.rings.move_to_end(room)
+        while len(self.rings) > self.max_rings:
+            self.rings.popitem(last=False)
+            self.evictions += 1
+
+    def push(self, room: str, candle: dict):
+        # живой поток дописывает только уже загруженные и ещё свежие буферы
+        ring = self._valid(room)
+        if ring is None:
+            return
+        ring.live = True
+        ring.push((int(candle["timestamp"]), candle["open"], candle["high"],
+                   candle["low"], candle["close"], candle["volume"]))
+
+    def drop(self, exchange: str, market_type: str, symbol: str):
+        for tf in TIMEFRAMES:
+            self.rings.pop(room_name(exchange, market_type, symbol, tf), None)
+
+    def release(self, room: str):
+        # поток комнаты больше не приходит — буфер живёт до ttl, как загруженный с диска
+        ring = self.rings.get(room)
+        if ring is not None and ring.live:
+            ring.live = False
+            ring.loaded = time.time()
+
+    async def _load(self, exchange, market_type, symbol, tf):
+        columns = await find_history_columns(exchange, market_type, symbol, tf, limit=self.bars)
+        room = room_name(exchange, market_type, symbol, tf)
+        columns = merge_live_columns(columns, live_bars.get(room))
+        ring = CandleRing(self.bars)
+        for values in zip(*(columns[name] for name in COLUMNS)):
+            ring.push(values)
+        ring.complete = ring.size < self.bars
+        self._store(room, ring)
+        return ring
+
+    async def history(self, exchange, market_type, symbol, tf, before=None, limit=None):
+        """Колонки из памяти или None, если запрос глубже буфера."""
+        room = room_name(exchange, market_type, symbol, tf)
+        ring = self._valid(room)
+        loaded = False
+        if ring is None and not before:
+            ring = await self._load(exchange, market_type, symbol, tf)
+            loaded = True
+
+        if ring is not None:
+            end = ring.index_before(before) if before else ring.size
+            if ring.complete or (limit and end >= limit):
+                if loaded:
+                    self.misses += 1
+                else:
+                    self.hits += 1
+                return ring.slice(max(0, end - limit) if limit else 0, end)
+
+        # нужной глубины в буфере нет — пусть отвечает Mongo
+        self.misses += 1
+        return None
+
+    def stats(self):
+        return {
+            "rings": len(self.rings),
+            "max_rings": self.max_rings,
+            "bytes": len(self.rings) * self.bars * BAR_BYTES,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+        }
+
+
+candle_cache = CandleCache()
@@ -1,12 +1,18 @@
 import asyncio
+import aiohttp
 import websockets
 import json
 import time
 import math
-from db import db
 from datetime import datetime
-from tickers import save_ticker_data
-from ws.manager import ws_manager
+from tickers import ticker_writer, ticker_snapshot
+from bus import bus, candle_kind
+from modules.heatmap import heatmap_book
+from cex.binance_streams import KlineStreamPool
+from cex.binance_history import fetch_klines
+from candle_archive import candle_archive
+from indicators import live_indicators
+from candles import TIMEFRAMES, CandleAggregator, live_bars, candle_cache, room_name
 
 SPOT_WS_URL = "wss://stream.binance.com:9443/ws/!ticker@arr"
 FUTURES_WS_URL = "wss://fstream.binance.com/ws/!ticker@arr"
@@ -64,6 +70,8 @@ async def consumer():
         t = await queue.get()
         try:
             raw_symbol = t["s"].upper()
+            if t["market_type"] == "spot":
+                heatmap_book.update(t)
 
             excluded_pairs = {"USD1USDT", "TUSDT"}
             if raw_symbol in excluded_pairs:
@@ -81,91 +89,164 @@ async def consumer():
             price = float(t["c"])
             price_change = float(t["P"])
             volume_24h = float(t["q"])
-            market_vol = float(t["v"])
 
+            # market_cap / market_vol пишут только обогащения (cex/enrichment.py):
+            # они шлют лишь изменившиеся значения, и $set отсюда затирал бы остальные
             ticker_obj = {
                 "symbol": symbol,
                 "price": price,
                 "price_change": price_change,
                 "volume_24h": volume_24h,
-                "market_vol": market_vol,
-                "market_cap": None,
                 "exchange": "binance",
                 "market_type": t["market_type"],
                 "updated": datetime.utcnow().isoformat()
             }
 
-            await save_ticker_data(ticker_obj)
+            ticker_writer.submit(ticker_obj)
         except Exception as e:
             print("[consumer] Error:", e)
 
-# ====== Новый мульти‑подписочный обработчик свечей ======
-
-async def kline_multi_ws_handler(market_type, symbols, tf):
-    name = f"{market_type}_{tf}"
-    base_url = "wss://stream.binance.com:9443/stream?streams=" if market_type == "spot" else "wss://fstream.binance.com/stream?streams="
-    streams = "/".join(f"{s.lower()}@kline_{tf}" for s in symbols)
-    ws_url = f"{base_url}{streams}"
-
-    while True:
-        try:
-            async with websockets.connect(ws_url, ping_interval=20, ping_timeout=20) as ws:
-                print(f"[kline_multi_ws_handler] Connected {market_type} {tf} ({len(symbols)} symbols)")
-                last_msg_time[name] = time.time()
-                async for msg in ws:
-                    last_msg_time[name] = time.time()
-                    try:
-                        data = json.loads(msg)
-                        stream = data.get("stream", "")
-                        k = data["data"]["k"]
-
-                        full_symbol = k["s"].upper()
-                        if market_type == "futures":
-                            full_symbol += "PERP"
-
-                        timestamp = int(k["t"]) / 1000
-                        close_time = int(k["T"]) // 1000
-                        timer = max(0, math.floor(close_time - time.time()))
-
-                        candle = {
-                            "symbol":     full_symbol,
-                            "timestamp":  timestamp,
-                            "open":       float(k["o"]),
-                            "high":       float(k["h"]),
-                            "low":        float(k["l"]),
-                            "close":      float(k["c"]),
-                            "volume":     float(k["v"]),
-                            "openTime":   int(k["t"]) // 1000,
-                            "closeTime":  close_time,
-                            "isFinal":    k["x"],
-                            "price":      float(k["c"]),
-                            "timer": timer
-                        }
-
-                        exchange = "binance"
-                        collection_name = f"{exchange}_{market_type}_candles_{tf}"
-
-                        await db[collection_name].update_one(
-                            {"symbol": full_symbol, "timestamp": timestamp},
-                            {"$set": candle},
-                            upsert=True
-                        )
-
-                        room = f"{exchange}:{market_type}:{full_symbol}:{tf}"
-                        live_candles[room] = {
-                            "closeTime": close_time,
-                            "symbol": full_symbol,
-                            "exchange": exchange,
-                            "market_type": market_type,
-                            "tf": tf
-                        }
-                        await ws_manager.broadcast(room, json.dumps(candle))
-
-                    except Exception as e:
-                        print(f"[kline_multi_ws_handler] Error {market_type}/{tf}: {e}")
-        except Exception as e:
-            print(f"[kline_multi_ws_handler] Connection error {market_type}/{tf}: {e}")
-            await asyncio.sleep(5)
+# ====== Свечи: подписки по требованию ======
+
+# У Binance берём только 1m, старшие тф собираются локально
+KLINE_TIMEFRAMES = set(TIMEFRAMES)
+
+_rest_session = None
+
+async def seed_from_klines(exchange, market_type, symbol, tf, start, until):
+    """
+    Закрытые минуты [start, until) свечи tf по REST: свеча tf целиком
+    минус текущая минута (её объём дальше придёт из потока).
+    """
+    global _rest_session
+    if _rest_session is None:
+        _rest_session = aiohttp.ClientSession()
+    api_symbol = symbol[:-4] if market_type == "futures" else symbol
+    bars, minutes = await asyncio.gather(
+        fetch_klines(_rest_session, market_type, api_symbol, tf, start * 1000, start * 1000, retries=2),
+        fetch_klines(_rest_session, market_type, api_symbol, "1m", until * 1000, until * 1000, retries=2),
+    )
+    if not bars or bars[0][0] != start * 1000:
+        return None
+    minute_volume = float(minutes[0][5]) if minutes and minutes[0][0] == until * 1000 else 0.0
+    return {
+        "open": float(bars[0][1]),
+        "high": float(bars[0][2]),
+        "low": float(bars[0][3]),
+        "volume": max(0.0, float(bars[0][5]) - minute_volume),
+    }
+
+aggregators = {
+    "spot": CandleAggregator("binance", "spot", seed=seed_from_klines),
+    "futures": CandleAggregator("binance", "futures", seed=seed_from_klines),
+}
+
+async def publish_candle(market_type, tf, candle):
+    exchange = "binance"
+    room = room_name(exchange, market_type, candle["symbol"], tf)
+    # свеча, период которой виден не целиком (complete=False), в кэш истории не идёт
+    live_bars.update(room, candle)
+    if candle.get("complete", True):
+        candle_cache.push(room, candle)
+    # в Mongo — только закрытая свеча
+    if candle["isFinal"]:
+        await live_bars.save(room, candle)
+
+    if bus.has_subscribers(room):
+        live_candles[room] = {
+            "closeTime": candle["closeTime"],
+            "symbol": candle["symbol"],
+            "exchange": exchange,
+            "market_type": market_type,
+            "tf": tf
+        }
+        # потоковые индикаторы комнаты едут в том же кадре
+        values = live_indicators.update(room, candle)
+        await bus.publish(room, {**candle, "indicators": values} if values else candle, candle_kind(candle))
+
+async def handle_kline(market_type, k):
+    if k["i"] != "1m":
+        return
+
+    full_symbol = k["s"].upper()
+    if market_type == "futures":
+        full_symbol += "PERP"
+
+    timestamp = int(k["t"]) // 1000
+    close_time = int(k["T"]) // 1000
+    timer = max(0, math.floor(close_time - time.time()))
+
+    candle = {
+        "symbol":     full_symbol,
+        "timestamp":  timestamp,
+        "open":       float(k["o"]),
+        "high":       float(k["h"]),
+        "low":        float(k["l"]),
+        "close":      float(k["c"]),
+        "volume":     float(k["v"]),
+        "openTime":   int(k["t"]) // 1000,
+        "closeTime":  close_time,
+        "isFinal":    k["x"],
+        "price":      float(k["c"]),
+        "timer": timer
+    }
+
+    await publish_candle(market_type, "1m", candle)
+    for tf, bar in await aggregators[market_type].update(full_symbol, candle):
+        await publish_candle(market_type, tf, bar)
+
+
+def on_kline_closed(market_type, stream):
+    # стрим закрыт после grace — до этого минуты ещё идут и состояние нужно
+    symbol = stream.split("@")[0].upper() + ("PERP" if market_type == "futures" else "")
+    aggregators[market_type].forget(symbol)
+    live_bars.drop("binance", market_type, symbol)
+    candle_cache.drop("binance", market_type, symbol)
+
+kline_pools = {
+    "spot": KlineStreamPool("spot", handle_kline, last_msg_time, on_close=on_kline_closed),
+    "futures": KlineStreamPool("futures", handle_kline, last_msg_time, on_close=on_kline_closed),
+}
+
+def kline_stream(room):
+    """
+    binance:spot:BTCUSDT:4h → (spot, btcusdt@kline_1m); чужие/кривые комнаты и
+    символы, которых нет среди тикеров, → None: у Binance подписываем только их
+    """
+    try:
+        exchange, market_type, symbol, tf = room.split(":")
+    except ValueError:
+        return None
+    if exchange != "binance" or market_type not in kline_pools or tf not in KLINE_TIMEFRAMES:
+        return None
+    if f"{exchange}:{market_type}:{symbol}" not in ticker_snapshot.items:
+        return None
+    if market_type == "futures":
+        if not symbol.endswith("USDTPERP"):
+            return None
+        symbol = symbol[:-4]
+    if not symbol.isalnum() or not symbol.endswith("USDT"):
+        return None
+    # любой тф обслуживается одним 1m-стримом
+    return market_type, f"{symbol.lower()}@kline_1m"
+
+def on_kline_room(room, active):
+    # первая подписка на комнату открывает стрим у Binance, последняя отписка — закрывает
+    if not active:
+        # индикаторы могли подключить и к комнате без стрима (ingest берёт их из demand)
+        live_indicators.drop(room)
+    target = kline_stream(room)
+    if target is None:
+        return
+    market_type, stream = target
+    if active:
+        if not kline_pools[market_type].acquire(stream, room):
+            print(f"[kline] {market_type}: соединений уже {len(kline_pools[market_type].sockets)}, {stream} не открыт")
+    else:
+        kline_pools[market_type].release(stream, room)
+        live_candles.pop(room, None)
+
+bus.on_room(on_kline_room)
 
 # ====== Watchdog ======
 
@@ -182,7 +263,10 @@ async def watchdog(timeout=30):
 async def timer_broadcaster():
     while True:
         now = int(time.time())
-        for room, info in live_candles.items():
+        # копия: publish в режиме ingest ждёт Redis, а комнаты тем временем приходят и уходят
+        for room, info in list(live_candles.items()):
+            if not bus.has_subscribers(room):
+                continue
             close_time = info["closeTime"]
             timer = max(0, close_time - now)
 
@@ -194,31 +278,40 @@ async def timer_broadcaster():
                 "timer": timer
             }
 
-            await ws_manager.broadcast(room, json.dumps(payload))
+            await bus.publish(room, payload)
 
         await asyncio.sleep(1)
 
 # ====== Старт ======
 
+async def supervise(name, factory, delay=5):
+    """Запускает factory() и перезапускает после падения — одна задача не роняет весь процесс."""
+    while True:
+        try:
+            await factory()
+            return
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            print(f"[supervise] {name} упала: {e!r}, перезапуск через {delay}s")
+            await asyncio.sleep(delay)
+
 async def start_binance():
-    timeframes = [
-        "1m", "5m", "15m", "30m", "1h", "2h", "4h", "6h", "12h", "1d", "3d", "1w", "1M"
-    ]
-    # Здесь можно указать хоть весь список тикеров
-    symbols = [
-        "btcusdt", "ethusdt", "bnbusdt", "xrpusdt"
-    ]
-
-    tasks = [
-        spot_ws_handler(),
-        futures_ws_handler(),
-        consumer(),
-        timer_broadcaster(),
-        watchdog()
-    ]
-
-    for tf in timeframes:
-        tasks.append(kline_multi_ws_handler("spot", symbols, tf))
-        tasks.append(kline_multi_ws_handler("futures", symbols, tf))
-
-    await asyncio.gather(*tasks)
+    # kline-стримы открываются по требованию из on_kline_room — только для известных тикеров
+    try:
+        await ticker_snapshot.ensure_loaded()
+    except Exception as e:
+        print("[binance] Ticker snapshot load error:", e)
+    tasks = {
+        "spot_ws_handler": spot_ws_handler,
+        "futures_ws_handler": futures_ws_handler,
+        "consumer": consumer,
+        "ticker_writer": lambda: ticker_writer.run(queue),
+        "timer_broadcaster": timer_broadcaster,
+        "heatmap": heatmap_book.run,
+        "candle_archive": candle_archive.run,
+        "watchdog": watchdog,
+    }
+    tasks.update({f"kline_pool_{market}": pool.run for market, pool in kline_pools.items()})
+
+    await asyncio.gather(*(supervise(name, factory) for name, factory in tasks.items()))
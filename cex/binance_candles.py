@@ -1,3 +1,4 @@
+import asyncio
 import os
 import sys
 import time
@@ -5,7 +6,7 @@ import requests
 from datetime import datetime
 
 sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
-from db import db
+from candle_store import candle_store
 
 def fetch_recent_klines(symbol, tf, market_type="spot", limit=1000):
     base_url = "https://api.binance.com/api/v3/klines" if market_type == "spot" else "https://fapi.binance.com/fapi/v1/klines"
@@ -18,8 +19,8 @@ def fetch_recent_klines(symbol, tf, market_type="spot", limit=1000):
     data = response.json()
     return data
 
-def save_klines(symbol, tf, klines, market_type="spot"):
-    collection = f"binance_{market_type}_candles_{tf}"
+async def save_klines(symbol, tf, klines, market_type="spot"):
+    candles = []
     for k in klines:
         ts = k[0] // 1000
         candle = {
@@ -35,7 +36,14 @@ def save_klines(symbol, tf, klines, market_type="spot"):
             "isFinal": True,
             "price": float(k[4])
         }
-        db[collection].update_one({"symbol": symbol.upper(), "timestamp": ts}, {"$set": candle}, upsert=True)
+        candles.append(candle)
+    await candle_store.upsert("binance", market_type, tf, candles)
+
+async def load_recent(symbol, timeframes):
+    for tf in timeframes:
+        klines = fetch_recent_klines(symbol, tf)
+        await save_klines(symbol, tf, klines)
+        print(f"✅ {symbol} {tf}: {len(klines)} последних свечей загружено")
 
 if __name__ == "__main__":
     if len(sys.argv) < 2:
@@ -45,7 +53,4 @@ if __name__ == "__main__":
     symbol = sys.argv[1].upper()
     timeframes = ["1m", "5m", "15m", "30m", "1h", "2h", "4h", "6h", "12h", "1d", "3d", "1w", "1M"]
 
-    for tf in timeframes:
-        klines = fetch_recent_klines(symbol, tf)
-        save_klines(symbol, tf, klines)
-        print(f"✅ {symbol} {tf}: {len(klines)} последних свечей загружено")
+    asyncio.run(load_recent(symbol, timeframes))
@@ -1,16 +1,27 @@
 import aiohttp
 import asyncio
+import os
 import time
 import signal
 from datetime import datetime, timezone
 from db import db
-from pymongo import UpdateOne
+from candle_store import candle_store
+from candle_archive import candle_archive
 
+# адреса переопределяются через env — например, на локальную заглушку bench/binance_stub.py
 BASE_URLS = {
-    "spot": "https://api.binance.com/api/v3/klines",
-    "futures": "https://fapi.binance.com/fapi/v1/klines"
+    "spot": os.environ.get("BINANCE_SPOT_KLINES", "https://api.binance.com/api/v3/klines"),
+    "futures": os.environ.get("BINANCE_FUTURES_KLINES", "https://fapi.binance.com/fapi/v1/klines")
 }
 
+# Бюджет веса запросов в минуту на IP и вес одного klines limit=1000
+WEIGHT_BUDGET = {"spot": 6000, "futures": 2400}
+KLINES_WEIGHT = {"spot": 2, "futures": 5}
+
+# Конвейер загрузки: сколько страниц может ждать записи и размер пачки записи
+PIPELINE_DEPTH = 8
+WRITE_BATCH = 5000
+
 TIMEFRAMES = list(reversed([
     "1m", "5m", "15m", "30m",
     "1h", "2h", "4h", "6h",
@@ -24,11 +35,100 @@ TF_TO_MS = {
     "1w": 604_800_000, "1M": 2_592_000_000
 }
 
+# с этого момента (2017-07) грузим, если месяц не указан
+DEFAULT_START = 1500000000000
+# чекпоинты докачки: {_id: "market:SYMBOL:tf", verified_until: мс}
+PROGRESS_COLLECTION = "binance_history_progress"
+
 stop_event = asyncio.Event()
 
 
-async def fetch_klines(session, base_url, symbol, tf, start_ms, end_ms=None, retries=5):
+class FetchError(Exception):
+    """Страницу свечей получить не удалось — это не то же самое, что «свечей нет»."""
+
+
+class WeightLimiter:
+    """
+    Токен-бакет по весу запросов одного API (spot/futures): пополняется
+    со скоростью бюджета в минуту и сверяется с X-MBX-USED-WEIGHT-1M из ответов,
+    чтобы учитывать и чужие запросы с того же IP.
+    """
+
+    def __init__(self, budget, safety=0.9):
+        self.capacity = budget * safety
+        self.rate = self.capacity / 60
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.paused_until = 0
+        self.lock = asyncio.Lock()
+        self.spent = 0
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    async def acquire(self, weight):
+        # под замком — запросы проходят по очереди, без гонки за токены
+        async with self.lock:
+            while True:
+                wait = self.paused_until - time.monotonic()
+                if wait > 0:
+                    await asyncio.sleep(wait)
+                    continue
+                self._refill()
+                if self.tokens >= weight:
+                    self.tokens -= weight
+                    self.spent += weight
+                    return
+                await asyncio.sleep((weight - self.tokens) / self.rate)
+
+    def observe(self, headers):
+        used = headers.get("X-MBX-USED-WEIGHT-1M") or headers.get("X-MBX-USED-WEIGHT")
+        if used:
+            self._refill()
+            self.tokens = min(self.tokens, self.capacity - int(used))
+
+    def pause(self, seconds):
+        self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+
+
+LIMITERS = {market: WeightLimiter(budget) for market, budget in WEIGHT_BUDGET.items()}
+
+
+class ThroughputReport:
+    def __init__(self):
+        self.started = time.monotonic()
+        self.requests = 0
+        self.candles = 0
+        self.written = 0
+        self.throttled = 0
+
+    def summary(self):
+        elapsed = max(time.monotonic() - self.started, 1e-9)
+        weight = sum(limiter.spent for limiter in LIMITERS.values())
+        return (
+            f"📊 {elapsed:.0f}s | {self.requests} req ({self.requests / elapsed:.1f}/s) | "
+            f"{self.candles} свечей ({self.candles / elapsed:.0f}/s) | "
+            f"записано {self.written} ({self.written / elapsed:.0f}/s) | "
+            f"вес {weight} ({weight / elapsed * 60:.0f}/мин) | 429/418: {self.throttled}"
+        )
+
+    async def run(self, interval=30):
+        while not stop_event.is_set():
+            await asyncio.sleep(interval)
+            print(self.summary())
+
+
+report = ThroughputReport()
+
+
+async def fetch_klines(session, market, symbol, tf, start_ms, end_ms=None, retries=5):
+    limiter = LIMITERS[market]
     for i in range(retries):
+        if stop_event.is_set():
+            return []
+        await limiter.acquire(KLINES_WEIGHT[market])
         try:
             params = {
                 "symbol": symbol.upper(),
@@ -40,89 +140,133 @@ async def fetch_klines(session, base_url, symbol, tf, start_ms, end_ms=None, ret
                 params["endTime"] = int(end_ms)
 
             async with session.get(
-                base_url,
+                BASE_URLS[market],
                 params=params,
                 timeout=aiohttp.ClientTimeout(total=20)
             ) as res:
-                if res.status == 429:
-                    print(f"⏳ Throttled {symbol} {tf}, sleeping 60s...")
-                    await asyncio.sleep(60)
+                report.requests += 1
+                limiter.observe(res.headers)
+                if res.status in (429, 418):
+                    # 418 — уже бан по IP; в обоих случаях ждём Retry-After всем планировщиком
+                    retry_after = int(res.headers.get("Retry-After", 60))
+                    report.throttled += 1
+                    print(f"⏳ HTTP {res.status} {symbol} {tf}, пауза {retry_after}s...")
+                    limiter.pause(retry_after)
                     continue
                 if res.status != 200:
                     text = await res.text()
-                    print(f"❌ {symbol} {tf}: HTTP {res.status} → {text}")
-                    return []
+                    raise FetchError(f"{symbol} {tf}: HTTP {res.status} → {text}")
                 data = await res.json()
-                await asyncio.sleep(0.1)  # throttle
+                report.candles += len(data)
                 return data
+        except FetchError:
+            raise
         except Exception as e:
             print(f"⚠️ Retry {i+1} for {symbol} {tf}: {e}")
             await asyncio.sleep(2)
-    return []
+    if stop_event.is_set():
+        return []
+    raise FetchError(f"{symbol} {tf}: {retries} попыток не удались")
 
 
-async def load_symbol(symbol, market="spot", tf_filter=None, start_date=None):
-    base_url = BASE_URLS[market]
-    collection_prefix = f"binance_{market}_candles"
-
-    api_symbol = symbol.replace("perp", "") if market == "futures" else symbol
-
-    print(f"\n📥 Загрузка {symbol.upper()}... ({market})")
+def next_open(ts_ms, tf):
+    """Открытие следующей свечи после ts_ms (для 1M — календарный месяц)."""
+    if tf == "1M":
+        d = datetime.fromtimestamp(ts_ms // 1000, tz=timezone.utc)
+        year, month = (d.year + 1, 1) if d.month == 12 else (d.year, d.month + 1)
+        return int(datetime(year, month, 1, tzinfo=timezone.utc).timestamp() * 1000)
+    return ts_ms + TF_TO_MS[tf]
 
-    async with aiohttp.ClientSession() as session:
-        for tf in TIMEFRAMES:
-            if stop_event.is_set():
-                return
-            if tf_filter and tf != tf_filter:
-                continue
 
-            print(f"⏳ {symbol} / {tf}...")
-            tf_ms = TF_TO_MS[tf]
-            end_time = int(time.time() * 1000)
+def parse_start_date(start_date):
+    if start_date:
+        try:
+            year, month = map(int, start_date.split("-"))
+            start_time = int(datetime(year, month, 1, tzinfo=timezone.utc).timestamp() * 1000)
+            print(f"▶️ Стартуем строго с {datetime.fromtimestamp(start_time//1000, tz=timezone.utc)}")
+            return start_time
+        except Exception as e:
+            print(f"⚠️ Ошибка парсинга даты {start_date}: {e}")
+    return DEFAULT_START
+
+
+async def stored_timestamps(market, symbol, tf, since):
+    """timestamp (с) по возрастанию из холодного архива и Mongo вместе."""
+    cold = candle_archive.series("binance", market, symbol, tf)
+    archived = cold.times(since) if cold else []
+    i = 0
+    async for ts in candle_store.timestamps("binance", market, symbol, tf, since):
+        while i < len(archived) and archived[i] <= ts:
+            yield archived[i]
+            i += 1
+        yield ts
+    for ts in archived[i:]:
+        yield ts
+
+
+async def missing_ranges(market, symbol, tf, start_ms, end_ms):
+    """
+    Диапазоны [from, to) в мс, которых нет ни в Mongo, ни в архиве: дыры
+    между сохранёнными свечами и хвост после последней. В Mongo идём только
+    по индексу {symbol, timestamp}, забирая одно поле.
+    """
+    ranges = []
+    expected = start_ms
+    async for ts in stored_timestamps(market, symbol.upper(), tf, start_ms // 1000):
+        ts *= 1000
+        if ts > expected:
+            ranges.append((expected, ts))
+        expected = max(expected, next_open(ts, tf))
+    if expected < end_ms:
+        ranges.append((expected, end_ms))
+    return ranges
+
+
+def kline_doc(symbol, k):
+    return {
+        "symbol": symbol.upper(),
+        "timestamp": k[0] // 1000,
+        "open": float(k[1]),
+        "high": float(k[2]),
+        "low": float(k[3]),
+        "close": float(k[4]),
+        "volume": float(k[5])
+    }
+
+
+async def write_klines(market, symbol, tf, klines, empty=False):
+    docs = [kline_doc(symbol, k) for k in klines]
+    if empty:
+        # диапазон заведомо пуст — обычная вставка дешевле upsert'ов
+        await candle_store.insert("binance", market, tf, docs)
+    else:
+        await candle_store.upsert("binance", market, tf, docs)
+    report.written += len(docs)
 
-            if start_date:
-                try:
-                    year, month = map(int, start_date.split("-"))
-                    start_time = int(datetime(year, month, 1, tzinfo=timezone.utc).timestamp() * 1000)
-                    print(f"▶️ Стартуем строго с {datetime.fromtimestamp(start_time//1000, tz=timezone.utc)}")
-                except Exception as e:
-                    print(f"⚠️ Ошибка парсинга даты {start_date}: {e}")
-                    start_time = 1500000000000
-            else:
-                start_time = 1500000000000
 
-            collection = db[f"{collection_prefix}_{tf}"]
+async def load_range(session, market, api_symbol, symbol, tf, start_time, end_time, on_page=None, empty=False):
+    """
+    Конвейер: сеть качает страницы в ограниченную очередь, писатель параллельно
+    сливает готовые страницы в крупные неупорядоченные пачки. on_page(last)
+    зовётся после записи — чекпоинт не убегает вперёд базы. Неудачный запрос
+    (FetchError) пробрасывается после записи уже скачанного.
+    """
+    tf_ms = TF_TO_MS[tf]
+    pages = asyncio.Queue(maxsize=PIPELINE_DEPTH)
 
+    async def produce(start_time):
+        try:
             while start_time < end_time and not stop_event.is_set():
                 window_end = min(start_time + 365*24*3600*1000, end_time)
 
                 while start_time < window_end and not stop_event.is_set():
-                    klines = await fetch_klines(session, base_url, api_symbol, tf, start_time, window_end)
+                    # endTime у Binance включительный: свеча на window_end — уже следующего окна
+                    # (или уже лежит в базе, если это правый край дыры из missing_ranges)
+                    klines = await fetch_klines(session, market, api_symbol, tf, start_time, window_end - 1)
                     if not klines:
                         break
-
-                    ops = [
-                        UpdateOne(
-                            {"symbol": symbol.upper(), "timestamp": k[0] // 1000},
-                            {"$set": {
-                                "symbol": symbol.upper(),
-                                "timestamp": k[0] // 1000,
-                                "open": float(k[1]),
-                                "high": float(k[2]),
-                                "low": float(k[3]),
-                                "close": float(k[4]),
-                                "volume": float(k[5])
-                            }},
-                            upsert=True
-                        )
-                        for k in klines
-                    ]
-
-                    if ops:
-                        await collection.bulk_write(ops, ordered=False)
-
-                    last = klines[-1][0]
-                    start_time = int(last + tf_ms)
+                    await pages.put(klines)
+                    start_time = int(klines[-1][0] + tf_ms)
 
                     print(
                         f"✅ {symbol} {tf}: {len(klines)} свечей "
@@ -131,31 +275,161 @@ async def load_symbol(symbol, market="spot", tf_filter=None, start_date=None):
                     )
 
                 start_time = window_end
+        finally:
+            # писатель дольёт скачанное и увидит ошибку на await producer
+            await pages.put(None)
+
+    producer = asyncio.create_task(produce(start_time))
+    try:
+        finished = False
+        while not finished:
+            page = await pages.get()
+            if page is None:
+                break
+            batch = [page]
+            # забираем всё, что уже скачано, до WRITE_BATCH свечей
+            while sum(map(len, batch)) < WRITE_BATCH and not pages.empty():
+                page = pages.get_nowait()
+                if page is None:
+                    finished = True
+                    break
+                batch.append(page)
+
+            await write_klines(market, symbol, tf, [k for page in batch for k in page], empty=empty)
+            if on_page:
+                await on_page(batch[-1][-1][0])
+        await producer
+    finally:
+        producer.cancel()
+    return not stop_event.is_set()
+
+
+async def fill_gaps(session, market, api_symbol, symbol, tf, start_time, end_time):
+    """
+    Докачка только недостающего. Чекпоинт verified_until — до него всё
+    либо лежит в базе, либо у Binance этих свечей нет; следующий запуск
+    (в том числе после Ctrl+C) сканирует покрытие только после него.
+    """
+    progress_id = f"{market}:{symbol.upper()}:{tf}"
+    progress = await db[PROGRESS_COLLECTION].find_one({"_id": progress_id})
+    if progress:
+        start_time = max(start_time, progress["verified_until"])
+
+    # незакрытую свечу не считаем проверенной
+    closed_until = end_time - TF_TO_MS[tf]
+
+    async def checkpoint(ts_ms):
+        await db[PROGRESS_COLLECTION].update_one(
+            {"_id": progress_id},
+            {"$set": {"verified_until": min(ts_ms, closed_until), "updated": datetime.now(timezone.utc)}},
+            upsert=True
+        )
+
+    ranges = await missing_ranges(market, symbol, tf, start_time, end_time)
+    if not ranges:
+        print(f"✔️ {symbol} {tf}: пропусков нет")
+    for range_start, range_end in ranges:
+        print(f"🕳 {symbol} {tf}: "
+              f"{datetime.fromtimestamp(range_start // 1000, tz=timezone.utc)} → "
+              f"{datetime.fromtimestamp(range_end // 1000, tz=timezone.utc)}")
+        # диапазоны из missing_ranges пусты по построению
+        completed = await load_range(
+            session, market, api_symbol, symbol, tf, range_start, range_end,
+            on_page=lambda last: checkpoint(next_open(last, tf)), empty=True
+        )
+        if not completed:
+            return
+        await checkpoint(range_end)
+    if not ranges:
+        await checkpoint(end_time)
+
+
+async def load_tf(session, symbol, market, tf, start_date=None, fill=False):
+    api_symbol = symbol.replace("perp", "") if market == "futures" else symbol
+    end_time = int(time.time() * 1000)
+    start_time = parse_start_date(start_date)
+    cold = candle_archive.series("binance", market, symbol.upper(), tf)
+
+    print(f"⏳ {symbol} / {tf}...")
+    try:
+        if fill:
+            # missing_ranges видит и архив: дыры внутри него тоже докачиваются
+            await fill_gaps(session, market, api_symbol, symbol, tf, start_time, end_time)
+        elif cold:
+            # то, что уже в архиве, не качаем заново, но история раньше него — качаем
+            if start_time < cold.start * 1000:
+                await load_range(session, market, api_symbol, symbol, tf, start_time, cold.start * 1000)
+            await load_range(session, market, api_symbol, symbol, tf, max(start_time, cold.end * 1000), end_time)
+        else:
+            await load_range(session, market, api_symbol, symbol, tf, start_time, end_time)
+    except FetchError as e:
+        # чекпоинт остался на последней записанной странице — следующий запуск продолжит с неё
+        print(f"❌ {e}")
+    if cold:
+        # докачанное внутри и перед архивом — туда же, иначе /history его не увидит
+        merged = await candle_archive.merge_older("binance", market, symbol.upper(), tf)
+        if merged:
+            print(f"🗄 {symbol} {tf}: {merged} свечей влито в архив")
+
+
+async def load_symbol(symbol, market="spot", tf_filter=None, start_date=None, fill=False):
+    print(f"\n📥 Загрузка {symbol.upper()}... ({market}{', докачка' if fill else ''})")
+
+    async with aiohttp.ClientSession() as session:
+        for tf in TIMEFRAMES:
+            if stop_event.is_set():
+                return
+            if tf_filter and tf != tf_filter:
+                continue
+            await load_tf(session, symbol, market, tf, start_date=start_date, fill=fill)
 
     print(f"✅ Загрузка {symbol.upper()} завершена. ({market})")
+    print(report.summary())
 
 
-async def load_all(market="spot", tf_filter=None, start_date=None, concurrency=2):
+async def market_symbols(market):
     symbols = await db.tickers.distinct("symbol", {"market_type": market})
-
     if market == "spot":
-        symbols = [s.lower() for s in symbols if s.lower().endswith("usdt")]
-    else:
-        symbols = [s.lower() for s in symbols if s.lower().endswith("usdtperp")]
-
-    if not symbols:
-        print(f"⚠️ Нет тикеров для {market} в коллекции tickers")
+        return [s.lower() for s in symbols if s.lower().endswith("usdt")]
+    return [s.lower() for s in symbols if s.lower().endswith("usdtperp")]
+
+
+async def load_all(market="spot", tf_filter=None, start_date=None, concurrency=16, fill=False):
+    """
+    Все символы × тф (× рынки, если market="all") одной очередью задач.
+    Темп задаёт не число воркеров, а WeightLimiter каждого рынка.
+    """
+    markets = list(BASE_URLS) if market == "all" else [market]
+
+    jobs = asyncio.Queue()
+    for m in markets:
+        symbols = await market_symbols(m)
+        if not symbols:
+            print(f"⚠️ Нет тикеров для {m} в коллекции tickers")
+        for tf in TIMEFRAMES:
+            if tf_filter and tf != tf_filter:
+                continue
+            for sym in symbols:
+                jobs.put_nowait((sym, m, tf))
+    if jobs.empty():
         return
 
-    sem = asyncio.Semaphore(concurrency)
+    print(f"📥 Задач: {jobs.qsize()} ({', '.join(markets)}), воркеров: {concurrency}")
 
-    async def limited(sym):
-        async with sem:
-            if not stop_event.is_set():
-                await load_symbol(sym, market=market, tf_filter=tf_filter, start_date=start_date)
+    async def worker(session):
+        while not stop_event.is_set():
+            try:
+                sym, m, tf = jobs.get_nowait()
+            except asyncio.QueueEmpty:
+                return
+            await load_tf(session, sym, m, tf, start_date=start_date, fill=fill)
 
-    tasks = [limited(sym) for sym in symbols]
-    await asyncio.gather(*tasks)
+    reporter = asyncio.create_task(report.run())
+    connector = aiohttp.TCPConnector(limit=concurrency)
+    async with aiohttp.ClientSession(connector=connector) as session:
+        await asyncio.gather(*(worker(session) for _ in range(concurrency)))
+    reporter.cancel()
+    print(report.summary())
 
 
 def _install_signal_handlers():
@@ -169,17 +443,21 @@ def _install_signal_handlers():
 
 async def _main():
     import sys
-    symbol = sys.argv[1].lower() if len(sys.argv) > 1 else "all"
-    market = sys.argv[2].lower() if len(sys.argv) > 2 else "spot"
-    tf = sys.argv[3].lower() if len(sys.argv) > 3 else None
-    start_date = sys.argv[4] if len(sys.argv) > 4 else None
+    # --fill — докачать только пропуски, с продолжением с чекпоинта
+    fill = "--fill" in sys.argv
+    args = [a for a in sys.argv[1:] if not a.startswith("--")]
+    symbol = args[0].lower() if len(args) > 0 else "all"
+    market = args[1].lower() if len(args) > 1 else "spot"
+    tf = args[2].lower() if len(args) > 2 else None
+    start_date = args[3] if len(args) > 3 else None
 
     _install_signal_handlers()
 
     if symbol == "all":
-        await load_all(market=market, tf_filter=tf, start_date=start_date)
+        # market "all" — spot и futures вместе, у каждого свой бюджет веса
+        await load_all(market=market, tf_filter=tf, start_date=start_date, fill=fill)
     else:
-        await load_symbol(symbol, market=market, tf_filter=tf, start_date=start_date)
+        await load_symbol(symbol, market=market, tf_filter=tf, start_date=start_date, fill=fill)
 
 
 if __name__ == "__main__":
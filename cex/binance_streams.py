@@ -0,0 +1,205 @@
+import asyncio
+import itertools
+import json
+import time
+import websockets
+
+from config import KLINE_MAX_SOCKETS
+
+STREAM_URLS = {
+    "spot": "wss://stream.binance.com:9443/stream",
+    "futures": "wss://fstream.binance.com/stream"
+}
+
+# Лимиты Binance на одно соединение
+MAX_STREAMS = {"spot": 1024, "futures": 200}
+MAX_CONTROL_PER_SEC = {"spot": 5, "futures": 10}
+# сколько стримов кладём в один SUBSCRIBE
+SUBSCRIBE_CHUNK = 100
+
+
+class StreamSocket:
+    """
+    Одно combined-stream соединение. Набор стримов меняется на лету
+    через SUBSCRIBE/UNSUBSCRIBE, без переподключения.
+    """
+
+    def __init__(self, pool: "KlineStreamPool", index: int):
+        self.pool = pool
+        self.name = f"{pool.market_type}_kline_{index}"
+        self.streams = set()      # что должно быть подписано
+        self.subscribed = set()   # что реально отправлено в текущее соединение
+        self.ids = itertools.count(1)
+        self.changed = asyncio.Event()
+        self.task = None
+
+    def has_room(self) -> bool:
+        return len(self.streams) < self.pool.max_streams
+
+    def add(self, stream: str):
+        self.streams.add(stream)
+        self.changed.set()
+
+    def remove(self, stream: str):
+        self.streams.discard(stream)
+        self.changed.set()
+
+    async def _send(self, ws, method: str, streams: list):
+        pause = 1 / MAX_CONTROL_PER_SEC[self.pool.market_type]
+        for i in range(0, len(streams), SUBSCRIBE_CHUNK):
+            await ws.send(json.dumps({
+                "method": method,
+                "params": streams[i:i + SUBSCRIBE_CHUNK],
+                "id": next(self.ids)
+            }))
+            await asyncio.sleep(pause)
+
+    async def _control(self, ws):
+        # сводим желаемый набор стримов с подписанным
+        while True:
+            await self.changed.wait()
+            self.changed.clear()
+            added = sorted(self.streams - self.subscribed)
+            removed = sorted(self.subscribed - self.streams)
+            if added:
+                await self._send(ws, "SUBSCRIBE", added)
+                self.subscribed.update(added)
+                print(f"[{self.name}] +{len(added)} streams ({len(self.subscribed)} total)")
+            if removed:
+                await self._send(ws, "UNSUBSCRIBE", removed)
+                self.subscribed.difference_update(removed)
+                print(f"[{self.name}] -{len(removed)} streams ({len(self.subscribed)} total)")
+            if not self.streams:
+                return
+
+    async def _reader(self, ws):
+        heartbeat = self.pool.heartbeat
+        async for msg in ws:
+            heartbeat[self.name] = time.time()
+            try:
+                data = json.loads(msg)
+                if "data" not in data:
+                    # ответ на SUBSCRIBE/UNSUBSCRIBE
+                    if data.get("error"):
+                        print(f"[{self.name}] Control error:", data["error"])
+                    continue
+                await self.pool.on_kline(self.pool.market_type, data["data"]["k"])
+            except Exception as e:
+                print(f"[{self.name}] Error:", e)
+
+    async def run(self):
+        url = STREAM_URLS[self.pool.market_type]
+        while self.streams:
+            try:
+                async with websockets.connect(url, ping_interval=20, ping_timeout=20) as ws:
+                    print(f"[{self.name}] Connected")
+                    self.pool.heartbeat[self.name] = time.time()
+                    self.subscribed = set()
+                    self.changed.set()
+
+                    reader = asyncio.create_task(self._reader(ws))
+                    control = asyncio.create_task(self._control(ws))
+                    done, pending = await asyncio.wait({reader, control}, return_when=asyncio.FIRST_COMPLETED)
+                    for t in pending:
+                        t.cancel()
+                    for t in done:
+                        # control завершается сам, когда стримов не осталось
+                        if t.exception():
+                            raise t.exception()
+            except Exception as e:
+                print(f"[{self.name}] Connection error:", e)
+                await asyncio.sleep(5)
+
+        print(f"[{self.name}] Idle, closed")
+        self.pool.heartbeat.pop(self.name, None)
+        self.pool.drop(self)
+
+
+class KlineStreamPool:
+    """
+    Подписки на kline-стримы по требованию: стрим живёт, пока на него есть
+    спрос (комнаты-держатели), и раскладывается по небольшому пулу соединений
+    с учётом лимита стримов на соединение. Соединений не больше max_sockets:
+    когда все заполнены, новый стрим не открывается. on_close(market_type, stream)
+    зовётся, когда стрим действительно закрыт — после grace.
+    """
+
+    def __init__(self, market_type: str, on_kline, heartbeat: dict, grace: float = 30,
+                 max_sockets: int = KLINE_MAX_SOCKETS, on_close=None):
+        self.market_type = market_type
+        self.on_kline = on_kline
+        self.on_close = on_close
+        self.heartbeat = heartbeat
+        self.max_streams = MAX_STREAMS[market_type]
+        self.max_sockets = max_sockets
+        # отписку откладываем: пользователь часто просто переключает тф туда-обратно
+        self.grace = grace
+        self.sockets = []
+        self.counter = itertools.count()
+        self.refs = {}       # stream -> комнаты, которым он нужен
+        self.owner = {}      # stream -> StreamSocket
+        self.released = {}   # stream -> когда refcount стал 0
+        self.rejected = 0
+
+    def acquire(self, stream: str, room: str) -> bool:
+        """False — свободных мест нет, стрим не открыт и комната не учтена."""
+        if stream not in self.owner:
+            sock = next((s for s in self.sockets if s.has_room()), None)
+            if sock is None:
+                if len(self.sockets) >= self.max_sockets:
+                    self.rejected += 1
+                    return False
+                sock = StreamSocket(self, next(self.counter))
+                self.sockets.append(sock)
+        self.refs.setdefault(stream, set()).add(room)
+        self.released.pop(stream, None)
+        if stream in self.owner:
+            return True
+
+        sock.add(stream)
+        self.owner[stream] = sock
+        if sock.task is None or sock.task.done():
+            sock.task = asyncio.create_task(sock.run())
+        return True
+
+    def release(self, stream: str, room: str):
+        # комната, которой acquire отказал, в refs не попала — её release ничего не трогает
+        rooms = self.refs.get(stream)
+        if not rooms or room not in rooms:
+            return
+        rooms.discard(room)
+        if rooms:
+            return
+        del self.refs[stream]
+        if stream in self.owner:
+            self.released[stream] = time.time()
+
+    def drop(self, sock: StreamSocket):
+        if sock in self.sockets and not sock.streams:
+            self.sockets.remove(sock)
+
+    def stats(self):
+        return {
+            "sockets": len(self.sockets),
+            "streams": len(self.owner),
+            "releasing": len(self.released),
+            "rejected": self.rejected,
+        }
+
+    async def run(self):
+        # фоновая отписка стримов, у которых истёк grace
+        while True:
+            await asyncio.sleep(1)
+            now = time.time()
+            for stream, since in list(self.released.items()):
+                if now - since < self.grace:
+                    continue
+                del self.released[stream]
+                sock = self.owner.pop(stream, None)
+                if sock:
+                    sock.remove(stream)
+                if self.on_close:
+                    try:
+                        self.on_close(self.market_type, stream)
+                    except Exception as e:
+                        print(f"[{self.market_type}_kline] Close callback error {stream}: {e}")
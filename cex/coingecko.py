@@ -1,10 +1,8 @@
 import asyncio
 import logging
-import httpx
-import json
 import math
-from datetime import datetime
-from db import db, redis_client
+
+from cex.enrichment import enrich_tickers, conditional_get
 
 log = logging.getLogger("coingecko")
 
@@ -62,125 +60,115 @@ CUSTOM_MAPPING = {
 }
 
 
-def match_coin_by_symbol(symbol, gecko_coins):
-    symbol = symbol.upper()
-    candidates = [c for c in gecko_coins if c["symbol"].upper() == symbol]
-    candidates = sorted(candidates, key=lambda c: c.get("market_cap") or 0, reverse=True)
-    return candidates[0] if candidates else None
+def index_by_symbol(gecko_coins):
+    """symbol → монета с наибольшей капитализацией, за один проход."""
+    index = {}
+    for coin in gecko_coins:
+        symbol = coin["symbol"].upper()
+        best = index.get(symbol)
+        if best is None or (coin.get("market_cap") or 0) > (best.get("market_cap") or 0):
+            index[symbol] = coin
+    return index
+
+
+# страница -> монеты (только нужные поля): на 304 берём отсюда
+pages = {}
+
+
+def trim_coin(coin):
+    return {key: coin.get(key) for key in ("id", "symbol", "market_cap", "total_volume")}
 
 
 async def fetch_all_market_data():
+    """(монеты, изменилось ли что-то с прошлого раза)"""
     coins = []
+    modified = False
     page = 1
     while True:
         log.info(f"Запрос страницы {page} с CoinGecko")
         try:
-            async with httpx.AsyncClient() as client:
-                response = await client.get(
-                    GECKO_MARKET_URL,
-                    params={
-                        "vs_currency": "usd",
-                        "order": "market_cap_desc",
-                        "per_page": 250,
-                        "page": page,
-                        "sparkline": "false"
-                    },
-                    timeout=30
-                )
-                if response.status_code == 429:
-                    log.warning("Превышен лимит CoinGecko. Пауза 3мин")
-                    await asyncio.sleep(240)
-                    continue
-
+            response = await conditional_get(
+                "coingecko",
+                GECKO_MARKET_URL,
+                params={
+                    "vs_currency": "usd",
+                    "order": "market_cap_desc",
+                    "per_page": 250,
+                    "page": page,
+                    "sparkline": "false"
+                }
+            )
+            if response.status_code == 429:
+                log.warning("Превышен лимит CoinGecko. Пауза 3мин")
+                await asyncio.sleep(240)
+                continue
+
+            if response.status_code == 304 and page in pages:
+                data = pages[page]
+            else:
                 response.raise_for_status()
-                data = response.json()
-                if not data:
-                    break
-                coins.extend(data)
-                page += 1
-                await asyncio.sleep(2)
+                data = [trim_coin(coin) for coin in response.json()]
+                pages[page] = data
+                modified = True
+            if not data:
+                break
+            coins.extend(data)
+            page += 1
+            await asyncio.sleep(2)
         except Exception as e:
             log.error(f"Ошибка при запросе CoinGecko (страница {page}): {e}")
             break
-    log.info(f"CoinGecko получено: {len(coins)}")
-    return coins
+    log.info(f"CoinGecko получено: {len(coins)}, изменения: {modified}")
+    return coins, modified
 
 
-def clean_ticker_data_for_redis(ticker_data):
-    """Удаляет _id и сериализует datetime в строку"""
-    ticker_data.pop("_id", None)
-    if isinstance(ticker_data.get("updated"), datetime):
-        ticker_data["updated"] = ticker_data["updated"].isoformat()
-    return ticker_data
+def parse_market_cap(market_cap):
+    if isinstance(market_cap, str):
+        market_cap = float(market_cap.replace(",", "")
+                                     .replace("b", "e9")
+                                     .replace("m", "e6"))
+    return market_cap
 
 
-async def update_market_caps():
-    tickers = await db.tickers.find().to_list(None)
-    if not tickers:
-        log.warning("Нет тикеров в базе")
-        return
-
-    gecko_coins = await fetch_all_market_data()
+async def load_lookup():
+    gecko_coins, modified = await fetch_all_market_data()
+    if not modified:
+        return None
     gecko_map_by_id = {coin["id"]: coin for coin in gecko_coins}
+    gecko_map_by_symbol = index_by_symbol(gecko_coins)
 
-    updated = 0
-
-    for ticker in tickers:
-        symbol = ticker["symbol"]
-        base = symbol.replace("PERP", "")
-        base = base[:-4].upper() if base.endswith("USDT") else base.upper()
+    def lookup(base, symbol):
         coin = None
         mapped_id = CUSTOM_MAPPING.get(base)
         if mapped_id:
             coin = gecko_map_by_id.get(mapped_id)
-            if coin:
-                log.info(f"[MAPPED] {symbol} → {mapped_id} → {coin['market_cap']}")
         if not coin:
-            coin = match_coin_by_symbol(base, gecko_coins)
-            if coin:
-                log.info(f"[MATCHED] {symbol} → {coin['id']} → {coin['market_cap']}")
-            else:
-                log.warning(f"[MISSING] Не найден CoinGecko coin для {symbol} (base={base})")
-
-        market_cap = coin.get("market_cap") if coin else None
-        market_vol = coin.get("total_volume") if coin else None
-        log.info(f"[{symbol}] market_cap={market_cap}, market_vol={market_vol}")
-
-        if market_cap is not None:
-            try:
-                if isinstance(market_cap, str):
-                    market_cap = float(market_cap.replace(",", "")
-                                                   .replace("b", "e9")
-                                                   .replace("m", "e6"))
-                if math.isnan(market_cap):
-                    continue
-
-                base_symbol_variants = [symbol.replace("PERP", ""), symbol + "PERP"] if not symbol.endswith("PERP") else [symbol, symbol.replace("PERP", "")]
-
-                await db.tickers.update_many(
-                    {"symbol": {"$in": base_symbol_variants}},
-                    {
-                        "$set": {
-                            "market_cap": int(market_cap) if market_cap else 0,
-                            "market_vol": int(market_vol) if market_vol else 0
-                        }
-                    }
-                )
-
-                for s in base_symbol_variants:
-                    ticker_data = await db.tickers.find_one({"symbol": s})
-                    if ticker_data:
-                        redis_key = f"cex:{s}"
-                        redis_client.set(
-                            redis_key,
-                            json.dumps(clean_ticker_data_for_redis(ticker_data))
-                        )
-
-                updated += 1
-            except Exception as e:
-                log.error(f"Ошибка обработки market_cap для {symbol}: {e}")
-
-    log.info(f"Обновлено: {updated} из {len(tickers)}")
+            coin = gecko_map_by_symbol.get(base)
+        if not coin:
+            log.debug(f"[MISSING] Не найден CoinGecko coin для {symbol} (base={base})")
+            return None
+
+        market_cap = coin.get("market_cap")
+        market_vol = coin.get("total_volume")
+        if market_cap is None:
+            return None
+        try:
+            market_cap = parse_market_cap(market_cap)
+        except ValueError as e:
+            log.error(f"Ошибка обработки market_cap для {symbol}: {e}")
+            return None
+        if math.isnan(market_cap):
+            return None
+        return {
+            "market_cap": int(market_cap) if market_cap else 0,
+            "market_vol": int(market_vol) if market_vol else 0
+        }
+
+    return lookup
+
+
+async def update_market_caps():
+    return await enrich_tickers("coingecko", load_lookup)
 
 
 async def start_coingecko(interval: int = 300):
@@ -0,0 +1,152 @@
+"""
+Капитализация и объём тикеров от внешних провайдеров (coinpaprika, coingecko).
+
+Провайдер строит свои индексы монет один раз и отдаёт lookup(base, symbol);
+изменения считаются в памяти против прошлого прогона, и только изменившиеся
+тикеры пишутся одним bulk_write в Mongo и одним pipeline в Redis.
+Запросы к провайдерам идут через общий пул соединений и условные
+(If-None-Match / If-Modified-Since), если провайдер отдаёт ETag/Last-Modified.
+"""
+import json
+import time
+from datetime import datetime
+
+import httpx
+from pymongo import UpdateOne
+
+from db import db, redis_set_many
+from tickers import ticker_key
+from bus import bus
+
+_client = None
+# source -> {url+params: (etag, last_modified)}
+validators = {}
+# source -> {ticker _id: значения, записанные прошлым прогоном}
+snapshots = {}
+# последний прогон по провайдерам — для /api/stats
+last_runs = {}
+# поля, которые пишут только обогащения
+ENRICHED_FIELDS = ("market_cap", "market_vol")
+# снимок тикера, которого провайдер не знает: его поля снимаются ($unset)
+UNMATCHED = {}
+
+
+def base_symbol(symbol: str) -> str:
+    """BTCUSDT, BTCUSDTPERP → BTC"""
+    base = symbol.replace("PERP", "")
+    return base[:-4].upper() if base.endswith("USDT") else base.upper()
+
+
+def http_client() -> httpx.AsyncClient:
+    """Общий клиент провайдеров: keep-alive между страницами и прогонами."""
+    global _client
+    if _client is None:
+        _client = httpx.AsyncClient(
+            timeout=30,
+            limits=httpx.Limits(max_connections=10, max_keepalive_connections=5)
+        )
+    return _client
+
+
+async def conditional_get(source: str, url: str, params: dict = None) -> httpx.Response:
+    """
+    GET с валидаторами прошлого ответа. На 304 тело пустое — данные
+    у провайдера не менялись; вызывающий решает, что делать со старыми.
+    """
+    key = url + "?" + "&".join(f"{k}={v}" for k, v in sorted((params or {}).items()))
+    etag, modified = validators.get(source, {}).get(key, (None, None))
+    headers = {}
+    if etag:
+        headers["If-None-Match"] = etag
+    if modified:
+        headers["If-Modified-Since"] = modified
+    response = await http_client().get(url, params=params, headers=headers)
+    if response.status_code == 200:
+        etag, modified = response.headers.get("etag"), response.headers.get("last-modified")
+        if etag or modified:
+            validators.setdefault(source, {})[key] = (etag, modified)
+    return response
+
+
+def clean_ticker_data_for_redis(ticker_data):
+    """Удаляет _id и сериализует datetime в строку"""
+    ticker_data.pop("_id", None)
+    if isinstance(ticker_data.get("updated"), datetime):
+        ticker_data["updated"] = ticker_data["updated"].isoformat()
+    return ticker_data
+
+
+async def enrich_tickers(source: str, load_lookup) -> dict:
+    """
+    load_lookup() — корутина провайдера: качает данные, строит индексы и
+    возвращает lookup(base, symbol) -> {"market_cap": ..., "market_vol": ...} или None,
+    либо сам load_lookup возвращает None, если у провайдера ничего не поменялось (304).
+    У тикеров, для которых lookup вернул None, ENRICHED_FIELDS снимаются: иначе
+    в колонке оставались бы старые значения (и базовый объём Binance из прошлых версий).
+    """
+    started = time.perf_counter()
+    tickers = await db.tickers.find({}, {"symbol": 1}).to_list(None)
+    if not tickers:
+        print(f"[{source}] Нет тикеров")
+        return {}
+    loaded = time.perf_counter()
+
+    lookup = await load_lookup()
+    fetched = time.perf_counter()
+
+    previous = snapshots.setdefault(source, {})
+    changes, skipped = {}, 0
+    if lookup is None:
+        skipped = len(previous)
+    else:
+        for ticker in tickers:
+            values = lookup(base_symbol(ticker["symbol"]), ticker["symbol"])
+            if values is None:
+                values = UNMATCHED
+            if previous.get(ticker["_id"]) == values:
+                skipped += 1
+                continue
+            changes[ticker["_id"]] = values
+
+    if changes:
+        try:
+            await db.tickers.bulk_write(
+                [
+                    UpdateOne({"_id": _id}, {"$set": values} if values else
+                              {"$unset": {field: "" for field in ENRICHED_FIELDS}})
+                    for _id, values in changes.items()
+                ],
+                ordered=False
+            )
+            # в Redis тикер лежит целиком — перечитываем только изменившиеся
+            docs = await db.tickers.find({"_id": {"$in": list(changes)}}).to_list(None)
+            for doc in docs:
+                # снятые поля — явным null: снимок тикеров и клиенты сливают тикер поверх старого
+                for field in ENRICHED_FIELDS:
+                    doc.setdefault(field, None)
+            docs = {ticker_key(doc): clean_ticker_data_for_redis(doc) for doc in docs}
+            await redis_set_many({key: json.dumps(doc) for key, doc in docs.items()})
+        except Exception:
+            # без валидаторов следующий прогон скачает всё заново и повторит запись
+            validators.pop(source, None)
+            raise
+        previous.update(changes)
+        await bus.publish_feed("tickers", docs)
+    finished = time.perf_counter()
+
+    run = {
+        "tickers": len(tickers),
+        "not_modified": lookup is None,
+        "changed": len(changes),
+        "skipped": skipped,
+        "load_ms": round((loaded - started) * 1000, 1),
+        "fetch_ms": round((fetched - loaded) * 1000, 1),
+        "write_ms": round((finished - fetched) * 1000, 1),
+        "total_ms": round((finished - started) * 1000, 1),
+        "at": int(time.time()),
+    }
+    last_runs[source] = run
+    print(f"[{source}] {'304, ' if lookup is None else ''}изменено {run['changed']}, без изменений {run['skipped']} "
+          f"из {run['tickers']} за {run['total_ms']} ms "
+          f"(Mongo {run['load_ms']}, провайдер {run['fetch_ms']}, запись {run['write_ms']})")
+    return run
@@ -1,3 +1,52 @@
 import os
 
 SECRET_KEY = os.environ.get('SECRET_KEY') or "\xec\x17\xfbc;\xccN\xc3'J\xf20\x9ax\x87\xf6\xd6\xa2-\xda\xb5K\x17\xb3"
+
+# WebSocket: размер исходящей очереди на соединение и что делать с медленным клиентом
+# drop_oldest — выбрасывать самые старые кадры
+# conflate    — схлопывать очередь до последнего кадра каждого вида по каждой комнате
+#               (таймер отдельно, каждая свеча отдельно)
+# disconnect  — закрывать соединение
+# личные кадры сокету (ответы протокола, снимки) не выбрасываются ни при какой политике
+WS_QUEUE_SIZE = int(os.environ.get('WS_QUEUE_SIZE', 64))
+WS_SLOW_POLICY = os.environ.get('WS_SLOW_POLICY', 'conflate')
+
+# Мультиплекс /ws/kline: сколько комнат можно держать на одном сокете
+WS_MAX_ROOMS = int(os.environ.get('WS_MAX_ROOMS', 100))
+
+# Кэш последних свечей в памяти: свечей на серию, общий бюджет и сколько
+# живёт серия, которую не кормит живой поток
+CANDLE_CACHE_BARS = int(os.environ.get('CANDLE_CACHE_BARS', 5000))
+CANDLE_CACHE_MB = int(os.environ.get('CANDLE_CACHE_MB', 256))
+CANDLE_CACHE_TTL = float(os.environ.get('CANDLE_CACHE_TTL', 10))
+
+# Хранилище свечей: documents — коллекция документов на тф, timeseries — time-series коллекции (MongoDB 7.0+)
+CANDLE_STORAGE = os.environ.get('CANDLE_STORAGE', 'documents')
+
+# Холодный архив свечей: закрытые свечи старше CANDLE_ARCHIVE_AGE_DAYS уходят из Mongo в mmap-файлы
+CANDLE_ARCHIVE_DIR = os.environ.get('CANDLE_ARCHIVE_DIR', 'archive')
+CANDLE_ARCHIVE_AGE_DAYS = float(os.environ.get('CANDLE_ARCHIVE_AGE_DAYS', 90))
+CANDLE_ARCHIVE_TIMEFRAMES = os.environ.get('CANDLE_ARCHIVE_TIMEFRAMES', '1m').split(',')
+# период фоновой компакции в секундах; 0 — только вручную (python3 -m candle_archive compact)
+CANDLE_ARCHIVE_INTERVAL = float(os.environ.get('CANDLE_ARCHIVE_INTERVAL', 0))
+
+# Индикаторы на сервере: прогрев = INDICATOR_WARMUP * наибольший период, размер LRU результатов
+INDICATOR_WARMUP = int(os.environ.get('INDICATOR_WARMUP', 10))
+INDICATOR_CACHE_SIZE = int(os.environ.get('INDICATOR_CACHE_SIZE', 512))
+
+# Загрузка рынка: embedded — Binance/coinpaprika/heatmap в процессе веб-сервера (один воркер);
+# external — их держит отдельный python3 -m ingest, воркеры читают через Redis pub/sub (bus.py)
+INGEST_MODE = os.environ.get('INGEST_MODE', 'embedded')
+BUS_PREFIX = os.environ.get('BUS_PREFIX', 'tradium')
+# как часто воркер подтверждает свои комнаты; молчащий 3 интервала считается ушедшим
+DEMAND_HEARTBEAT = float(os.environ.get('DEMAND_HEARTBEAT', 5))
+
+# kline-стримы Binance по требованию: сколько соединений держать на рынок (spot — до 1024
+# стримов на соединение, futures — до 200); сверх этого новые стримы не открываются
+KLINE_MAX_SOCKETS = int(os.environ.get('KLINE_MAX_SOCKETS', 4))
+
+# /ws/tickers: как часто уходят пачки изменившихся тикеров, мс
+TICKER_PUSH_MS = int(os.environ.get('TICKER_PUSH_MS', 1000))
+
+# Страница тикера: сколько секунд живёт отрендеренный HTML (и max-age в Cache-Control)
+TICKER_PAGE_TTL = float(os.environ.get('TICKER_PAGE_TTL', 10))
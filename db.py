@@ -1,9 +1,30 @@
 from motor.motor_asyncio import AsyncIOMotorClient
-import redis
+import redis.asyncio as aioredis
 
 MONGO_URI = "mongodb://localhost:27017"
 client = AsyncIOMotorClient(MONGO_URI)
 db = client["tradium_db"]
 
 REDIS_URI = "redis://localhost"
-redis_client = redis.Redis.from_url(REDIS_URI, decode_responses=True)
\ No newline at end of file
+REDIS_MAX_CONNECTIONS = 32
+
+# Асинхронный клиент поверх ограниченного пула: при исчерпании пула
+# корутина ждёт свободное соединение, а не открывает новое
+redis_pool = aioredis.BlockingConnectionPool.from_url(
+    REDIS_URI,
+    max_connections=REDIS_MAX_CONNECTIONS,
+    timeout=5,
+    decode_responses=True
+)
+redis_client = aioredis.Redis(connection_pool=redis_pool)
+
+
+async def redis_set_many(mapping: dict, chunk: int = 1000):
+    """Пишет пачку ключей одним pipeline (MSET кусками по chunk ключей)."""
+    if not mapping:
+        return
+    items = list(mapping.items())
+    async with redis_client.pipeline(transaction=False) as pipe:
+        for i in range(0, len(items), chunk):
+            pipe.mset(dict(items[i:i + chunk]))
+        await pipe.execute()
@@ -14,6 +14,9 @@ from router import router
 from modules.desk import desk_bp
 from cex.binance import start_binance
 from cex.coinpaprika import start_coinpaprika
+from bus import bus
+from tickers import ticker_stream
+from config import INGEST_MODE
 
 # Логирование
 logging.basicConfig(level=logging.INFO)
@@ -21,11 +24,26 @@ log = logging.getLogger('fastapi')
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
+    if INGEST_MODE == "external":
+        # рынок грузит python3 -m ingest, воркер только читает шину
+        log.info("Web worker: market data from ingest via Redis")
+        asyncio.create_task(bus.run())
+        asyncio.create_task(ticker_stream.run())
+        yield
+        await bus.stop()
+        log.info("Lifespan завершён")
+        return
+
     log.info("Cold start: initializing Redis if needed...")
-    from tickers import initialize_redis_from_mongo
+    from tickers import initialize_redis_from_mongo, ensure_indexes as ensure_ticker_indexes
+    from candles import ensure_indexes as ensure_candle_indexes
     await initialize_redis_from_mongo()
+    await ensure_ticker_indexes()
+    # на больших коллекциях первая сборка индекса долгая — не держим старт
+    asyncio.create_task(ensure_candle_indexes())
     asyncio.create_task(start_binance())
     asyncio.create_task(start_coinpaprika(interval=300))
+    asyncio.create_task(ticker_stream.run())
     yield
     log.info("Lifespan завершён")
 
@@ -0,0 +1,850 @@
+"""
+Индикаторы на NumPy — серверные версии static/js/indicators/*.
+Формулы (в том числе затравка EMA первым значением и затравка RSI суммой)
+повторяют клиентские, чтобы линии совпадали с тем, что рисовал браузер.
+Имена индикаторов и параметров — как в meta.defaultParams на клиенте,
+лишние параметры (цвета, толщины) игнорируются.
+
+Результат — колонки той же длины, что входные свечи; где значения ещё
+нет (прогрев) — NaN, в JSON уходит null.
+"""
+import asyncio
+import math
+import time
+import numpy as np
+from collections import OrderedDict, deque
+from numpy.lib.stride_tricks import sliding_window_view
+from config import INDICATOR_WARMUP, INDICATOR_CACHE_SIZE
+from candles import COLUMNS, bucket_end, find_history_columns
+
+
+# ====== Примитивы ======
+
+def _nan(n):
+    return np.full(n, np.nan)
+
+
+def _ewm(x, alpha, prev):
+    """
+    out[i] = alpha * x[i] + (1 - alpha) * out[i - 1], out[-1] = prev.
+    Рекурсия разворачивается в cumsum блоками: внутри блока степени
+    (1 - alpha) ещё не уходят в переполнение.
+    """
+    out = np.empty(len(x))
+    decay = 1.0 - alpha
+    if not len(x):
+        return out
+    if decay <= 0:
+        out[:] = x
+        return out
+    block = max(1, int(200 / -np.log10(decay)))
+    for start in range(0, len(x), block):
+        seg = x[start:start + block]
+        powers = decay ** np.arange(1, len(seg) + 1)
+        out[start:start + len(seg)] = powers * (prev + alpha * np.cumsum(seg / powers))
+        prev = out[start + len(seg) - 1]
+    return out
+
+
+def ema(x, period):
+    """EMA с затравкой первым значением, как ema() в клиентских индикаторах."""
+    if not len(x):
+        return np.empty(0)
+    return np.concatenate(([x[0]], _ewm(x[1:], 2 / (period + 1), x[0])))
+
+
+def rolling_sum(x, period):
+    out = _nan(len(x))
+    if len(x) >= period:
+        cs = np.concatenate(([0.0], np.cumsum(x)))
+        out[period - 1:] = cs[period:] - cs[:-period]
+    return out
+
+
+def sma(x, period):
+    return rolling_sum(x, period) / period
+
+
+def rolling_std(x, period):
+    """Стандартное отклонение генеральной совокупности по окну (без cumsum квадратов — цены большие)."""
+    out = _nan(len(x))
+    if len(x) >= period:
+        out[period - 1:] = sliding_window_view(x, period).std(axis=1)
+    return out
+
+
+def _shift(x):
+    """Ряд по приращениям (длиной n-1) выравниваем по свечам."""
+    return np.concatenate(([np.nan], x))
+
+
+# ====== Индикаторы ======
+
+def calc_ma(c, fastPeriod, slowPeriod):
+    return {"fast": sma(c["c"], fastPeriod), "slow": sma(c["c"], slowPeriod)}
+
+
+def calc_sma(c, period):
+    return {"sma": sma(c["c"], period)}
+
+
+def calc_rsi(c, period):
+    close = c["c"]
+    out = _nan(len(close))
+    if len(close) <= period:
+        return {"rsi": out}
+    diff = np.diff(close)
+    up, down = np.maximum(diff, 0), np.maximum(-diff, 0)
+    # как на клиенте: затравка — сумма за первые period-1 приращений
+    gain = _ewm(up[period - 1:], 1 / period, up[:period - 1].sum())
+    loss = _ewm(down[period - 1:], 1 / period, down[:period - 1].sum())
+    with np.errstate(divide="ignore", invalid="ignore"):
+        rs = np.where(loss == 0, 100.0, gain / loss)
+    out[period:] = 100 - 100 / (1 + rs)
+    return {"rsi": out}
+
+
+def calc_macd(c, fast, slow, signal):
+    close = c["c"]
+    if len(close) < slow:
+        return {"macd": _nan(len(close)), "signal": _nan(len(close)), "hist": _nan(len(close))}
+    macd = ema(close, fast) - ema(close, slow)
+    sig = ema(macd, signal)
+    return {"macd": macd, "signal": sig, "hist": macd - sig}
+
+
+def true_range(c):
+    high, low, close = c["h"], c["l"], c["c"]
+    tr = high - low
+    if len(close) > 1:
+        prev = close[:-1]
+        tr[1:] = np.maximum.reduce([tr[1:], np.abs(high[1:] - prev), np.abs(low[1:] - prev)])
+    return tr
+
+
+def calc_atr(c, period):
+    out = _nan(len(c["c"]))
+    if len(out) > period:
+        out[period:] = sma(true_range(c), period)[period:]
+    return {"atr": out}
+
+
+def calc_obv(c, smoothType, smoothLength):
+    close = c["c"]
+    if len(close) < 2:
+        return {"obv": _nan(len(close)), "smooth": _nan(len(close))}
+    obv = np.concatenate(([0.0], np.cumsum(np.sign(np.diff(close)) * c["v"][1:])))
+    if smoothLength <= 1:
+        smooth = _nan(len(close))
+    else:
+        smooth = ema(obv, smoothLength) if smoothType == "ema" else sma(obv, smoothLength)
+    return {"obv": obv, "smooth": smooth}
+
+
+def _double_smoothed(close, long, short, zero):
+    momentum = np.diff(close)
+    num = ema(ema(momentum, long), short)
+    den = ema(ema(np.abs(momentum), long), short)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        return np.where(den != 0, 100 * num / den, zero)
+
+
+def calc_tsi(c, long, short, signal):
+    close = c["c"]
+    if len(close) < long + short:
+        return {"tsi": _nan(len(close)), "signal": _nan(len(close))}
+    tsi = _double_smoothed(close, long, short, np.nan)
+    sig = ema(np.nan_to_num(tsi), signal)
+    return {"tsi": _shift(tsi), "signal": _shift(sig)}
+
+
+def calc_trend_strength(c, period):
+    close = c["c"]
+    if len(close) < period + 2:
+        return {"value": _nan(len(close))}
+    return {"value": _shift(_double_smoothed(close, period, period, 0.0))}
+
+
+def calc_volatility_ohlc(c, period):
+    close = c["c"]
+    if len(close) < period:
+        return {"value": _nan(len(close))}
+    vols = np.zeros(len(close))
+    vols[1:] = (c["h"][1:] - c["l"][1:]) / close[:-1] * 100
+    return {"value": sma(vols, period)}
+
+
+def calc_cfm(c, period):
+    high, low, close, volume = c["h"], c["l"], c["c"], c["v"]
+    if len(close) < period:
+        return {"cfm": _nan(len(close))}
+    span = high - low
+    with np.errstate(divide="ignore", invalid="ignore"):
+        mfm = np.where(span != 0, ((close - low) - (high - close)) / span, 0.0)
+        mfv, vol = rolling_sum(mfm * volume, period), rolling_sum(volume, period)
+        return {"cfm": np.where(vol != 0, mfv / vol, 0.0)}
+
+
+def calc_bbw(c, period, mult):
+    close = c["c"]
+    return {"bbw": 2 * mult * rolling_std(close, period) / sma(close, period) * 100}
+
+
+def calc_ao(c, short, long):
+    median = (c["h"] + c["l"]) / 2
+    if len(median) < long:
+        return {"ao": _nan(len(median))}
+    return {"ao": sma(median, short) - sma(median, long)}
+
+
+def calc_efi(c, period):
+    close = c["c"]
+    if len(close) < 2:
+        return {"efi": _nan(len(close))}
+    # первое значение на клиенте — null, и EMA стартует от нуля
+    raw = np.diff(close) * c["v"][1:]
+    return {"efi": _shift(_ewm(raw, 2 / (period + 1), 0.0))}
+
+
+def calc_vpvr(c, rows):
+    """Профиль объёма по цене за окно: объём свечи делится поровну между её ценовыми строками."""
+    high, low = c["h"], c["l"]
+    if not len(high) or rows <= 0 or high.max() == low.min():
+        return {"price_low": [], "price_high": [], "up": [], "down": [], "poc": None, "vah": None, "val": None}
+    lo_price, hi_price = low.min(), high.max()
+    step = (hi_price - lo_price) / rows
+
+    volume, open_, close = c["v"], c["o"], c["c"]
+    up = np.where(close > open_, volume, np.where(close < open_, 0.0, volume / 2))
+    down = volume - up
+
+    first = np.clip(np.floor((low - lo_price) / step).astype(np.int64), 0, rows - 1)
+    last = np.clip(np.floor((high - lo_price) / step).astype(np.int64), 0, rows - 1)
+    span = np.maximum(1, last - first + 1)
+
+    def spread(values):
+        # разностный массив: +v/span с first, -v/span после last
+        delta = np.zeros(rows + 1)
+        np.add.at(delta, first, values / span)
+        np.add.at(delta, last + 1, -values / span)
+        return np.cumsum(delta[:-1])
+
+    up_bins, down_bins = spread(up), spread(down)
+    total = up_bins + down_bins
+    edges = lo_price + step * np.arange(rows + 1)
+
+    # value area: самые объёмные строки, пока не наберётся 70% объёма
+    order = np.argsort(-total, kind="stable")
+    before = np.concatenate(([0.0], np.cumsum(total[order])[:-1]))
+    included = order[before < total.sum() * 0.7]
+    return {
+        "price_low": edges[:-1], "price_high": edges[1:],
+        "up": up_bins, "down": down_bins,
+        "poc": int(np.argmax(total)),
+        "vah": int(included.max()), "val": int(included.min()),
+    }
+
+
+INDICATORS = {
+    "ma": (calc_ma, {"fastPeriod": 50, "slowPeriod": 200}),
+    "sma": (calc_sma, {"period": 25}),
+    "rsi": (calc_rsi, {"period": 14}),
+    "macd": (calc_macd, {"fast": 12, "slow": 26, "signal": 9}),
+    "atr": (calc_atr, {"period": 14}),
+    "obv": (calc_obv, {"smoothType": "sma", "smoothLength": 9}),
+    "tsi": (calc_tsi, {"long": 25, "short": 13, "signal": 13}),
+    "trendStrength": (calc_trend_strength, {"period": 14}),
+    "volatilityOHLC": (calc_volatility_ohlc, {"period": 10}),
+    "cfm": (calc_cfm, {"period": 20}),
+    "bbw": (calc_bbw, {"period": 20, "mult": 2.0}),
+    "ao": (calc_ao, {"short": 5, "long": 34}),
+    "efi": (calc_efi, {"period": 13}),
+    "vpvr": (calc_vpvr, {"rows": 120}),
+}
+# профиль считается по видимому окну, а не по каждой свече
+PROFILES = {"vpvr"}
+MAX_PERIOD = 5000
+
+
+def resolve_params(name: str, params: dict) -> dict:
+    """
+    Параметры по умолчанию + переданные, приведённые к типам умолчаний:
+    int — периоды (целые, 1..MAX_PERIOD), float — множители (> 0).
+    """
+    _, defaults = INDICATORS[name]
+    resolved = dict(defaults)
+    for key, default in defaults.items():
+        if isinstance(default, float):
+            if key in params:
+                resolved[key] = float(params[key])
+            if not 0 < resolved[key] < math.inf:
+                raise ValueError(f"{key} out of range")
+        elif isinstance(default, int):
+            if key in params:
+                value = float(params[key])
+                if not value.is_integer():
+                    raise ValueError(f"{key} must be an integer")
+                resolved[key] = int(value)
+            if not 1 <= resolved[key] <= MAX_PERIOD:
+                raise ValueError(f"{key} out of range")
+        elif key in params:
+            resolved[key] = type(default)(params[key])
+    return resolved
+
+
+def warmup(name: str, params: dict) -> int:
+    """Сколько свечей до окна нужно для прогрева (EMA-цепочкам — с запасом)."""
+    if name in PROFILES:
+        return 0
+    # прогрев считают только периоды; множители (float) сюда не входят
+    periods = [value for value in params.values() if isinstance(value, int)]
+    return INDICATOR_WARMUP * int(max(periods, default=0))
+
+
+def to_arrays(columns: dict) -> dict:
+    return {
+        name: np.asarray(values, dtype=np.int64 if name == "t" else np.float64)
+        for name, values in columns.items()
+    }
+
+
+def compute(name: str, columns: dict, params: dict, skip: int = 0) -> dict:
+    """
+    columns — колонки свечей (t/o/h/l/c/v, по возрастанию). Первые skip
+    свечей — прогрев: участвуют в расчёте, но в ответ не попадают.
+    """
+    func, _ = INDICATORS[name]
+    arrays = to_arrays(columns)
+    if name in PROFILES:
+        arrays = {key: values[skip:] for key, values in arrays.items()}
+        return func(arrays, **params)
+    result = {"t": arrays["t"][skip:]}
+    for key, values in func(arrays, **params).items():
+        result[key] = values[skip:]
+    return result
+
+
+def to_json(result: dict) -> dict:
+    """NumPy -> списки, NaN -> None."""
+    out = {}
+    for key, values in result.items():
+        if isinstance(values, np.ndarray):
+            values = values.tolist()
+            if values and isinstance(values[0], float):
+                values = [None if v != v else v for v in values]
+        out[key] = values
+    return out
+
+
+class IndicatorCache:
+    """
+    LRU результатов по (symbol, tf, индикатор, параметры, окно). Запись
+    годится, пока не изменились входные свечи: штамп — число свечей,
+    время и close последней (формирующаяся свеча меняет close).
+    """
+
+    def __init__(self, size: int = INDICATOR_CACHE_SIZE):
+        self.size = size
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def stamp(columns: dict):
+        return (len(columns["t"]), columns["t"][-1], columns["c"][-1]) if columns["t"] else (0,)
+
+    def get(self, key, stamp):
+        entry = self.entries.get(key)
+        if entry is None or entry[0] != stamp:
+            self.misses += 1
+            return None
+        self.entries.move_to_end(key)
+        self.hits += 1
+        return entry[1]
+
+    def put(self, key, stamp, result):
+        self.entries[key] = (stamp, result)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.size:
+            self.entries.popitem(last=False)
+
+    def stats(self):
+        return {"entries": len(self.entries), "hits": self.hits, "misses": self.misses}
+
+
+indicator_cache = IndicatorCache()
+
+
+# ====== Потоковые индикаторы ======
+#
+# Состояние на последней закрытой свече + O(1) на обновление: preview(candle)
+# считает значение для формирующейся свечи, не трогая состояние, commit(candle)
+# продвигает состояние закрытой свечой. Формулы те же, что в calc_*.
+
+class _Ema:
+    __slots__ = ("alpha", "value")
+
+    def __init__(self, period=None, alpha=None, value=None):
+        self.alpha = alpha if alpha is not None else 2 / (period + 1)
+        self.value = value
+
+    def peek(self, x):
+        return x if self.value is None else x * self.alpha + self.value * (1 - self.alpha)
+
+    def push(self, x):
+        self.value = self.peek(x)
+        return self.value
+
+
+class _Window:
+    """Сумма по окну period: period-1 закрытых значений + текущее."""
+    __slots__ = ("period", "items", "sum", "pushes")
+
+    def __init__(self, period):
+        self.period = period
+        self.items = deque()
+        self.sum = 0.0
+        self.pushes = 0
+
+    def peek(self, x):
+        return self.sum + x if len(self.items) == self.period - 1 else None
+
+    def push(self, x):
+        self.items.append(x)
+        self.sum += x
+        if len(self.items) > self.period - 1:
+            self.sum -= self.items.popleft()
+        self.pushes += 1
+        # скользящая сумма копит ошибку округления — раз в окно пересчитываем
+        if self.pushes % self.period == 0:
+            self.sum = math.fsum(self.items)
+
+
+def _ratio(total, period):
+    return None if total is None else total / period
+
+
+class StreamMa:
+    def __init__(self, fastPeriod, slowPeriod):
+        self.fast, self.slow = _Window(fastPeriod), _Window(slowPeriod)
+
+    def preview(self, c):
+        x = c["close"]
+        return {"fast": _ratio(self.fast.peek(x), self.fast.period), "slow": _ratio(self.slow.peek(x), self.slow.period)}
+
+    def commit(self, c):
+        self.fast.push(c["close"])
+        self.slow.push(c["close"])
+
+
+class StreamSma:
+    def __init__(self, period):
+        self.window = _Window(period)
+
+    def preview(self, c):
+        return {"sma": _ratio(self.window.peek(c["close"]), self.window.period)}
+
+    def commit(self, c):
+        self.window.push(c["close"])
+
+
+class StreamRsi:
+    def __init__(self, period):
+        self.period = period
+        self.n = 0
+        self.prev = None
+        self.gain = self.loss = 0.0
+
+    def _step(self, close):
+        if self.prev is None:
+            return None, 0.0, 0.0
+        diff = close - self.prev
+        up, down = max(diff, 0.0), max(-diff, 0.0)
+        if self.n < self.period:
+            return None, self.gain + up, self.loss + down
+        p = self.period
+        gain, loss = (self.gain * (p - 1) + up) / p, (self.loss * (p - 1) + down) / p
+        rs = 100.0 if loss == 0 else gain / loss
+        return 100 - 100 / (1 + rs), gain, loss
+
+    def preview(self, c):
+        return {"rsi": self._step(c["close"])[0]}
+
+    def commit(self, c):
+        _, self.gain, self.loss = self._step(c["close"])
+        self.prev = c["close"]
+        self.n += 1
+
+
+class StreamMacd:
+    def __init__(self, fast, slow, signal):
+        self.fast, self.slow, self.signal = _Ema(fast), _Ema(slow), _Ema(signal)
+
+    def preview(self, c):
+        macd = self.fast.peek(c["close"]) - self.slow.peek(c["close"])
+        signal = self.signal.peek(macd)
+        return {"macd": macd, "signal": signal, "hist": macd - signal}
+
+    def commit(self, c):
+        self.signal.push(self.fast.push(c["close"]) - self.slow.push(c["close"]))
+
+
+class StreamAtr:
+    def __init__(self, period):
+        self.period = period
+        self.window = _Window(period)
+        self.prev = None
+        self.n = 0
+
+    def _tr(self, c):
+        tr = c["high"] - c["low"]
+        if self.prev is not None:
+            tr = max(tr, abs(c["high"] - self.prev), abs(c["low"] - self.prev))
+        return tr
+
+    def preview(self, c):
+        if self.n < self.period:
+            return {"atr": None}
+        return {"atr": _ratio(self.window.peek(self._tr(c)), self.period)}
+
+    def commit(self, c):
+        self.window.push(self._tr(c))
+        self.prev = c["close"]
+        self.n += 1
+
+
+class StreamObv:
+    def __init__(self, smoothType, smoothLength):
+        self.length = smoothLength
+        self.smooth = None
+        if smoothLength > 1:
+            self.smooth = _Ema(smoothLength) if smoothType == "ema" else _Window(smoothLength)
+        self.value = 0.0
+        self.prev = None
+
+    def _obv(self, c):
+        if self.prev is None:
+            return 0.0
+        diff = c["close"] - self.prev
+        return self.value + (c["volume"] if diff > 0 else -c["volume"] if diff < 0 else 0.0)
+
+    def _smooth(self, value, op):
+        if self.smooth is None:
+            return None
+        result = getattr(self.smooth, op)(value)
+        return result if isinstance(self.smooth, _Ema) else _ratio(result, self.length)
+
+    def preview(self, c):
+        value = self._obv(c)
+        return {"obv": value, "smooth": self._smooth(value, "peek")}
+
+    def commit(self, c):
+        self.value = self._obv(c)
+        self._smooth(self.value, "push")
+        self.prev = c["close"]
+
+
+class StreamTsi:
+    def __init__(self, long, short, signal, zero=None):
+        self.num = (_Ema(long), _Ema(short))
+        self.den = (_Ema(long), _Ema(short))
+        self.signal = _Ema(signal) if signal else None
+        self.zero = zero
+        self.prev = None
+
+    def _value(self, c, op):
+        momentum = c["close"] - self.prev
+        num = getattr(self.num[1], op)(getattr(self.num[0], op)(momentum))
+        den = getattr(self.den[1], op)(getattr(self.den[0], op)(abs(momentum)))
+        return 100 * num / den if den else self.zero
+
+    def preview(self, c):
+        if self.prev is None:
+            return {"tsi": None, "signal": None}
+        tsi = self._value(c, "peek")
+        return {"tsi": tsi, "signal": self.signal.peek(tsi or 0.0)}
+
+    def commit(self, c):
+        if self.prev is not None:
+            self.signal.push(self._value(c, "push") or 0.0)
+        self.prev = c["close"]
+
+
+class StreamTrendStrength(StreamTsi):
+    def __init__(self, period):
+        super().__init__(period, period, 0, zero=0.0)
+
+    def preview(self, c):
+        return {"value": None if self.prev is None else self._value(c, "peek")}
+
+    def commit(self, c):
+        if self.prev is not None:
+            self._value(c, "push")
+        self.prev = c["close"]
+
+
+class StreamVolatilityOhlc:
+    def __init__(self, period):
+        self.window = _Window(period)
+        self.prev = None
+
+    def _vol(self, c):
+        return 0.0 if self.prev is None else (c["high"] - c["low"]) / self.prev * 100
+
+    def preview(self, c):
+        return {"value": _ratio(self.window.peek(self._vol(c)), self.window.period)}
+
+    def commit(self, c):
+        self.window.push(self._vol(c))
+        self.prev = c["close"]
+
+
+class StreamCfm:
+    def __init__(self, period):
+        self.mfv, self.vol = _Window(period), _Window(period)
+
+    @staticmethod
+    def _mfv(c):
+        span = c["high"] - c["low"]
+        mfm = ((c["close"] - c["low"]) - (c["high"] - c["close"])) / span if span else 0.0
+        return mfm * c["volume"]
+
+    def preview(self, c):
+        mfv, vol = self.mfv.peek(self._mfv(c)), self.vol.peek(c["volume"])
+        if vol is None:
+            return {"cfm": None}
+        return {"cfm": mfv / vol if vol else 0.0}
+
+    def commit(self, c):
+        self.mfv.push(self._mfv(c))
+        self.vol.push(c["volume"])
+
+
+class StreamBbw:
+    def __init__(self, period, mult):
+        self.period, self.mult = period, mult
+        # суммы считаем от опорной цены — без потери точности на x² больших цен
+        self.base = None
+        self.sum, self.sumsq = _Window(period), _Window(period)
+
+    def preview(self, c):
+        base = c["close"] if self.base is None else self.base
+        x = c["close"] - base
+        total, squares = self.sum.peek(x), self.sumsq.peek(x * x)
+        if total is None:
+            return {"bbw": None}
+        mean = total / self.period
+        std = math.sqrt(max(squares / self.period - mean * mean, 0.0))
+        return {"bbw": 2 * self.mult * std / (mean + base) * 100}
+
+    def commit(self, c):
+        if self.base is None:
+            self.base = c["close"]
+        x = c["close"] - self.base
+        self.sum.push(x)
+        self.sumsq.push(x * x)
+
+
+class StreamAo:
+    def __init__(self, short, long):
+        self.short, self.long = _Window(short), _Window(long)
+
+    def preview(self, c):
+        median = (c["high"] + c["low"]) / 2
+        long = self.long.peek(median)
+        if long is None:
+            return {"ao": None}
+        return {"ao": self.short.peek(median) / self.short.period - long / self.long.period}
+
+    def commit(self, c):
+        median = (c["high"] + c["low"]) / 2
+        self.short.push(median)
+        self.long.push(median)
+
+
+class StreamEfi:
+    def __init__(self, period):
+        self.ema = _Ema(alpha=2 / (period + 1), value=0.0)
+        self.prev = None
+
+    def preview(self, c):
+        if self.prev is None:
+            return {"efi": None}
+        return {"efi": self.ema.peek((c["close"] - self.prev) * c["volume"])}
+
+    def commit(self, c):
+        if self.prev is not None:
+            self.ema.push((c["close"] - self.prev) * c["volume"])
+        self.prev = c["close"]
+
+
+# vpvr — профиль окна, а не ряд по свечам: потоком не считается
+STREAMS = {
+    "ma": StreamMa,
+    "sma": StreamSma,
+    "rsi": StreamRsi,
+    "macd": StreamMacd,
+    "atr": StreamAtr,
+    "obv": StreamObv,
+    "tsi": StreamTsi,
+    "trendStrength": StreamTrendStrength,
+    "volatilityOHLC": StreamVolatilityOhlc,
+    "cfm": StreamCfm,
+    "bbw": StreamBbw,
+    "ao": StreamAo,
+    "efi": StreamEfi,
+}
+MAX_ROOM_STREAMS = 16
+
+
+def indicator_key(name: str, params: dict) -> str:
+    """Ключ в кадре: "rsi:14", "macd:12,26,9" — значения параметров в порядке умолчаний."""
+    return f"{name}:" + ",".join(str(value) for value in params.values())
+
+
+class LiveIndicator:
+    """Поток одного индикатора в комнате: коммитит закрытые свечи, формирующуюся — только preview."""
+
+    GAP = object()
+
+    def __init__(self, name: str, params: dict):
+        self.name, self.params = name, params
+        self.stream = STREAMS[name](**params)
+        self.last = None      # timestamp последней закрытой свечи в состоянии
+        self.pending = None   # формирующаяся свеча
+        self.ready = False
+
+    def _commit(self, candle):
+        self.stream.commit(candle)
+        self.last = candle["timestamp"]
+        self.pending = None
+
+    def seed(self, columns: dict, tf: str, now: float):
+        """История — колонки по возрастанию; формирующуюся свечу (если есть) не коммитим."""
+        for t, o, h, l, c, v in zip(*(columns[name] for name in COLUMNS)):
+            if bucket_end(t, tf) > now:
+                break
+            self._commit({"timestamp": t, "open": o, "high": h, "low": l, "close": c, "volume": v})
+        self.ready = True
+
+    def update(self, candle: dict, tf: str):
+        ts = candle["timestamp"]
+        if self.last is not None and ts <= self.last:
+            return None
+        # финальный кадр прошлой свечи мог потеряться
+        if self.pending is not None and ts > self.pending["timestamp"]:
+            self._commit(self.pending)
+        if self.last is not None and ts > bucket_end(self.last, tf):
+            return self.GAP
+        values = self.stream.preview(candle)
+        if candle.get("isFinal"):
+            self._commit(candle)
+        else:
+            self.pending = candle
+        return values
+
+
+class LiveIndicators:
+    """
+    Потоковые индикаторы по комнатам /ws/kline. Живут, пока у комнаты есть
+    подписчики; значения едут в тех же кадрах комнаты, поле "indicators".
+    """
+
+    def __init__(self, max_per_room: int = MAX_ROOM_STREAMS):
+        self.max_per_room = max_per_room
+        self.rooms = {}     # room -> {key: LiveIndicator}
+        self.tasks = set()
+        self.seeds = 0
+        self.updates = 0
+
+    def parse(self, specs) -> tuple:
+        """
+        specs — ["rsi", {"name": "macd", "params": {...}}].
+        Возвращает ключи для кадров, ошибки по отвергнутым спецификациям
+        и принятые спецификации в полном виде {"name", "params"}.
+        """
+        keys, errors, accepted = [], [], []
+        for spec in specs:
+            try:
+                name, params = (spec, {}) if isinstance(spec, str) else (spec["name"], spec.get("params") or {})
+                if name not in STREAMS:
+                    raise ValueError(f"unknown indicator {name}")
+                params = resolve_params(name, params)
+                key = indicator_key(name, params)
+                if key not in keys:
+                    if len(keys) >= self.max_per_room:
+                        raise ValueError("too many indicators")
+                    accepted.append({"name": name, "params": params})
+                keys.append(key)
+            except (ValueError, KeyError, TypeError, AttributeError) as e:
+                errors.append({"indicator": spec, "error": str(e) or "bad indicator"})
+        return keys, errors, accepted
+
+    def attach(self, room: str, specs) -> tuple:
+        """Подключает индикаторы к комнате; возвращает (ключи, ошибки), как parse."""
+        indicators = self.rooms.setdefault(room, {})
+        keys, errors, accepted = self.parse(specs)
+        for spec in accepted:
+            key = indicator_key(spec["name"], spec["params"])
+            if key in indicators:
+                continue
+            if len(indicators) >= self.max_per_room:
+                keys.remove(key)
+                errors.append({"indicator": spec, "error": "too many indicators"})
+                continue
+            indicators[key] = LiveIndicator(spec["name"], spec["params"])
+            self._seed(room, key)
+        return keys, errors
+
+    def _seed(self, room: str, key: str):
+        task = asyncio.create_task(self._load(room, key))
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+
+    async def _load(self, room: str, key: str):
+        indicator = self.rooms[room][key]
+        try:
+            exchange, market_type, symbol, tf = room.split(":")
+            columns = await find_history_columns(
+                exchange, market_type, symbol, tf, limit=warmup(indicator.name, indicator.params) + 1
+            )
+        except Exception as e:
+            print(f"[indicators] Seed error {room} {key}: {e}")
+            columns = {name: [] for name in COLUMNS}
+        # комнату могли закрыть, пока грузили историю
+        if self.rooms.get(room, {}).get(key) is indicator:
+            indicator.seed(columns, tf, time.time())
+            self.seeds += 1
+
+    def update(self, room: str, candle: dict):
+        indicators = self.rooms.get(room)
+        if not indicators:
+            return None
+        tf = room.rsplit(":", 1)[1]
+        values = {}
+        for key, indicator in list(indicators.items()):
+            if not indicator.ready:
+                continue
+            result = indicator.update(candle, tf)
+            if result is LiveIndicator.GAP:
+                # пропустили закрытую свечу — состояние заново из истории
+                indicators[key] = LiveIndicator(indicator.name, indicator.params)
+                self._seed(room, key)
+            elif result is not None:
+                values[key] = result
+        self.updates += 1
+        return values or None
+
+    def drop(self, room: str):
+        self.rooms.pop(room, None)
+
+    def stats(self):
+        return {
+            "rooms": len(self.rooms),
+            "streams": sum(map(len, self.rooms.values())),
+            "seeds": self.seeds,
+            "updates": self.updates,
+        }
+
+
+live_indicators = LiveIndicators()
@@ -0,0 +1,53 @@
+"""
+Процесс загрузки рынка для INGEST_MODE=external: один на всю установку.
+
+    python3 -m ingest
+
+Держит Binance (тикеры, kline-стримы, свечи), coinpaprika и heatmap, пишет в
+Mongo/Redis и раздаёт кадры веб-воркерам через bus.py. Kline-стримы
+открываются по подпискам воркеров, как в embedded-режиме — по подпискам сокетов.
+"""
+import asyncio
+
+from bus import bus
+from tickers import ticker_writer, initialize_redis_from_mongo, ensure_indexes as ensure_ticker_indexes
+from candles import ensure_indexes as ensure_candle_indexes, live_bars, candle_cache
+from candle_archive import candle_archive
+from indicators import indicator_cache, live_indicators
+from cex.binance import start_binance, kline_pools, supervise
+from cex.coinpaprika import start_coinpaprika
+from cex.enrichment import last_runs as enrichment_runs
+from modules.heatmap import heatmap_book
+
+
+def stats():
+    return {
+        "tickers": ticker_writer.stats(),
+        "klines": {market: pool.stats() for market, pool in kline_pools.items()},
+        "live_bars": live_bars.stats(),
+        "candle_cache": candle_cache.stats(),
+        "candle_archive": candle_archive.stats(),
+        "indicators": indicator_cache.stats(),
+        "live_indicators": live_indicators.stats(),
+        "heatmap": heatmap_book.stats(),
+        "enrichment": enrichment_runs,
+        "bus": bus.stats(),
+    }
+
+
+async def main():
+    bus.role = "ingest"
+    bus.stats_provider = stats
+    await initialize_redis_from_mongo()
+    await ensure_ticker_indexes()
+    asyncio.create_task(ensure_candle_indexes())
+    print("[ingest] Started")
+    await asyncio.gather(
+        supervise("bus", bus.run),
+        start_binance(),
+        supervise("coinpaprika", lambda: start_coinpaprika(interval=300)),
+    )
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
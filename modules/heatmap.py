@@ -1,78 +1,112 @@
-import json
+import asyncio
 import logging
-import threading
+from bisect import bisect_left, insort
 from fastapi import APIRouter, HTTPException
-from websocket import create_connection
+
+from bus import bus
 
 heatmap_bp = APIRouter()
 logging.basicConfig(level=logging.DEBUG)
 
-market_data_cache = []
+HEATMAP_SIZE = 350
+EXCLUDED = {'USDCUSDT', 'FDUSDUSDT', 'EURUSDT', 'PEPEUSDT'}
+TOP_GAINERS = 16
+TOP_LOSERS = 15
+
+
+def _remove(index: list, key):
+    i = bisect_left(index, key)
+    if i < len(index) and index[i] == key:
+        del index[i]
+
+
+class HeatmapBook:
+    """
+    Спотовые USDT-пары из !ticker@arr (через consumer в cex/binance).
+    Индексы по объёму и по % изменения правятся на каждый тикер бинпоиском,
+    снимок для /api/heatmap и /api/top собирается не чаще раза в interval.
+    """
+
+    def __init__(self, size: int = HEATMAP_SIZE):
+        self.size = size
+        self.items = {}        # symbol -> элемент heatmap
+        self.by_volume = []    # (-quote volume, symbol), по возрастанию
+        self.by_change = []    # (price_change, symbol), по возрастанию
+        self.version = 0
+        self.published = 0
+        self.snapshot = {"heatmap": [], "top": {"gainers": [], "losers": []}}
 
-def fetch_market_data():
-    try:
-        ws = create_connection("wss://stream.binance.com:9443/ws/!ticker@arr")
-        ping_interval=10,
-        ping_timeout=20,
-        logging.info("WebSocket connection established")
+    def update(self, t: dict):
+        symbol = t['s']
+        if not symbol.endswith('USDT') or symbol in EXCLUDED:
+            return
+        item = {
+            'symbol': symbol,
+            'price': float(t['c']),
+            'price_change': float(t['P']),
+            'market_cap': float(t['q']),
+            'volume_24h': float(t['v']),
+            'supply': float(t['Q'])
+        }
+        old = self.items.get(symbol)
+        if old is not None:
+            _remove(self.by_volume, (-old['market_cap'], symbol))
+            _remove(self.by_change, (old['price_change'], symbol))
+        self.items[symbol] = item
+        insort(self.by_volume, (-item['market_cap'], symbol))
+        insort(self.by_change, (item['price_change'], symbol))
+        self.version += 1
+
+    def _top(self, index, members: set, count: int) -> list:
+        # обход с края индекса до count пар из heatmap
+        top = []
+        for _, symbol in index:
+            if symbol in members:
+                top.append(self.items[symbol])
+                if len(top) == count:
+                    break
+        return top
+
+    def build(self) -> dict:
+        heatmap = [self.items[symbol] for _, symbol in self.by_volume[:self.size]]
+        members = {item['symbol'] for item in heatmap}
+        return {
+            "heatmap": heatmap,
+            "top": {
+                "gainers": self._top(reversed(self.by_change), members, TOP_GAINERS),
+                "losers": self._top(self.by_change, members, TOP_LOSERS)
+            }
+        }
+
+    def load(self, snapshot: dict):
+        # снимок от процесса ingest (INGEST_MODE=external)
+        self.snapshot = snapshot
+
+    def stats(self):
+        return {"symbols": len(self.items), "version": self.version, "published": self.published}
+
+    async def run(self, interval: float = 1.0):
         while True:
-            result = ws.recv()
-            logging.debug(f"Received data: {result}")
-            data = json.loads(result)
-
-            global market_data_cache
-            
-            filtered_data = [
-                item for item in data
-                if item['s'].endswith('USDT') and item['s'] not in ['USDCUSDT', 'FDUSDUSDT','EURUSDT','PEPEUSDT']
-            ]
-
-            sorted_data = sorted(filtered_data, key=lambda x: float(x['q']), reverse=True)[:350]
-
-            market_data_cache = [
-                {
-                    'symbol': item['s'],
-                    'price': float(item['c']),
-                    'price_change': float(item['P']),
-                    'market_cap': float(item['q']),
-                    'volume_24h': float(item['v']),
-                    'supply': float(item['Q'])
-                }
-                for item in sorted_data
-            ]
-
-            logging.debug(f"Market data cache updated: {market_data_cache}")
-
-    except Exception as e:
-        logging.error(f"Error fetching market data from WebSocket: {str(e)}")
-
-threading.Thread(target=fetch_market_data, daemon=True).start()
+            await asyncio.sleep(interval)
+            if self.version == self.published:
+                continue
+            self.published = self.version
+            self.snapshot = self.build()
+            await bus.publish_snapshot("heatmap", self.snapshot)
+
+
+heatmap_book = HeatmapBook()
+bus.on_snapshot("heatmap", heatmap_book.load)
+
 
 @heatmap_bp.get("/api/heatmap")
 async def get_market_data(page: int = 0, limit: int = 350):
-    try:
-        start = page * limit
-        end = start + limit
-
-        if start >= len(market_data_cache):
-            return []
+    if page < 0 or limit < 0:
+        raise HTTPException(status_code=400, detail="Invalid page")
+    start = page * limit
+    return heatmap_book.snapshot["heatmap"][start:start + limit]
 
-        return market_data_cache[start:end]
-    except Exception as e:
-        logging.error(f"Exception occurred while fetching market data: {str(e)}")
-        raise HTTPException(status_code=500, detail="Error fetching market data")
 
 @heatmap_bp.get("/api/top")
 async def get_tops():
-    try:
-        sorted_data = sorted(market_data_cache, key=lambda x: x['price_change'])
-        losers = sorted_data[:15]
-        gainers = sorted_data[-16:][::-1]
-
-        return {
-            "gainers": gainers,
-            "losers": losers
-        }
-    except Exception as e:
-        logging.error(f"Exception occurred while fetching top movers: {str(e)}")
-        raise HTTPException(status_code=500, detail="Error fetching top movers")
+    return heatmap_book.snapshot["top"]
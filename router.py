@@ -1,19 +1,122 @@
 from fastapi import APIRouter, Request, WebSocket, WebSocketDisconnect, HTTPException, Query
-from fastapi.responses import HTMLResponse, JSONResponse, RedirectResponse
+from fastapi.responses import HTMLResponse, RedirectResponse, Response
 from fastapi.templating import Jinja2Templates
-from db import db, redis_client
-from bson import ObjectId
+import gzip
+import json
+import time
+from collections import OrderedDict
+
+try:
+    import brotli   # в requirements.txt; без него отдаём только gzip
+except ImportError:
+    brotli = None
 
 from modules.ping import ping_bp
 from modules.desk import desk_bp
 from modules.img import router as img_bp
-from modules.heatmap import heatmap_bp
+from modules.heatmap import heatmap_bp, heatmap_book
 
-from tickers import save_ticker_data, get_ticker_data
+from tickers import ticker_writer, ticker_snapshot, ticker_stream
 from ws.manager import ws_manager
+from bus import bus
+from cex.binance import kline_pools, kline_stream
+from config import TICKER_PAGE_TTL
+from candle_archive import candle_archive
+from cex.enrichment import last_runs as enrichment_runs
+from indicators import INDICATORS, resolve_params, warmup, compute, to_json, indicator_cache, live_indicators
+from candles import (
+    live_bars, merge_live, room_name, find_history,
+    find_history_columns, merge_live_columns, pack_columns, rows_from_columns,
+    candle_cache, BINARY_LAYOUT
+)
 
 templates = Jinja2Templates(directory="templates")
 
+# мелкие ответы не сжимаем
+COMPRESS_MIN_SIZE = 1024
+# отрендеренных страниц тикеров в памяти
+TICKER_PAGES_MAX = 4096
+
+
+def accepted_encoding(request: Request, size: int) -> str:
+    """br / gzip / "" — чем сжимать тело размера size для этого клиента."""
+    accept = request.headers.get("accept-encoding", "")
+    if size < COMPRESS_MIN_SIZE:
+        return ""
+    if brotli and "br" in accept:
+        return "br"
+    if "gzip" in accept:
+        return "gzip"
+    return ""
+
+
+def compress(body: bytes, encoding: str) -> bytes:
+    if encoding == "br":
+        return brotli.compress(body, quality=4)
+    if encoding == "gzip":
+        return gzip.compress(body, compresslevel=5)
+    return body
+
+
+def encoded_response(request: Request, body: bytes, media_type: str, headers: dict = None,
+                     encoding: str = None) -> Response:
+    """
+    Отдаёт body сжатым br/gzip, если клиент это принимает. encoding задан —
+    body уже сжат им (например, из PageCache).
+    """
+    headers = dict(headers or {}, Vary="Accept-Encoding")
+    if encoding is None:
+        encoding = accepted_encoding(request, len(body))
+        body = compress(body, encoding)
+    if encoding:
+        headers["Content-Encoding"] = encoding
+    return Response(content=body, media_type=media_type, headers=headers)
+
+
+class PageCache:
+    """
+    Отрендеренный HTML на ttl секунд: одинаковые данные не рендерим заново.
+    Рядом — тело, уже сжатое каждым запрошенным кодированием: сжимаем раз на рендер.
+    """
+
+    def __init__(self, ttl: float = TICKER_PAGE_TTL, max_pages: int = TICKER_PAGES_MAX):
+        self.ttl = ttl
+        self.max_pages = max_pages
+        self.pages = OrderedDict()   # key -> (истекает, {кодирование: тело}), "" — сам html
+        self.hits = 0
+        self.renders = 0
+        self.compressions = 0
+
+    def get(self, key):
+        page = self.pages.get(key)
+        if page is None or page[0] < time.monotonic():
+            return None
+        self.hits += 1
+        return page[1][""]
+
+    def encoded(self, key, encoding: str) -> bytes:
+        """Тело страницы key (она только что из get/put) в кодировании encoding."""
+        bodies = self.pages[key][1]
+        if encoding not in bodies:
+            bodies[encoding] = compress(bodies[""], encoding)
+            self.compressions += 1
+        return bodies[encoding]
+
+    def put(self, key, html: bytes):
+        self.pages[key] = (time.monotonic() + self.ttl, {"": html})
+        self.pages.move_to_end(key)
+        while len(self.pages) > self.max_pages:
+            self.pages.popitem(last=False)
+        self.renders += 1
+
+    def stats(self):
+        return {"pages": len(self.pages), "hits": self.hits, "renders": self.renders,
+                "compressions": self.compressions}
+
+
+ticker_pages = PageCache()
+
+
 router = APIRouter()
 router.include_router(ping_bp)
 router.include_router(desk_bp)
@@ -50,60 +153,161 @@ async def get_ticker_page(
     if symbol != symbol.upper():
         return RedirectResponse(url=f"/{exchange}/{market_type}/{symbol.upper()}")
 
+    # известные тикеры — в снимке в памяти: неизвестный символ не доходит до Mongo
+    await ticker_snapshot.ensure_loaded()
     key = f"{exchange}:{market_type}:{symbol}"
-    ticker_info = await db.tickers.find_one({"_id": key})
+    ticker_info = ticker_snapshot.items.get(key)
 
     if not ticker_info:
         raise HTTPException(status_code=404, detail="Ticker not found")
 
-    return templates.TemplateResponse("ticker.html", {
-        "request": request,
-        "exchange": exchange,
-        "market_type": market_type,
-        "symbol": symbol,
-        "ticker_info": ticker_info
-    })
+    # url_for в шаблоне строит абсолютные ссылки — кэшируем по хосту
+    page_key = (str(request.base_url), key)
+    html = ticker_pages.get(page_key)
+    if html is None:
+        html = templates.get_template("ticker.html").render({
+            "request": request,
+            "exchange": exchange,
+            "market_type": market_type,
+            "symbol": symbol,
+            "ticker_info": ticker_info
+        }).encode()
+        ticker_pages.put(page_key, html)
+
+    encoding = accepted_encoding(request, len(html))
+    return encoded_response(request, ticker_pages.encoded(page_key, encoding), "text/html; charset=utf-8", {
+        "Cache-Control": f"public, max-age={int(TICKER_PAGE_TTL)}"
+    }, encoding=encoding)
+
+
+async def stored_columns(exchange, market_type, symbol, tf, before, limit):
+    """Колонки свечей из Mongo + архива вместе с формирующейся — когда кэш не ответил."""
+    columns = await find_history_columns(exchange, market_type, symbol, tf, before=before, limit=limit)
+    live = live_bars.get(room_name(exchange, market_type, symbol, tf))
+    return merge_live_columns(columns, live, before=before, limit=limit)
+
+
+async def history_columns(exchange, market_type, symbol, tf, before, limit):
+    """Колонки свечей вместе с формирующейся: кэш в памяти, иначе Mongo + архив."""
+    columns = await candle_cache.history(exchange, market_type, symbol, tf, before=before, limit=limit)
+    if columns is None:
+        columns = await stored_columns(exchange, market_type, symbol, tf, before, limit)
+    return columns
 
 
 # History (candles)
 @router.get("/{exchange}/{market_type}/{symbol}/history")
 async def get_candles(
+    request: Request,
     exchange: str,
     market_type: str,
     symbol: str,
     tf: str = Query("1m"),
     limit: int = Query(2000),
-    before: int = Query(None)  # Unix timestamp
+    before: int = Query(None),  # Unix timestamp
+    format: str = Query("json", pattern="^(json|columns|binary)$")
 ):
-    collection_name = f"{exchange}_{market_type}_candles_{tf}"
-    query = {"symbol": symbol}
-    if before:
-        query["timestamp"] = {"$lt": before}
-
-    cursor = db[collection_name].find(query).sort("timestamp", -1)
-    if limit:
-        cursor = cursor.limit(limit)
-
-    history = await cursor.to_list(None)
-    for candle in history:
-        candle["_id"] = str(candle["_id"])
+    """
+    format=json    — список свечей (по умолчанию)
+    format=columns — {"t": [...], "o": [...], "h", "l", "c", "v"}
+    format=binary  — колонки подряд, t int64 + o/h/l/c/v float64, little-endian
+    Колоночные форматы сжимаются br/gzip по Accept-Encoding.
+    """
+    # свежая история и неглубокая прокрутка — из кэша в памяти
+    columns = await candle_cache.history(exchange, market_type, symbol, tf, before=before, limit=limit)
+
+    if format != "json":
+        if columns is None:
+            # кэш уже спрошен выше — второй раз не идём, иначе промах посчитается дважды
+            columns = await stored_columns(exchange, market_type, symbol, tf, before, limit)
+        if format == "columns":
+            return encoded_response(request, json.dumps(columns, separators=(",", ":")).encode(), "application/json")
+        return encoded_response(request, pack_columns(columns), "application/octet-stream", {
+            "X-Candle-Count": str(len(columns["t"])),
+            "X-Candle-Layout": BINARY_LAYOUT
+        })
+
+    if columns is not None:
+        return rows_from_columns(columns)
+
+    history = await find_history(exchange, market_type, symbol, tf, before=before, limit=limit)
+    # незакрытая свеча живёт в памяти — докладываем её поверх истории
+    live = live_bars.get(room_name(exchange, market_type, symbol, tf))
+    history = merge_live(history, live, before=before, limit=limit)
     # возвращаем в хронологическом порядке
     return history[::-1]
 
 
+# Indicators
+@router.get("/{exchange}/{market_type}/{symbol}/indicators")
+async def get_indicators(
+    request: Request,
+    exchange: str,
+    market_type: str,
+    symbol: str,
+    name: str,
+    tf: str = Query("1m"),
+    params: str = Query("{}"),  # JSON, как defaultParams на клиенте
+    limit: int = Query(2000),
+    before: int = Query(None)
+):
+    """
+    Колонки {"t": [...], <линии индикатора>: [...]} на тех же свечах, что
+    /history с теми же limit/before; свечи прогрева сервер догружает сам.
+    vpvr отдаёт профиль окна: price_low/price_high/up/down и индексы poc/vah/val.
+    """
+    if name not in INDICATORS:
+        raise HTTPException(status_code=404, detail="Indicator not found")
+    try:
+        params = json.loads(params)
+        if not isinstance(params, dict):
+            raise ValueError(params)
+        params = resolve_params(name, params)
+    except (ValueError, TypeError):
+        raise HTTPException(status_code=400, detail="Invalid params")
+
+    columns = await history_columns(exchange, market_type, symbol, tf, before, limit + warmup(name, params))
+    key = (exchange, market_type, symbol, tf, name, tuple(sorted(params.items())), before, limit)
+    stamp = indicator_cache.stamp(columns)
+    body = indicator_cache.get(key, stamp)
+    if body is None:
+        result = compute(name, columns, params, skip=max(0, len(columns["t"]) - limit))
+        body = json.dumps(to_json(result), separators=(",", ":")).encode()
+        indicator_cache.put(key, stamp, body)
+    return encoded_response(request, body, "application/json")
+
+
 # JSON список тикеров
 @router.get("/tickers/json")
-async def tickers_json():
-    tickers = await db.tickers.find().to_list(None)
-    for ticker in tickers:
-        ticker["_id"] = str(ticker["_id"])
-    return tickers
+async def tickers_json(request: Request, since: str = Query(None)):
+    """
+    Без since — полный список. Версия снимка — в заголовке X-Tickers-Version.
+    since=<версия> — {"version": ..., "full": false, "tickers": [изменившиеся]};
+    если версия не этого процесса (рестарт, другой воркер) — full: true и весь список.
+    Из памяти, без Mongo; ETag/If-None-Match → 304, gzip по Accept-Encoding.
+    """
+    await ticker_snapshot.ensure_loaded()
+    entry = ticker_snapshot.body(since)
+    headers = {
+        "ETag": entry[0],
+        "X-Tickers-Version": ticker_snapshot.version,
+        "Cache-Control": "no-cache",
+        "Vary": "Accept-Encoding"
+    }
+    if request.headers.get("if-none-match") == entry[0]:
+        return Response(status_code=304, headers=headers)
+    body = entry[1]
+    if len(body) >= COMPRESS_MIN_SIZE and "gzip" in request.headers.get("accept-encoding", ""):
+        body = ticker_snapshot.gzipped(entry)
+        headers["Content-Encoding"] = "gzip"
+    return Response(content=body, media_type="application/json", headers=headers)
 
 
 # Список тикеров в HTML
 @router.get("/tickers", response_class=HTMLResponse)
 async def tickers_list(request: Request):
-    tickers = await db.tickers.find().to_list(None)
+    await ticker_snapshot.ensure_loaded()
+    tickers = list(ticker_snapshot.items.values())
     ticker_count = len(tickers)
     return templates.TemplateResponse("tickers.html", {
         "request": request,
@@ -112,30 +316,148 @@ async def tickers_list(request: Request):
     })
 
 
+# Метрики рассылки и записи тикеров
+@router.get("/api/stats")
+async def stats():
+    return {
+        "ws": ws_manager.stats(),
+        "tickers": ticker_writer.stats(),
+        "ticker_snapshot": ticker_snapshot.stats(),
+        "ticker_stream": ticker_stream.stats(),
+        "ticker_pages": ticker_pages.stats(),
+        "klines": {market: pool.stats() for market, pool in kline_pools.items()},
+        "live_bars": live_bars.stats(),
+        "candle_cache": candle_cache.stats(),
+        "candle_archive": candle_archive.stats(),
+        "indicators": indicator_cache.stats(),
+        "live_indicators": live_indicators.stats(),
+        "heatmap": heatmap_book.stats(),
+        "enrichment": enrichment_runs,
+        "bus": bus.stats(),
+        # INGEST_MODE=external: Binance/свечи/тикеры — в процессе ingest
+        "ingest": await bus.ingest_stats()
+    }
+
+
+def kline_room(item) -> str:
+    """Комната из строки "exchange:market_type:symbol:tf" или из объекта с такими полями."""
+    if isinstance(item, str):
+        exchange, market_type, symbol, tf = item.split(":")
+    else:
+        exchange, market_type, symbol = item["exchange"], item["market_type"], item["symbol"]
+        tf = item.get("tf", "1m")
+        if any(":" in part for part in (exchange, market_type, symbol, tf)):
+            raise ValueError("bad room")
+    return f"{exchange}:{market_type}:{symbol.upper()}:{tf}"
+
+
 # WebSocket-роут для K-line в реальном времени
 @router.websocket("/ws/kline")
 async def kline_ws(
     websocket: WebSocket,
-    exchange: str     = Query(...),
-    market_type: str  = Query(...),
-    symbol: str       = Query(...),
+    exchange: str     = Query(None),
+    market_type: str  = Query(None),
+    symbol: str       = Query(None),
     tf: str           = Query("1m"),
+    batch_ms: int     = Query(0, ge=0, le=5000),
 ):
     """
-    Подключиться можно так:
+    Одна комната из query (кадры приходят как есть):
     wss://<ваш-домен>/ws/kline?exchange=binance&market_type=spot&symbol=BTCUSDT&tf=1m
+
+    Мультиплекс: подключаемся без комнаты и шлём
+    {"op": "subscribe", "rooms": ["binance:spot:BTCUSDT:1m", {"exchange": "binance", "market_type": "futures", "symbol": "ETHUSDTPERP", "tf": "5m"}]}
+    {"op": "unsubscribe", "rooms": ["binance:spot:BTCUSDT:1m"]}
+    Кадры приходят как {"room": ..., "data": ...}; с batch_ms=N — пачкой {"batch": [...]} раз в N мс.
+
+    Потоковые индикаторы: в объекте комнаты
+    "indicators": ["rsi", {"name": "macd", "params": {"fast": 12, "slow": 26, "signal": 9}}].
+    Ответ на subscribe перечисляет их ключи ("indicators": {room: ["rsi:14", "macd:12,26,9"]}),
+    значения приходят в кадрах свечей: data.indicators = {"rsi:14": {"rsi": ...}, ...}.
+    Индикаторы живут, пока у комнаты есть подписчики.
+    Ответы на команды приходят с "room": null.
     """
     await websocket.accept()
-    room = f"{exchange}:{market_type}:{symbol.upper()}:{tf}"
+    room = kline_room({"exchange": exchange, "market_type": market_type, "symbol": symbol, "tf": tf}) \
+        if exchange and market_type and symbol else None
 
-    # регистрируем вебсокет в комнате
-    await ws_manager.connect(websocket, room)
+    # регистрируем вебсокет (и комнату, если передана в query)
+    await ws_manager.connect(websocket, room, batch_ms=batch_ms)
 
     try:
-        # держим соединение живым
+        # по снимку тикеров проверяются комнаты с индикаторами
+        await ticker_snapshot.ensure_loaded()
         while True:
-            await websocket.receive_text()
+            text = await websocket.receive_text()
+            try:
+                msg = json.loads(text)
+            except ValueError:
+                # не JSON — просто keepalive
+                continue
+            if not isinstance(msg, dict) or msg.get("op") not in ("subscribe", "unsubscribe"):
+                continue
+
+            op = msg["op"]
+            done, errors, indicators = [], [], {}
+            for item in msg.get("rooms") or []:
+                try:
+                    name = kline_room(item)
+                    if op == "subscribe":
+                        ws_manager.subscribe(websocket, name)
+                    else:
+                        ws_manager.unsubscribe(websocket, name)
+                    done.append(name)
+                except (ValueError, KeyError, TypeError, AttributeError) as e:
+                    errors.append({"room": item, "error": str(e) or "bad room"})
+                    continue
+                if op == "subscribe" and isinstance(item, dict) and isinstance(item.get("indicators"), list):
+                    if kline_stream(name) is None:
+                        # свечей в такой комнате не будет — индикаторам не на чем считаться
+                        errors.append({"room": name, "error": "unknown room"})
+                        continue
+                    indicators[name], failed = bus.attach_indicators(name, item["indicators"])
+                    errors += [{"room": name, **error} for error in failed]
+
+            reply = {"op": op, "rooms": done, "errors": errors}
+            if indicators:
+                reply["indicators"] = indicators
+            await ws_manager.send(websocket, reply)
     except WebSocketDisconnect:
         await ws_manager.disconnect(websocket)
     except Exception:
         await ws_manager.disconnect(websocket)
+
+
+# WebSocket тикеров вместо опроса /tickers/json
+@router.websocket("/ws/tickers")
+async def tickers_ws(
+    websocket: WebSocket,
+    exchange: str     = Query("binance"),
+    market_type: str  = Query(None),
+    symbols: str      = Query(None),  # BTCUSDT,ETHUSDTPERP
+    batch_ms: int     = Query(0, ge=0, le=5000),
+):
+    """
+    wss://<ваш-домен>/ws/tickers?market_type=spot&symbols=BTCUSDT,ETHUSDT
+    Без market_type — все рынки, без symbols — все тикеры рынка.
+    Кадры {"room": ..., "data": ...}: сначала один {"type": "snapshot", "rooms", "tickers"}
+    на все комнаты, дальше {"type": "update", "tickers": [изменившиеся]}
+    раз в TICKER_PUSH_MS.
+    """
+    await websocket.accept()
+    manager = ticker_stream.manager
+    await manager.connect(websocket, batch_ms=batch_ms)
+    try:
+        symbol_list = [s for s in (symbols or "").split(",") if s]
+        await ticker_stream.subscribe(websocket, ticker_stream.rooms(exchange, market_type, symbol_list))
+        while True:
+            # входящие — только keepalive
+            await websocket.receive_text()
+    except WebSocketDisconnect:
+        await manager.disconnect(websocket)
+    except ValueError as e:
+        # слишком много symbols
+        await manager.disconnect(websocket)
+        await websocket.close(code=1008, reason=str(e)[:120])
+    except Exception:
+        await manager.disconnect(websocket)
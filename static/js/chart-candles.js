@@ -1,5 +1,7 @@
 // chart-candles.js
 import { num } from './chart-utils.js';
+import { subscribeKline } from './chart-socket.js';
+import { fetchCandlesBinary } from './chart-data.js';
 
 // --- настройки рендера свечей ---
 export const candleRenderSettings = {
@@ -112,7 +114,7 @@ export function initCandles(chartCore, chartSettings) {
                   || "candles").toLowerCase();
   chartCore.state.chartStyle = savedStyle;
   localStorage.setItem("chartStyle", savedStyle);
-  try { chartCore._candleSocket?.close(); } catch {}
+  try { chartCore._candleUnsubscribe?.(); } catch {}
   // сначала история
   loadOHLCV(chartCore, chartSettings).then(() => {
     connectCandlesSocket(chartCore, chartSettings);
@@ -120,7 +122,8 @@ export function initCandles(chartCore, chartSettings) {
   return {
     render: () => drawCandlesOnly(chartCore),
     destroy: () => {
-      try { chartCore._candleSocket?.close(); } catch {}
+      try { chartCore._candleUnsubscribe?.(); } catch {}
+      chartCore._candleUnsubscribe = null;
       cleanupCandles(chartCore);
       isLoadingHistory = false;
       noMoreHistory = false;
@@ -133,9 +136,7 @@ export function initCandles(chartCore, chartSettings) {
 async function loadOHLCV(chartCore, { exchange, marketType, symbol, timeframe }) {
   try {
     const url = `/${exchange}/${marketType}/${symbol}/history?tf=${timeframe}&limit=2000`;
-    const res = await fetch(url);
-    if (!res.ok) throw new Error(`HTTP ${res.status}`);
-    const data = await res.json();
+    const data = await fetchCandlesBinary(url);
     const intervalMs = chartCore.state.tfMs || 60000;
     const candles = data.map(c => {
       let ts = c.time ?? c.timestamp ?? c.openTime;
@@ -188,10 +189,7 @@ async function checkAndLoadHistory(chartCore, trigger = "viewport") {
     try {
       const oldest = candles[0].time;
       const url = `/${chartCore.chartSettings.exchange}/${chartCore.chartSettings.marketType}/${chartCore.chartSettings.symbol}/history?tf=${chartCore.chartSettings.timeframe}&before=${Math.floor(oldest/1000)}&limit=1000`;
-      const res = await fetch(url);
-      if (!res.ok) throw new Error(`HTTP ${res.status}`);
-
-      const data = await res.json();
+      const data = await fetchCandlesBinary(url);
       const intervalMs = chartCore.state.tfMs || 60000;
 
       // если сервер вернул пусто — фиксируем конец
@@ -288,27 +286,11 @@ export function safeCheckAndLoadHistory(chartCore, trigger = "viewport") {
   checkAndLoadHistory(chartCore, trigger);
 }
 
-// --- подключение сокета ---
+// --- подписка на свечи через общий сокет ---
 function connectCandlesSocket(chartCore, { exchange, marketType, symbol, timeframe, onUpdate }) {
-  const proto = location.protocol === "https:" ? "wss" : "ws";
-  const url = `${proto}://${location.host}/ws/kline?exchange=${exchange}&market_type=${marketType}&symbol=${symbol}&tf=${timeframe}`;
-  const ws = new WebSocket(url);
-  chartCore._candleSocket = ws;
-  //ws.onopen = () => console.log("[candles] socket OPEN");
-  ws.onerror = e => console.warn("[candles] socket ERROR", e);
-  ws.onclose = e => {
-    console.warn("[candles] socket CLOSE", e.code, e.reason);
-    if (chartCore._alive && ws.readyState !== WebSocket.OPEN) {
-      setTimeout(
-        () => connectCandlesSocket(chartCore, { exchange, marketType, symbol, timeframe, onUpdate }),
-        800
-      );
-    }
-  };
-  ws.onmessage = e => {
+  chartCore._candleUnsubscribe = subscribeKline({ exchange, marketType, symbol, timeframe }, data => {
     if (!chartCore._alive) return;
     try {
-      const data = JSON.parse(e.data);
       if (!("open" in data) || !("close" in data)) return;
 
       const style = chartCore.state.chartStyle || "candles";
@@ -342,7 +324,7 @@ function connectCandlesSocket(chartCore, { exchange, marketType, symbol, timefra
     } catch (err) {
       console.warn("[candles] parse error:", err);
     }
-  };
+  });
 }
 
 // --- обновление последней свечи ---
@@ -36,4 +36,18 @@ export async function loadMoreCandles(exchange, marketType, symbol, timeframe, b
 
   console.log(`[loadMoreCandles] Получено свечей: ${candles.length}`);
   return candles;
-}
\ No newline at end of file
+}
+// бинарный /history?format=binary: колонки t(int64) o/h/l/c/v(float64), little-endian
+export async function fetchCandlesBinary(url) {
+  const res = await fetch(url + (url.includes("?") ? "&" : "?") + "format=binary");
+  if (!res.ok) throw new Error(`HTTP ${res.status}`);
+  const buf = await res.arrayBuffer();
+  const n = buf.byteLength / 48;
+  const t = new BigInt64Array(buf, 0, n);
+  const [o, h, l, c, v] = [1, 2, 3, 4, 5].map(i => new Float64Array(buf, i * n * 8, n));
+  const out = new Array(n);
+  for (let i = 0; i < n; i++) {
+    out[i] = { timestamp: Number(t[i]), open: o[i], high: h[i], low: l[i], close: c[i], volume: v[i] };
+  }
+  return out;
+}
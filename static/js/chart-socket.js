@@ -0,0 +1,91 @@
+// chart-socket.js
+// один мультиплекс-сокет /ws/kline на страницу: все графики подписываются через него
+
+const BATCH_MS = 100;
+const handlers = new Map(); // room -> Set(handler)
+const indicators = new Map(); // room -> [спецификации потоковых индикаторов]
+let socket = null;
+let reconnectTimer = null;
+
+function roomName({ exchange, marketType, symbol, timeframe }) {
+  return `${exchange}:${marketType}:${symbol.toUpperCase()}:${timeframe}`;
+}
+
+// комната с индикаторами уходит объектом: сервер досчитывает их в кадрах свечей
+function roomItem(room) {
+  const specs = indicators.get(room);
+  if (!specs?.length) return room;
+  const [exchange, market_type, symbol, tf] = room.split(":");
+  return { exchange, market_type, symbol, tf, indicators: specs };
+}
+
+function send(op, rooms) {
+  if (socket?.readyState === WebSocket.OPEN && rooms.length) {
+    socket.send(JSON.stringify({ op, rooms: op === "subscribe" ? rooms.map(roomItem) : rooms }));
+  }
+}
+
+function dispatch(room, data) {
+  const set = handlers.get(room);
+  if (!set) return;
+  set.forEach(fn => {
+    try { fn(data); } catch (err) { console.warn("[socket] handler error:", err); }
+  });
+}
+
+function connect() {
+  const proto = location.protocol === "https:" ? "wss" : "ws";
+  const ws = new WebSocket(`${proto}://${location.host}/ws/kline?batch_ms=${BATCH_MS}`);
+  socket = ws;
+  ws.onopen = () => send("subscribe", [...handlers.keys()]);
+  ws.onerror = e => console.warn("[socket] ERROR", e);
+  ws.onclose = e => {
+    console.warn("[socket] CLOSE", e.code, e.reason);
+    if (socket === ws) socket = null;
+    // переподключаемся только если кто-то ещё слушает
+    if (handlers.size && !reconnectTimer) {
+      reconnectTimer = setTimeout(() => { reconnectTimer = null; connect(); }, 800);
+    }
+  };
+  ws.onmessage = e => {
+    let msg;
+    try { msg = JSON.parse(e.data); } catch { return; }
+    const frames = msg.batch ?? [msg];
+    for (const f of frames) {
+      if (f.room != null) dispatch(f.room, f.data);
+      else if (f.data?.errors?.length) console.warn("[socket]", f.data.op, f.data.errors);
+    }
+  };
+}
+
+// подписка графика на комнату; возвращает функцию отписки
+// params.indicators — ["rsi", { name: "macd", params: {...} }]: значения придут в data.indicators
+export function subscribeKline(params, handler) {
+  const room = roomName(params);
+  let set = handlers.get(room);
+  if (params.indicators?.length) {
+    const specs = indicators.get(room) ?? [];
+    indicators.set(room, [...specs, ...params.indicators]);
+    // повторный subscribe на уже открытую комнату только добавляет индикаторы
+    if (set) send("subscribe", [room]);
+  }
+  if (!set) {
+    set = new Set();
+    handlers.set(room, set);
+    send("subscribe", [room]);
+  }
+  set.add(handler);
+  if (!socket) connect();
+
+  return () => {
+    const s = handlers.get(room);
+    if (!s) return;
+    s.delete(handler);
+    if (!s.size) {
+      handlers.delete(room);
+      indicators.delete(room);
+      send("unsubscribe", [room]);
+    }
+    if (!handlers.size) socket?.close();
+  };
+}
@@ -73,11 +73,14 @@ window.addEventListener("DOMContentLoaded", async () => {
     }
   });
 
-  await fetchTickers();
+  connectTickers();
 });
 
 let tickers = [];
 let autoUpdate = true;
+// версия снимка на сервере: дальше запрашиваем только изменения
+let tickersVersion = null;
+const tickersById = new Map();
 
 const state = {
   sortBy: localStorage.getItem("sortBy") || "market_cap",
@@ -89,6 +92,7 @@ document.getElementById("toggle-update").addEventListener("click", () => {
   const el = document.getElementById("toggle-update");
   el.classList.toggle("on", autoUpdate);
   el.querySelector("b").className = autoUpdate ? "icon-on" : "icon-off";
+  scheduleRender();
 });
 
 document.getElementById("hide-small").addEventListener("change", () => {
@@ -131,6 +135,7 @@ function formatPrice(price) {
 }
 
 function formatNumber(val) {
+  if (val === null || val === undefined) return "—";
   const num = parseFloat(val);
   if (num >= 1e9) return (num / 1e9).toFixed(2) + "b";
   if (num >= 1e6) return (num / 1e6).toFixed(2) + "m";
@@ -196,24 +201,89 @@ function render() {
   });
 }
 
+function normalizeTicker(t) {
+  return {
+    ...t,
+    exchange: t.exchange || "unknown",
+    market_type: t.market_type || "spot"
+  };
+}
+
 async function fetchTickers() {
   if (!autoUpdate) return;
 
   try {
-    const res = await fetch("/tickers/json");
-    const data = await res.json();
-    tickers = data.map(t => ({
-      ...t,
-      exchange: t.exchange || "unknown",
-      market_type: t.market_type || "spot"
-    }));
+    if (tickersVersion === null) {
+      const res = await fetch("/tickers/json");
+      const data = await res.json();
+      tickersVersion = res.headers.get("X-Tickers-Version");
+      tickersById.clear();
+      data.forEach(t => tickersById.set(t._id, normalizeTicker(t)));
+    } else {
+      const res = await fetch(`/tickers/json?since=${encodeURIComponent(tickersVersion)}`);
+      if (res.status === 304) return;
+      const data = await res.json();
+      tickersVersion = data.version;
+      if (data.full) tickersById.clear();
+      if (!data.tickers.length && !data.full) return;
+      data.tickers.forEach(t => tickersById.set(t._id, normalizeTicker(t)));
+    }
+    tickers = [...tickersById.values()];
     render();
   } catch (e) {
     console.error("Fetch error", e);
   }
 }
 
-setInterval(fetchTickers, 3000);
+// Пуш с сервера: снимок при подключении, дальше пачки изменившихся тикеров.
+// Пока сокета нет — опрос /tickers/json (с since), как раньше.
+let tickerSocket = null;
+let pollTimer = null;
+let renderPending = false;
+
+function scheduleRender() {
+  if (!autoUpdate || renderPending) return;
+  renderPending = true;
+  requestAnimationFrame(() => {
+    renderPending = false;
+    tickers = [...tickersById.values()];
+    render();
+  });
+}
+
+function startPolling() {
+  if (pollTimer) return;
+  fetchTickers();
+  pollTimer = setInterval(fetchTickers, 3000);
+}
+
+function stopPolling() {
+  clearInterval(pollTimer);
+  pollTimer = null;
+}
+
+function connectTickers() {
+  const protocol = location.protocol === "https:" ? "wss" : "ws";
+  tickerSocket = new WebSocket(`${protocol}://${location.host}/ws/tickers`);
+
+  tickerSocket.onopen = () => stopPolling();
+
+  tickerSocket.onmessage = (event) => {
+    const frame = JSON.parse(event.data);
+    const data = frame.data || {};
+    if (!Array.isArray(data.tickers)) return;
+    data.tickers.forEach(t => tickersById.set(t._id, normalizeTicker(t)));
+    // опрос после переподключения начнёт с полного списка
+    tickersVersion = null;
+    scheduleRender();
+  };
+
+  tickerSocket.onclose = () => {
+    tickerSocket = null;
+    startPolling();
+    setTimeout(connectTickers, 5000);
+  };
+}
 
 document.getElementById("clearStorage").addEventListener("click", () => {
   localStorage.removeItem("sortBy");
@@ -1,39 +1,316 @@
-from db import db, redis_client
+import asyncio
+import gzip
+import time
+from collections import OrderedDict
+from db import db, redis_client, redis_set_many
+from pymongo import UpdateOne
 import json
 
+from bus import bus
+from config import TICKER_PUSH_MS
+from candle_store import MARKETS
+from ws.manager import ConnectionManager
+
 async def initialize_redis_from_mongo():
-    if redis_client.get("initialized"):
+    if await redis_client.get("initialized"):
         print("[init] Redis already initialized. Skipping.")
         return
 
     print("[init] Redis is empty or not marked initialized. Restoring from MongoDB...")
     tickers = await db.tickers.find().to_list(None)
-    for t in tickers:
-        symbol = t["symbol"]
-        redis_client.set(symbol, json.dumps(t))
-    
-    redis_client.set("initialized", "1")
+    await redis_set_many({t["symbol"]: json.dumps(t) for t in tickers})
+
+    await redis_client.set("initialized", "1")
     print(f"[init] Restored {len(tickers)} tickers into Redis.")
 
 
+async def ensure_indexes():
+    await db.tickers.create_index([("market_type", 1), ("symbol", 1)], name="market_type_symbol")
+
+
+def ticker_key(data: dict) -> str:
+    return f"{data['exchange']}:{data['market_type']}:{data['symbol']}"
+
+
 async def save_ticker_data(data: dict):
-    symbol = data["symbol"]
-    exchange = data["exchange"]
-    market_type = data["market_type"]
-    key = f"{exchange}:{market_type}:{symbol}"
+    key = ticker_key(data)
 
     await db.tickers.update_one({"_id": key}, {"$set": data}, upsert=True)
-    redis_client.set(key, json.dumps(data))
+    await redis_client.set(key, json.dumps(data))
 
 async def get_ticker_data(exchange: str, market_type: str, symbol: str):
     key = f"{exchange.lower()}:{market_type.lower()}:{symbol.upper()}"
 
-    data = redis_client.get(key)
+    data = await redis_client.get(key)
     if data:
         return json.loads(data)
     
     doc = await db.tickers.find_one({"_id": key})
     if doc:
-        redis_client.set(key, json.dumps(doc))
+        await redis_client.set(key, json.dumps(doc))
     return doc
 
+
+# ====== Write-behind для тикеров ======
+
+class TickerWriter:
+    """
+    Копит последнее состояние каждого тикера (exchange:market_type:symbol)
+    и раз в interval секунд сбрасывает всё одной пачкой:
+    один bulk_write в Mongo и один MSET в Redis через pipeline.
+    """
+
+    def __init__(self, interval: float = 0.5, stats_interval: float = 60):
+        self.interval = interval
+        self.stats_interval = stats_interval
+        self.pending = {}
+        self.queue = None
+
+        self.received = 0
+        self.written = 0
+        self.flushes = 0
+        self.last_flush_ms = 0.0
+        self.max_flush_ms = 0.0
+        self.total_flush_ms = 0.0
+
+    def submit(self, data: dict):
+        # более свежее состояние просто затирает предыдущее
+        self.pending[ticker_key(data)] = data
+        self.received += 1
+
+    async def flush(self):
+        if not self.pending:
+            return 0
+
+        batch, self.pending = self.pending, {}
+        started = time.perf_counter()
+
+        try:
+            ops = [UpdateOne({"_id": key}, {"$set": data}, upsert=True) for key, data in batch.items()]
+            await db.tickers.bulk_write(ops, ordered=False)
+
+            await redis_set_many({key: json.dumps(data) for key, data in batch.items()})
+        except Exception:
+            # возвращаем несохранённое, не затирая то, что успело прийти новее
+            for key, data in batch.items():
+                self.pending.setdefault(key, data)
+            raise
+        # снимок /tickers/json — здесь или в веб-воркерах
+        await bus.publish_feed("tickers", batch)
+
+        elapsed = (time.perf_counter() - started) * 1000
+        self.flushes += 1
+        self.written += len(batch)
+        self.last_flush_ms = elapsed
+        self.total_flush_ms += elapsed
+        self.max_flush_ms = max(self.max_flush_ms, elapsed)
+        return len(batch)
+
+    def stats(self):
+        return {
+            "queue_depth": self.queue.qsize() if self.queue else 0,
+            "pending": len(self.pending),
+            "received": self.received,
+            "written": self.written,
+            "coalesce_ratio": round(self.received / self.written, 2) if self.written else 0,
+            "flushes": self.flushes,
+            "last_flush_ms": round(self.last_flush_ms, 2),
+            "avg_flush_ms": round(self.total_flush_ms / self.flushes, 2) if self.flushes else 0,
+            "max_flush_ms": round(self.max_flush_ms, 2),
+        }
+
+    async def run(self, queue: asyncio.Queue = None):
+        # queue — входная очередь консьюмера, нужна только для метрики глубины
+        self.queue = queue
+        last_stats = time.time()
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                await self.flush()
+            except Exception as e:
+                print("[ticker_writer] Flush error:", e)
+
+            if time.time() - last_stats >= self.stats_interval:
+                last_stats = time.time()
+                print("[ticker_writer] Stats:", self.stats())
+
+
+ticker_writer = TickerWriter()
+
+
+# ====== Снимок всех тикеров для /tickers/json ======
+
+class TickerSnapshot:
+    """
+    Все тикеры в памяти: из Mongo один раз, дальше их правят пачки
+    TickerWriter и обогащения (фид "tickers" шины). Версия растёт на каждую
+    пачку; тела ответов (и их gzip) собираются один раз на версию.
+    Версия вида "{эпоха}-{номер}": эпоха своя у каждого процесса, так что
+    чужая или дорестартовая версия узнаётся и отвечается полным списком.
+    """
+
+    MAX_BODIES = 64
+
+    def __init__(self):
+        self.epoch = format(int(time.time() * 1000), "x")
+        self.items = {}               # key -> тикер
+        self.changed = OrderedDict()  # key -> номер версии, по возрастанию
+        self.number = 0
+        self.loaded = False
+        self.lock = asyncio.Lock()
+        self.bodies = {}              # since -> [etag, json, gzip]
+        self.bodies_number = 0
+        self.hits = 0
+        self.builds = 0
+
+    @property
+    def version(self) -> str:
+        return f"{self.epoch}-{self.number}"
+
+    def apply(self, batch: dict):
+        self.number += 1
+        for key, data in batch.items():
+            ticker = self.items.get(key)
+            self.items[key] = {**ticker, **data} if ticker else {"_id": key, **data}
+            self.changed[key] = self.number
+            self.changed.move_to_end(key)
+
+    async def ensure_loaded(self):
+        if self.loaded:
+            return
+        async with self.lock:
+            if self.loaded:
+                return
+            for ticker in await db.tickers.find().to_list(None):
+                key = ticker["_id"] = str(ticker["_id"])
+                # пачки, пришедшие за время загрузки, новее Mongo
+                newer = self.items.get(key)
+                self.items[key] = {**ticker, **newer} if newer else ticker
+            self.number += 1
+            self.loaded = True
+
+    def since(self, version: str):
+        """Тикеры, изменившиеся после version, или None, если version не наша."""
+        epoch, _, number = version.rpartition("-")
+        if epoch != self.epoch or not number.isdigit() or int(number) > self.number:
+            return None
+        return self.changed_after(int(number))
+
+    def changed_after(self, number: int) -> list:
+        changed = []
+        for key in reversed(self.changed):
+            if self.changed[key] <= number:
+                break
+            changed.append(self.items[key])
+        return changed
+
+    def body(self, since: str = None) -> list:
+        """[etag, json, gzip или None] для полного списка (since=None) или дельты."""
+        if self.bodies_number != self.number or len(self.bodies) > self.MAX_BODIES:
+            self.bodies, self.bodies_number = {}, self.number
+        entry = self.bodies.get(since)
+        if entry is not None:
+            self.hits += 1
+            return entry
+        if since is None:
+            payload, etag = list(self.items.values()), f'"{self.version}"'
+        else:
+            changed = self.since(since)
+            full = changed is None
+            payload = {"version": self.version, "full": full, "tickers": list(self.items.values()) if full else changed}
+            etag = f'"{self.version}/{since}"'
+        entry = [etag, json.dumps(payload, separators=(",", ":"), default=str).encode(), None]
+        self.bodies[since] = entry
+        self.builds += 1
+        return entry
+
+    def gzipped(self, entry: list) -> bytes:
+        if entry[2] is None:
+            entry[2] = gzip.compress(entry[1], compresslevel=5)
+        return entry[2]
+
+    def stats(self):
+        return {"tickers": len(self.items), "version": self.version, "hits": self.hits, "builds": self.builds}
+
+
+ticker_snapshot = TickerSnapshot()
+bus.on_feed("tickers", ticker_snapshot.apply)
+
+
+# ====== /ws/tickers ======
+
+class TickerStream:
+    """
+    Пуш тикеров вместо опроса /tickers/json. Комнаты своего ConnectionManager:
+        tickers:{exchange}:{market_type}           — весь рынок
+        tickers:{exchange}:{market_type}:{SYMBOL}  — один тикер
+    При подписке — один снимок всех комнат, дальше раз в interval изменившиеся
+    тикеры одной пачкой на комнату: всё, что пришло между тиками, схлопнуто.
+    """
+
+    def __init__(self, snapshot: TickerSnapshot, interval_ms: int = TICKER_PUSH_MS):
+        self.snapshot = snapshot
+        self.interval = interval_ms / 1000
+        self.manager = ConnectionManager()
+        self.number = 0
+        self.pushed = 0
+
+    @staticmethod
+    def rooms(exchange: str = "binance", market_type: str = None, symbols=None) -> list:
+        markets = [market_type] if market_type else list(MARKETS)
+        if not symbols:
+            return [f"tickers:{exchange}:{market}" for market in markets]
+        return [f"tickers:{exchange}:{market}:{symbol.upper()}" for market in markets for symbol in symbols]
+
+    def room_tickers(self, room: str) -> list:
+        _, exchange, market_type, *symbol = room.split(":")
+        if symbol:
+            ticker = self.snapshot.items.get(f"{exchange}:{market_type}:{symbol[0]}")
+            return [ticker] if ticker else []
+        return [t for t in self.snapshot.items.values()
+                if t.get("exchange") == exchange and t.get("market_type") == market_type]
+
+    async def subscribe(self, ws, rooms: list):
+        await self.snapshot.ensure_loaded()
+        tickers = []
+        for room in rooms:
+            self.manager.subscribe(ws, room)
+            tickers += self.room_tickers(room)
+        # один кадр на все комнаты: снимок не должен делиться на части, которые можно потерять
+        await self.manager.send(ws, json.dumps(
+            {"type": "snapshot", "rooms": rooms, "tickers": tickers},
+            separators=(",", ":"), default=str
+        ))
+
+    async def push(self):
+        if self.snapshot.number == self.number:
+            return
+        changed, self.number = self.snapshot.changed_after(self.number), self.snapshot.number
+        batches = {}
+        for ticker in changed:
+            room = f"tickers:{ticker.get('exchange')}:{ticker.get('market_type')}"
+            if self.manager.has_subscribers(room):
+                batches.setdefault(room, []).append(ticker)
+            symbol_room = f"{room}:{ticker.get('symbol')}"
+            if self.manager.has_subscribers(symbol_room):
+                batches.setdefault(symbol_room, []).append(ticker)
+        for room, tickers in batches.items():
+            await self.manager.broadcast(room, json.dumps(
+                {"type": "update", "tickers": tickers}, separators=(",", ":"), default=str
+            ))
+            self.pushed += 1
+
+    def stats(self):
+        return {"connections": len(self.manager.connections), "rooms": len(self.manager.rooms), "pushed": self.pushed}
+
+    async def run(self):
+        self.number = self.snapshot.number
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                await self.push()
+            except Exception as e:
+                print("[ticker_stream] Push error:", e)
+
+
+ticker_stream = TickerStream(ticker_snapshot)
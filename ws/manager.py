@@ -1,29 +1,275 @@
 # ws/manager.py
 
-from typing import Dict, List
+import asyncio
+import json
+import time
+from collections import deque
+from typing import Dict, Set
 from fastapi import WebSocket, WebSocketDisconnect
 
-class ConnectionManager:
+from config import WS_QUEUE_SIZE, WS_SLOW_POLICY, WS_MAX_ROOMS
+
+POLICIES = ("drop_oldest", "conflate", "disconnect")
+
+
+class RoomStats:
     def __init__(self):
-        # ключ — имя «комнаты», значение — список WebSocket
-        self.active_connections: Dict[str, List[WebSocket]] = {}
-
-    async def connect(self, ws: WebSocket, room: str):
-        if room not in self.active_connections:
-            self.active_connections[room] = []
-        self.active_connections[room].append(ws)
-
-    async def disconnect(self, ws: WebSocket):
-        # удаляем ws из всех комнат
-        for room, conns in self.active_connections.items():
-            if ws in conns:
-                conns.remove(ws)
-
-    async def broadcast(self, room: str, message: str):
-        # рассылаем message всем в комнате
-        conns = self.active_connections.get(room, [])
-        for conn in conns:
-            await conn.send_text(message)
+        self.frames = 0
+        self.sent = 0
+        self.dropped = 0
+        self.last_ms = 0.0
+        self.max_ms = 0.0
+        self.total_ms = 0.0
+
+    def sent_after(self, ms: float):
+        self.sent += 1
+        self.last_ms = ms
+        self.total_ms += ms
+        self.max_ms = max(self.max_ms, ms)
+
+    def as_dict(self):
+        return {
+            "frames": self.frames,
+            "sent": self.sent,
+            "dropped": self.dropped,
+            "fanout_last_ms": round(self.last_ms, 2),
+            "fanout_avg_ms": round(self.total_ms / self.sent, 2) if self.sent else 0,
+            "fanout_max_ms": round(self.max_ms, 2),
+        }
+
+
+class Connection:
+    """Сокет со своей ограниченной очередью и отдельной корутиной-писателем."""
+
+    def __init__(self, ws: WebSocket, manager: "ConnectionManager", maxsize: int, policy: str,
+                 tagged: bool = False, batch_ms: int = 0):
+        self.ws = ws
+        self.manager = manager
+        self.maxsize = maxsize
+        self.policy = policy
+        # tagged — кадры оборачиваются в {"room", "data"} (мультиплекс-режим)
+        # batch_ms — кадры копятся и уходят одним {"batch": [...]} раз в batch_ms
+        self.tagged = tagged or batch_ms > 0
+        self.batch_ms = batch_ms
+        # элементы очереди: (room, message, время broadcast, kind)
+        self.queue = deque()
+        # обратный индекс: комнаты, в которых состоит сокет
+        self.rooms: Set[str] = set()
+        self.ready = asyncio.Event()
+        self.closed = False
+        self.task = asyncio.create_task(self._writer())
+
+    def push(self, room: str, message: str, stamp: float, kind: str = None):
+        if self.closed:
+            return
+        if len(self.queue) >= self.maxsize:
+            if self.policy == "disconnect":
+                self.manager.count_drop(room)
+                self.closed = True
+                asyncio.create_task(self.manager.disconnect(self.ws, close=True))
+                return
+            if self.policy == "conflate":
+                self._conflate()
+            while len(self.queue) >= self.maxsize and self._drop_oldest():
+                pass
+        self.queue.append((room, message, stamp, kind))
+        self.ready.set()
+
+    def _drop_oldest(self) -> bool:
+        # личные кадры (room = None) — ответы протокола и снимки, их не выбрасываем
+        for i, item in enumerate(self.queue):
+            if item[0] is not None:
+                del self.queue[i]
+                self.manager.count_drop(item[0])
+                return True
+        return False
+
+    def _conflate(self):
+        # оставляем только последний кадр каждого вида в каждой комнате
+        latest, personal = {}, []
+        for item in self.queue:
+            if item[0] is None:
+                personal.append(item)
+                continue
+            key = (item[0], item[3])
+            if key in latest:
+                self.manager.count_drop(item[0])
+            latest[key] = item
+        self.queue = deque(sorted(personal + list(latest.values()), key=lambda item: item[2]))
+
+    def _tag(self, room: str, message: str) -> str:
+        # кадр уже сериализован для всей комнаты — только оборачиваем строкой
+        return '{"room":' + json.dumps(room) + ',"data":' + message + '}'
+
+    def _sent(self, room: str, stamp: float):
+        stats = self.manager.room_stats.get(room)
+        if stats:
+            stats.sent_after((time.perf_counter() - stamp) * 1000)
+
+    async def _writer(self):
+        try:
+            while True:
+                await self.ready.wait()
+                if self.batch_ms:
+                    # копим кадры всех комнат и отправляем одним сообщением
+                    await asyncio.sleep(self.batch_ms / 1000)
+                    self.ready.clear()
+                    items, self.queue = self.queue, deque()
+                    if not items:
+                        continue
+                    await self.ws.send_text(
+                        '{"batch":[' + ",".join(self._tag(room, message) for room, message, *_ in items) + ']}'
+                    )
+                    for room, _, stamp, _ in items:
+                        self._sent(room, stamp)
+                    continue
+
+                self.ready.clear()
+                while self.queue:
+                    room, message, stamp, _ = self.queue.popleft()
+                    await self.ws.send_text(self._tag(room, message) if self.tagged else message)
+                    self._sent(room, stamp)
+        except asyncio.CancelledError:
+            pass
+        except Exception:
+            # сокет умер — убираем его, не дожидаясь receive-цикла
+            self.closed = True
+            asyncio.create_task(self.manager.disconnect(self.ws))
+
+    def close(self):
+        self.closed = True
+        if self.task is not asyncio.current_task():
+            self.task.cancel()
+
+
+class ConnectionManager:
+    def __init__(self, queue_size: int = WS_QUEUE_SIZE, policy: str = WS_SLOW_POLICY,
+                 max_rooms: int = WS_MAX_ROOMS):
+        if policy not in POLICIES:
+            raise ValueError(f"Unknown slow consumer policy: {policy}")
+        self.queue_size = queue_size
+        self.policy = policy
+        self.max_rooms = max_rooms
+        # ключ — имя «комнаты», значение — множество WebSocket
+        self.rooms: Dict[str, Set[WebSocket]] = {}
+        self.connections: Dict[WebSocket, Connection] = {}
+        self.room_stats: Dict[str, RoomStats] = {}
+        # колбэки (room, active): комната появилась / опустела
+        self.room_listeners = []
+
+    def on_room(self, callback):
+        self.room_listeners.append(callback)
+
+    def _notify(self, room: str, active: bool):
+        for callback in self.room_listeners:
+            try:
+                callback(room, active)
+            except Exception as e:
+                print(f"[ws_manager] Room listener error {room}: {e}")
+
+    def stats_for(self, room: str) -> RoomStats:
+        stats = self.room_stats.get(room)
+        if stats is None:
+            stats = self.room_stats[room] = RoomStats()
+        return stats
+
+    def count_drop(self, room: str):
+        # статистику держим только для живых комнат
+        stats = self.room_stats.get(room)
+        if stats:
+            stats.dropped += 1
+
+    def has_subscribers(self, room: str) -> bool:
+        return room in self.rooms
+
+    async def connect(self, ws: WebSocket, room: str = None, batch_ms: int = 0):
+        if ws not in self.connections:
+            # без комнаты в query клиент работает по протоколу subscribe/unsubscribe
+            self.connections[ws] = Connection(
+                ws, self, self.queue_size, self.policy,
+                tagged=room is None, batch_ms=batch_ms
+            )
+        if room:
+            self.subscribe(ws, room)
+
+    def subscribe(self, ws: WebSocket, room: str):
+        conn = self.connections.get(ws)
+        if conn is None:
+            return
+        if room in conn.rooms:
+            return
+        if len(conn.rooms) >= self.max_rooms:
+            raise ValueError(f"Too many rooms per connection (max {self.max_rooms})")
+        if conn.rooms:
+            # больше одной комнаты — без тега кадры не различить
+            conn.tagged = True
+        conn.rooms.add(room)
+        if room not in self.rooms:
+            self.rooms[room] = set()
+            self._notify(room, True)
+        self.rooms[room].add(ws)
+
+    def unsubscribe(self, ws: WebSocket, room: str):
+        conn = self.connections.get(ws)
+        if conn:
+            conn.rooms.discard(room)
+        self._leave(ws, room)
+
+    def _leave(self, ws: WebSocket, room: str):
+        conns = self.rooms.get(room)
+        if conns is None:
+            return
+        conns.discard(ws)
+        if not conns:
+            # пустые комнаты не держим
+            del self.rooms[room]
+            self.room_stats.pop(room, None)
+            self._notify(room, False)
+
+    async def disconnect(self, ws: WebSocket, close: bool = False):
+        conn = self.connections.pop(ws, None)
+        if conn is None:
+            return
+        conn.close()
+        # удаляем ws только из его комнат
+        for room in conn.rooms:
+            self._leave(ws, room)
+        conn.rooms.clear()
+        if close:
+            try:
+                await ws.close(code=1013)
+            except Exception:
+                pass
+
+    async def send(self, ws: WebSocket, message):
+        # личное сообщение сокету (ответы протокола) через ту же очередь, room = null
+        conn = self.connections.get(ws)
+        if conn:
+            conn.push(None, message if isinstance(message, str) else json.dumps(message), time.perf_counter())
+
+    async def broadcast(self, room: str, message, kind: str = None):
+        # сериализуем один раз на комнату и раскладываем по очередям без ожидания;
+        # kind — вид кадра для conflate: кадры разных видов одной комнаты друг друга не вытесняют
+        conns = self.rooms.get(room)
+        if not conns:
+            return
+        if not isinstance(message, str):
+            message = json.dumps(message)
+        stamp = time.perf_counter()
+        self.stats_for(room).frames += 1
+        for ws in conns:
+            self.connections[ws].push(room, message, stamp, kind)
+
+    def stats(self):
+        return {
+            "connections": len(self.connections),
+            "policy": self.policy,
+            "queue_size": self.queue_size,
+            "rooms": {
+                room: dict(stats.as_dict(), subscribers=len(self.rooms.get(room, ())))
+                for room, stats in self.room_stats.items()
+            }
+        }
 
 # глобальный инстанс
 ws_manager = ConnectionManager()